@@ -1,5 +1,6 @@
 # Author: Michael Gschwandtner
 # Contact: blensor@zero997.com
+import os
 import sys
 import traceback
 from mathutils import Matrix
@@ -22,6 +23,13 @@ from . import exportmotion
 from . import mesh_utils
 from . import noise
 from . import raycast
+from . import ray_pattern
+from . import scan_processing
+from . import scan_interface
+from . import scan_interface_pure
+from . import scan_sequence
+from . import parallel
+from . import batch
 
 
 """If the blensor module is reloaded, reload all submodules as well
@@ -52,7 +60,12 @@ __all__ = [
     'generic_lidar',
     'exportmotion',
     'mesh_utils',
-    'noise'
+    'noise',
+    'ray_pattern',
+    'scan_processing',
+    'scan_sequence',
+    'parallel',
+    'batch'
     ]
 
 
@@ -102,6 +115,8 @@ def velodyne_layout(obj, layout):
             row = layout.row()
             row.prop(obj,"velodyne_noise_type")
             row = layout.row()
+            row.prop(obj, "velodyne_time_slices")
+            row = layout.row()
             col = row.column()
             col.prop(obj, "velodyne_start_angle")
             col = row.column()
@@ -166,6 +181,8 @@ def kinect_layout(obj, layout):
             row = layout.row()
             row.prop(obj, "kinect_noise_smooth")
             row = layout.row()
+            row.prop(obj, "kinect_noise_fields")
+            row = layout.row()
             col = row.column()
             col.prop(obj, "kinect_ref_dist")
             col = row.column()
@@ -179,6 +196,8 @@ def kinect_layout(obj, layout):
 def depthmap_layout(obj, layout):
             row = layout.row()
             row.prop(obj, "depthmap_max_dist")
+            row = layout.row()
+            row.prop(obj, "depthmap_format")
 
 def ibeo_layout(obj, layout):
             row = layout.row()
@@ -244,6 +263,7 @@ def dispatch_scan(obj, filename=None, output_labels=True):
             frame_current = bpy.context.scene.frame_current
 
             evd.output_labels = output_labels
+            evd.pcd_format = obj.pcd_format
             if obj.local_coordinates:
               world_transformation = Matrix()
             else:
@@ -263,7 +283,7 @@ def dispatch_scan(obj, filename=None, output_labels=True):
                   noise_sigma=obj.velodyne_noise_sigma, add_blender_mesh=obj.add_scan_mesh, 
                   add_noisy_blender_mesh=obj.add_noise_scan_mesh, 
                   rotation_speed = obj.velodyne_rotation_speed, evd_file=filename,
-                  world_transformation = world_transformation )
+                  world_transformation = world_transformation, time_slices=obj.velodyne_time_slices )
 
             elif obj.scan_type == "ibeo":
                 obj.ref_dist = obj.ibeo_ref_dist
@@ -314,8 +334,60 @@ def dispatch_scan(obj, filename=None, output_labels=True):
             bpy.context.scene.frame_current = frame_current
 
 
-def dispatch_scan_range(obj,filename,frame=0,last_frame=True, time_per_frame=1.0/24.0, output_labels=True):
+"""Scan the current frame with several sensors of a rig. The scene is
+   converted for the raycaster only once and shared by all sensors.
+   filenames has one entry per sensor. Depthmaps are rendered and can not
+   share the setup, they are scanned after the other sensors.
+   Every sensor is made the camera and the active object while it scans,
+   the scanners and mesh_utils read their settings from there.
+"""
+def dispatch_rig_scan(objs, filenames, output_labels=True):
+            scene = bpy.context.scene
+            camera = scene.camera
+            active = scene.objects.active
+            depthmaps = [(obj, filename) for obj, filename in zip(objs, filenames) if obj.scan_type == "depthmap"]
+            raycast = [(obj, filename) for obj, filename in zip(objs, filenames) if obj.scan_type != "depthmap"]
+
+            try:
+                scan_interface.begin_shared_render_setup()
+                try:
+                    for obj, filename in raycast:
+                        scene.camera = obj
+                        scene.objects.active = obj
+                        dispatch_scan(obj, filename, output_labels)
+                finally:
+                    scan_interface.end_shared_render_setup()
+
+                for obj, filename in depthmaps:
+                    scene.camera = obj
+                    scene.objects.active = obj
+                    dispatch_scan(obj, filename, output_labels)
+            finally:
+                scene.camera = camera
+                scene.objects.active = active
+
+"""One output file per sensor of a rig, the object name is appended to the
+   base name: scan.evd becomes scan_Velodyne.evd, scan_Kinect.evd, ...
+   Sensors that do not save their scans get None
+"""
+def rig_filenames(filepath, objs):
+            base, extension = os.path.splitext(filepath)
+            return ["%s_%s%s"%(base, obj.name, extension) if obj.save_scan else None for obj in objs]
+
+"""The selected sensors that can be scanned as a rig, the active object first"""
+def rig_scanners(context):
+            objs = [obj for obj in context.selected_objects if obj.type == "CAMERA"]
+            if context.object in objs:
+                objs.remove(context.object)
+                objs.insert(0, context.object)
+            return objs
+
+"""Scan frame as part of a range scan. With raise_errors an exception of
+   the scanner is passed on instead of only aborting the scan
+"""
+def dispatch_scan_range(obj,filename,frame=0,last_frame=True, time_per_frame=1.0/24.0, output_labels=True, raise_errors=False):
             evd.output_labels = output_labels
+            evd.pcd_format = obj.pcd_format
             evd.frame_counter = frame
 
             if obj.local_coordinates:
@@ -334,28 +406,29 @@ def dispatch_scan_range(obj,filename,frame=0,last_frame=True, time_per_frame=1.0
                   noise_sigma=obj.velodyne_noise_sigma,  rotation_speed = obj.velodyne_rotation_speed, 
                   frame_start = frame, frame_end=frame+1, filename=filename, last_frame=last_frame, 
                   frame_time=time_per_frame, world_transformation=world_transformation,
-                  add_blender_mesh=obj.add_scan_mesh, add_noisy_blender_mesh=obj.add_noise_scan_mesh)
+                  add_blender_mesh=obj.add_scan_mesh, add_noisy_blender_mesh=obj.add_noise_scan_mesh,
+                  time_slices=obj.velodyne_time_slices, raise_errors=raise_errors)
 
             elif obj.scan_type == "ibeo":
                 ibeo.scan_range(scanner_object = obj, angle_resolution=obj.ibeo_angle_resolution,
                   max_distance=obj.ibeo_max_dist, noise_mu = obj.ibeo_noise_mu, 
                   noise_sigma=obj.ibeo_noise_sigma,  rotation_speed = obj.ibeo_rotation_speed, 
                   frame_start = frame, frame_end=frame+1, filename=filename, last_frame=last_frame,
-                  world_transformation=world_transformation,
+                  world_transformation=world_transformation, raise_errors=raise_errors,
                   add_blender_mesh=obj.add_scan_mesh, add_noisy_blender_mesh=obj.add_noise_scan_mesh)
 
             elif obj.scan_type == "generic":
                 generic_lidar.scan_range( scanner_object = obj, add_blender_mesh=obj.add_scan_mesh, 
                   frame_start = frame, frame_end=frame+1, filename=filename, last_frame=last_frame, 
                   add_noisy_blender_mesh=obj.add_noise_scan_mesh, 
-                  world_transformation=world_transformation)
+                  world_transformation=world_transformation, raise_errors=raise_errors)
 
             elif obj.scan_type == "depthmap":
                 depthmap.scan_range( scanner_object = obj,
                   max_distance=obj.depthmap_max_dist,
                   frame_start = frame, frame_end=frame+1, filename=filename,
-                  world_transformation=world_transformation,
-                  add_blender_mesh=obj.add_scan_mesh)
+                  world_transformation=world_transformation, raise_errors=raise_errors,
+                  add_blender_mesh=obj.add_scan_mesh, depthmap_format=obj.depthmap_format)
 
             elif obj.scan_type == "tof":
                 tof.scan_range( scanner_object = obj, max_distance=obj.tof_max_dist, 
@@ -365,17 +438,19 @@ def dispatch_scan_range(obj,filename,frame=0,last_frame=True, time_per_frame=1.0
                   backfolding=obj.tof_backfolding, tof_res_x = obj.tof_xres,
                   tof_res_y = obj.tof_yres, 
                   lens_angle_w = obj.tof_lens_angle_w, lens_angle_h = obj.tof_lens_angle_h, flength = obj.tof_focal_length, 
-                  world_transformation=world_transformation,
+                  world_transformation=world_transformation, raise_errors=raise_errors,
                   add_blender_mesh=obj.add_scan_mesh, add_noisy_blender_mesh=obj.add_noise_scan_mesh)
 
             elif obj.scan_type == "kinect":
                 kinect.scan_range( scanner_object = obj,
                   frame_start = frame, frame_end=frame+1, filename=filename, 
                   last_frame=last_frame,frame_time = time_per_frame,
-                  world_transformation=world_transformation)
+                  world_transformation=world_transformation, raise_errors=raise_errors)
 
             else:
                 print ("Scanner not supported ... yet")
+                if raise_errors:
+                    raise ValueError("Scanner type %s does not support range scans"%obj.scan_type)
 
 
 
@@ -442,7 +517,26 @@ class OBJECT_PT_sensor(bpy.types.Panel):
             col = row.column()
             col.prop(obj, "show_in_frame")
             row = layout.row()
-            row.prop(obj, "store_data_in_mesh")
+            col = row.column()
+            col.prop(obj, "store_data_in_mesh")
+            col = row.column()
+            col.prop(obj, "store_data_side_buffer")
+            row = layout.row()
+            row.prop(obj, "scan_display_mode")
+            if obj.scan_display_mode == "sequence":
+                row = layout.row()
+                row.prop(obj, "scan_sequence_cache")
+            if obj.scan_type in ["velodyne", "ibeo", "generic"]:
+                row = layout.row()
+                row.prop(obj, "adaptive_scan_step")
+                if obj.adaptive_scan_step > 1:
+                    row = layout.row()
+                    col = row.column()
+                    col.prop(obj, "adaptive_scan_bin_size")
+                    col = row.column()
+                    col.prop(obj, "adaptive_scan_margin")
+            row = layout.row()
+            row.prop(obj, "pcd_format")
             row = layout.row()
             col = row.column()
             col.prop(obj, "inv_scan_x")
@@ -459,6 +553,8 @@ class OBJECT_PT_sensor(bpy.types.Panel):
             row = layout.row()
             row.operator("blensor.scan", "Single scan")        
             row = layout.row()
+            row.operator("blensor.scan_rig", "Scan rig")
+            row = layout.row()
             row.operator("blensor.scanrange", "Scan range")        
             row = layout.row()
             col = row.column()
@@ -515,6 +611,43 @@ class OBJECT_OT_scan(bpy.types.Operator):
                 #    self.report({'WARNING'}, "Scan not successful: "+str(type(e)))
         return{'FINISHED'}
 
+class OBJECT_OT_scan_rig(bpy.types.Operator):
+    bl_label = "Run rig scan" #Button label
+    bl_idname = "blensor.scan_rig" #Name used to refer to this operator
+    bl_description = "Scan the current frame with all selected sensors" # tooltip
+
+    filepath = bpy.props.StringProperty(subtype="FILE_PATH")
+    output_labels = bpy.props.BoolProperty(
+        name="Write labels",
+        description="Include labels for each point",
+        default=True)
+
+
+    def execute(self, context):
+        objs = rig_scanners(context)
+        try:
+          dispatch_rig_scan(objs, rig_filenames(self.filepath, objs), self.output_labels)
+        except UserInfoException as e:
+            print ("Scan not successful")
+            self.report({'WARNING'}, "Scan not successful: "+str(e))
+
+        return {'FINISHED'}
+ 
+    def invoke(self,context,event):
+        objs = rig_scanners(context)
+        if not objs:
+            self.report({'WARNING'}, "Please select at least one valid camera")
+            return {'FINISHED'}
+        if any(obj.save_scan for obj in objs):
+            context.window_manager.fileselect_add(self)
+            return {'RUNNING_MODAL'}
+        try:
+          dispatch_rig_scan(objs, [None]*len(objs))
+        except UserInfoException as e:
+           print ("Scan not successful")
+           self.report({'WARNING'}, "Scan not successful: "+str(e))
+        return{'FINISHED'}
+
 class OBJECT_OT_scanrange(bpy.types.Operator):
     bl_label = "Run range scan" #Button label
     bl_idname = "blensor.scanrange" #Name used to refer to this operator
@@ -557,6 +690,12 @@ class OBJECT_OT_scanrange_handler(bpy.types.Operator):
     filepath = bpy.props.StringProperty()
     frame = bpy.props.IntProperty()
     _timer = None   
+    _writer = None
+
+    def close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
 
     def modal(self, context, event):
         obj=context.object
@@ -566,6 +705,7 @@ class OBJECT_OT_scanrange_handler(bpy.types.Operator):
           if event.type in ('ESC'):
               if self._timer is not None:
                  context.window_manager.event_timer_remove(self._timer)
+              self.close_writer()
               print ("ABORT MISSION NOW !!")
               return {'CANCELLED'}
 
@@ -584,6 +724,7 @@ class OBJECT_OT_scanrange_handler(bpy.types.Operator):
                                     context.scene.render.fps_base))
 
               if self.properties.frame >= obj.scan_frame_end:
+                  self.close_writer()
                   return {'FINISHED'}
 
               range = float(obj.scan_frame_end-obj.scan_frame_start)
@@ -609,9 +750,12 @@ class OBJECT_OT_scanrange_handler(bpy.types.Operator):
         obj = context.object
         self.properties.frame = obj.scan_frame_start
 
-        """Truncate the file if it exists"""
-        fh = open(self.filepath, "w")
-        fh.close()
+        """Truncate the file if it exists, evd frames are written through
+           one writer that flushes in the background while the next frame
+           is scanned
+        """
+        self.close_writer()
+        self._writer = evd.EvdWriter(self.filepath, append=False, background=True)
 
         context.window_manager.modal_handler_add(self)
         """If the user moves the mouse the events are generated faster. Otherwise
@@ -629,8 +773,8 @@ class OBJECT_OT_scanrange_handler(bpy.types.Operator):
         self.properties.frame = obj.scan_frame_start
 
         """Truncate the file if it exists"""
-        fh = open(self.filepath, "w")
-        fh.close()
+        self.close_writer()
+        self._writer = evd.EvdWriter(self.filepath, append=False, background=True)
 
         context.window_manager.modal_handler_add(self)
         """If the user moves the mouse the events are generated faster. Otherwise
@@ -679,6 +823,8 @@ class OBJECT_OT_delete_scans(bpy.types.Operator):
     def execute(self, context):
         for o in bpy.context.scene.objects:
             if o.name.find('NoisyScan.') == 0 or o.name.find('Scan.') == 0:
+                if scan_sequence.CACHE_PROPERTY in o:
+                    scan_sequence.delete_cache(o)
                 bpy.context.scene.objects.unlink(o)
         
         return {'FINISHED'}
@@ -845,6 +991,7 @@ def register():
     bpy.utils.register_class(OBJECT_OT_randomize)
     bpy.utils.register_class(OBJECT_OT_delete_scans)
     bpy.utils.register_class(OBJECT_OT_scan)
+    bpy.utils.register_class(OBJECT_OT_scan_rig)
     bpy.utils.register_class(OBJECT_PT_sensor)
     bpy.utils.register_class(OBJECT_OT_exportmotion)
     bpy.utils.register_class(OBJECT_OT_exporthandler)
@@ -861,12 +1008,20 @@ def register():
 
     cType.save_scan = bpy.props.BoolProperty( name = "Save to File", default = False, description = "Should the scan be saved to file" )
     cType.local_coordinates = bpy.props.BoolProperty( name = "Sensor coordinates", default = True, description = "Should the points be saved sensor coordinates" )
+    cType.pcd_format = bpy.props.EnumProperty( items=[("ascii","ASCII","Human readable text"),("binary","Binary","Uncompressed binary data"),("binary_compressed","Binary compressed","LZF compressed binary data")], name = "PCD format", default = "ascii", description = "Data format of saved .pcd files, an extension like .binary.pcd overrides it" )
 
 
     cType.scan_frame_start = bpy.props.IntProperty( name = "Start frame", default = 1, min = 0, description = "First frame to be scanned" )
     cType.scan_frame_end = bpy.props.IntProperty( name = "End frame", default = 250, min = 0, description = "Last frame to be scanned" )
 
     cType.store_data_in_mesh = bpy.props.BoolProperty( name = "Store data in mesh", default = True, description = "Add scan data to the Blender mesh, for later export (high memory usage!)" )
+    cType.scan_display_mode = bpy.props.EnumProperty( items=[("objects","Objects","One mesh object per scanned frame"),("sequence","Sequence","One object per scanner that shows the scan of the current frame from a disk cache")], name = "Display scans", default = "objects", description = "How scan meshes are added to the scene" )
+    cType.scan_sequence_cache = bpy.props.StringProperty( name = "Sequence cache", default = "", subtype = "DIR_PATH", description = "Directory for the scans of sequence objects, a temporary directory if empty" )
+    cType.store_data_side_buffer = bpy.props.BoolProperty( name = "Side buffer", default = False, description = "Keep the scan data of the mesh in a compact buffer instead of vertex layers (not saved with the .blend file)" )
+
+    cType.adaptive_scan_step = bpy.props.IntProperty( name = "Adaptive step", default = 0, min = 0, max = 64, description = "Cast every n-th ray first and the other rays only where it found geometry, 0 or 1 casts all rays" )
+    cType.adaptive_scan_bin_size = bpy.props.FloatProperty( name = "Bin size", default = 2.0, min = 0.1, max = 45.0, description = "Angular size in degrees of the regions that are cast or skipped by the adaptive scan" )
+    cType.adaptive_scan_margin = bpy.props.IntProperty( name = "Margin", default = 1, min = 0, max = 16, description = "Number of neighbouring bins that are also cast around geometry, higher values are more conservative" )
 
     cType.inv_scan_x = bpy.props.BoolProperty( name = "Inv X", default = False, description = "Invert the X coordinate" )
     cType.inv_scan_y = bpy.props.BoolProperty( name = "Inv Y", default = False, description = "Invert the X coordinate" )
@@ -895,11 +1050,16 @@ def register():
     kinect.addProperties(cType)
     generic_lidar.addProperties(cType)
     depthmap.addProperties(cType)
+
+    scan_interface_pure.register_handlers()
+    scan_sequence.register_handlers()
+
 """Unregister the blender addon"""
 def unregister():
     bpy.utils.unregister_class(OBJECT_OT_exportmotion)
     bpy.utils.unregister_class(OBJECT_PT_sensor)
     bpy.utils.unregister_class(OBJECT_OT_scan)
+    bpy.utils.unregister_class(OBJECT_OT_scan_rig)
     bpy.utils.unregister_class(OBJECT_OT_delete_scans)
     bpy.utils.unregister_class(OBJECT_OT_randomize)
     bpy.utils.unregister_class(OBJECT_OT_scanrange)
@@ -907,5 +1067,7 @@ def unregister():
     bpy.utils.unregister_class(OBJECT_OT_scanrange_handler)
     bpy.utils.unregister_class(GenericFloatCollection)
     bpy.utils.unregister_class(NativeWarningMessageBox)
+    scan_interface_pure.unregister_handlers()
+    scan_sequence.unregister_handlers()
 
 
@@ -48,9 +48,14 @@ class AdvancedErrorModel(gaussian_error_model.GaussianErrorModel):
     try:
       em = ast.literal_eval(error_model_string)
       self.error_model = sorted (em,key = lambda x: x[0])
+      """Columns of the table for the batched lookup"""
+      table = np.array(self.error_model, dtype=np.float64).reshape(-1,3)
+      self.distances = table[:,0]
+      self.mus = table[:,1]
+      self.sigmas = table[:,2]
     except:
-      pass
-    if self.error_model is None:
+      self.error_model = None
+    if self.error_model is None or len(self.error_model) == 0:
       raise blensor.UserInfoException("Error in Advanced Error Model string")              
 
   def getErrorParams(self, dist):
@@ -86,6 +91,31 @@ class AdvancedErrorModel(gaussian_error_model.GaussianErrorModel):
     if sigma < 0.0000001:
       return mu
     return(np.random.normal(mu,sigma))
+
+  """Same as getErrorParams for an array of distances. Like the scalar
+     version it extrapolates below the first distance of the table and
+     uses the last entry beyond the last distance
+  """
+  def getErrorParamsArray(self, distances):
+    distances = np.asarray(distances, dtype=np.float64)
+    last = len(self.distances)-1
+    index = np.clip(np.searchsorted(self.distances, distances, side="right")-1, 0, last)
+    upper = np.minimum(index+1, last)
+
+    d_lower = self.distances[index]
+    drange = self.distances[upper]-d_lower
+    interpolate = drange > 0.000001
+    dl = np.zeros(distances.shape)
+    dl[interpolate] = (distances-d_lower)[interpolate]/drange[interpolate]
+
+    mu = (1.0-dl)*self.mus[index] + dl*self.mus[upper]
+    sigma = (1.0-dl)*self.sigmas[index] + dl*self.sigmas[upper]
+    return mu, sigma
+
+  def drawErrorsFromModel(self, distances):
+    mu, sigma = self.getErrorParamsArray(distances)
+    sigma[sigma < 0.0000001] = 0.0
+    return mu + sigma*np.random.standard_normal(mu.shape)
     
     
 
@@ -97,7 +127,7 @@ if __name__=="__main__":
     nr_samples = 100
     
     distances = np.arange(0,30,0.1)
-    error_parameters = np.array([model.getErrorParams(x) for x in distances])
+    error_parameters = np.array(model.getErrorParamsArray(distances)).T
     
     mus = np.tile(error_parameters[:,0],(nr_samples,1))
     sigmas = np.tile(error_parameters[:,1],(nr_samples,1))
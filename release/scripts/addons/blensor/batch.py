@@ -0,0 +1,296 @@
+"""Unattended batch scanning driven by a job spec
+
+   blender -b scene.blend --python-expr "import blensor.batch; blensor.batch.main()" -- job.json
+
+   The job spec is a JSON file, or a YAML file if PyYAML is installed
+   (.yaml/.yml extension). Example:
+
+   {
+     "manifest": "/tmp/scans/manifest.json",
+     "scans": [
+       {"scanner": "Velodyne", "filename": "/tmp/scans/velodyne.evd",
+        "frame_start": 1, "frame_end": 100, "seed": 42},
+       {"scanner": "Kinect", "filename": "/tmp/scans/kinect.pcd",
+        "frame": 10, "pcd_format": "binary",
+        "properties": {"kinect_noise_sigma": 0.01}},
+       {"rig": ["Velodyne", "Kinect"], "filename": "/tmp/scans/rig.evd",
+        "frame_start": 1, "frame_end": 10}
+     ]
+   }
+
+   Every scan needs a scanner (object name) and a filename. A scan with
+   frame_start/frame_end is a range scan like the scan range operator
+   (both frames inclusive), otherwise a single scan of frame (default:
+   the current frame) is made. Optional entries:
+     seed           random seed, frame n is scanned with seed+n so every
+                    frame is reproducible on its own
+     pcd_format     ascii, binary or binary_compressed
+     output_labels  write the object ids and colors (default true)
+     properties     scanner object properties set before scanning
+     workers        range scans with more than one worker are split
+                    among background Blender processes (see parallel)
+
+   A scan with rig (a list of object names) instead of scanner scans every
+   frame with all sensors of the rig, sharing the scene setup among them
+   (see dispatch_rig_scan). Each sensor writes to filename with its name
+   appended (rig_Velodyne.evd, rig_Kinect.evd) or to the files listed in
+   filenames (one per sensor) instead. Streams of range scans get one file per frame
+   (rig_Velodyne00001.evd, ...). properties and pcd_format are set on all
+   sensors of the rig, workers are not supported.
+
+   The manifest lists every scan with its frames, per frame timings and
+   errors. main() exits with 1 if any scan failed.
+"""
+
+import os
+import sys
+import json
+import random
+import time
+import traceback
+
+import bpy
+import numpy
+
+import blensor
+from blensor import evd
+from blensor import parallel
+
+
+class JobSpecException(Exception):
+  pass
+
+
+def load_job_spec(path):
+    with open(path) as fh:
+        if path.endswith(".yaml") or path.endswith(".yml"):
+            try:
+                import yaml
+            except ImportError:
+                raise JobSpecException("YAML job specs need PyYAML, use JSON instead")
+            spec = yaml.safe_load(fh)
+        else:
+            spec = json.load(fh)
+
+    if not isinstance(spec, dict) or not isinstance(spec.get("scans"), list):
+        raise JobSpecException("Job spec needs a list of scans")
+    for scan in spec["scans"]:
+        for key in ["rig" if "rig" in scan else "scanner", "filename"]:
+            if key not in scan and not (key == "filename" and "filenames" in scan):
+                raise JobSpecException("Scan entry without %s: %s"%(key, str(scan)))
+        if "rig" in scan:
+            if not isinstance(scan["rig"], list) or not scan["rig"]:
+                raise JobSpecException("Rig needs a list of scanners: %s"%str(scan))
+            if "filenames" in scan and len(scan["filenames"]) != len(scan["rig"]):
+                raise JobSpecException("Rig needs one filename per scanner: %s"%str(scan))
+    return spec
+
+
+def seed_random(scan, frame):
+    if scan.get("seed") is not None:
+        seed = int(scan["seed"]) + frame
+        random.seed(seed)
+        numpy.random.seed(seed % (1<<32))
+
+
+def find_scanner(name):
+    if name not in bpy.data.objects:
+        raise JobSpecException("Scanner %s not found"%name)
+    return bpy.data.objects[name]
+
+
+def setup_scanner(scene, scan):
+    obj = find_scanner(scan["scanner"])
+    scene.camera = obj
+    scene.objects.active = obj
+    apply_properties(obj, scan)
+    return obj
+
+
+def apply_properties(obj, scan):
+    for name, value in scan.get("properties", {}).items():
+        if not hasattr(obj, name):
+            raise JobSpecException("Scanner has no property %s"%name)
+        setattr(obj, name, value)
+    if "pcd_format" in scan:
+        obj.pcd_format = scan["pcd_format"]
+
+
+"""Scan a single frame, returns the frame record of the manifest"""
+def run_frame(scene, obj, scan, frame, last_frame=None):
+    record = {"frame": frame}
+    start_time = time.time()
+    seed_random(scan, frame)
+    scene.frame_set(frame)
+
+    output_labels = scan.get("output_labels", True)
+    if last_frame is None:
+        blensor.dispatch_scan(obj, scan["filename"], output_labels=output_labels)
+    else:
+        """The scanners only print errors of range scans unless asked to raise them"""
+        blensor.dispatch_scan_range(obj, scan["filename"], frame=frame,
+                                    last_frame=last_frame,
+                                    time_per_frame=1.0/(scene.render.fps / scene.render.fps_base),
+                                    output_labels=output_labels, raise_errors=True)
+
+    record["time"] = time.time()-start_time
+    print ("Scanned %s frame %d in %.3f s"%(obj.name, frame, record["time"]))
+    return record
+
+
+"""Output files of the sensors of a rig for one frame. Single scans of
+   a stream would overwrite each other, so range scans of streams get the
+   frame number in the file name like the per frame formats
+"""
+def rig_frame_filenames(scan, objs, frame, is_range):
+    if "filenames" in scan:
+        filenames = list(scan["filenames"])
+    else:
+        base, extension = os.path.splitext(scan["filename"])
+        filenames = ["%s_%s%s"%(base, obj.name, extension) for obj in objs]
+    if is_range:
+        for idx, obj in enumerate(objs):
+            if not parallel.is_per_frame_output(filenames[idx], obj.scan_type):
+                base, extension = os.path.splitext(filenames[idx])
+                filenames[idx] = "%s%05d%s"%(base, frame, extension)
+    return filenames
+
+
+"""Scan a single frame with all sensors of a rig"""
+def run_rig_frame(scene, objs, scan, frame, is_range):
+    record = {"frame": frame}
+    start_time = time.time()
+    seed_random(scan, frame)
+    scene.frame_set(frame)
+    evd.frame_counter = frame
+
+    blensor.dispatch_rig_scan(objs, rig_frame_filenames(scan, objs, frame, is_range),
+                              output_labels=scan.get("output_labels", True))
+
+    record["time"] = time.time()-start_time
+    print ("Scanned rig %s frame %d in %.3f s"%(", ".join(obj.name for obj in objs), frame, record["time"]))
+    return record
+
+
+def run_rig(scene, scan):
+    record = {"rig": scan["rig"], "filename": scan.get("filename"), "frames": []}
+    start_time = time.time()
+    frame_current = scene.frame_current
+    camera = scene.camera
+    try:
+        objs = [find_scanner(name) for name in scan["rig"]]
+        for obj in objs:
+            apply_properties(obj, scan)
+        record["scan_types"] = [obj.scan_type for obj in objs]
+
+        if "frame_start" in scan:
+            frame_start = int(scan["frame_start"])
+            frame_end = int(scan.get("frame_end", frame_start))
+            for frame in range(frame_start, frame_end+1):
+                record["frames"].append(run_rig_frame(scene, objs, scan, frame, True))
+        else:
+            frame = int(scan.get("frame", frame_current))
+            record["frames"].append(run_rig_frame(scene, objs, scan, frame, False))
+    except Exception as e:
+        traceback.print_exc()
+        record["error"] = str(e)
+
+    scene.camera = camera
+    scene.frame_set(frame_current)
+    record["time"] = time.time()-start_time
+    return record
+
+
+def run_scan(scene, scan):
+    if "rig" in scan:
+        return run_rig(scene, scan)
+    record = {"scanner": scan["scanner"], "filename": scan["filename"], "frames": []}
+    start_time = time.time()
+    frame_current = scene.frame_current
+    try:
+        obj = setup_scanner(scene, scan)
+        record["scan_type"] = obj.scan_type
+        record["per_frame_files"] = parallel.is_per_frame_output(scan["filename"], obj.scan_type)
+
+        if "frame_start" in scan:
+            frame_start = int(scan["frame_start"])
+            frame_end = int(scan.get("frame_end", frame_start))
+            workers = int(scan.get("workers", 1))
+            if workers > 1:
+                """The workers apply the properties and seeds themselves"""
+                properties = dict(scan.get("properties", {}))
+                if "pcd_format" in scan:
+                    properties["pcd_format"] = scan["pcd_format"]
+                missing = parallel.scan_range_parallel(bpy.data.filepath, obj.name,
+                             scan["filename"], frame_start, frame_end, workers=workers,
+                             output_labels=scan.get("output_labels", True),
+                             properties=properties, seed=scan.get("seed"))
+                workdir = parallel.default_workdir(scan["filename"])
+                record["frames"] = [parallel.frame_record(workdir, frame) for frame in range(frame_start, frame_end+1)
+                                    if frame not in missing]
+                if missing:
+                    record["error"] = "Frames not completed: %s"%str(missing)
+            else:
+                if record["per_frame_files"]:
+                    for frame in range(frame_start, frame_end+1):
+                        record["frames"].append(run_frame(scene, obj, scan, frame,
+                                                          last_frame=(frame == frame_end)))
+                else:
+                    """One writer for the whole stream, frames are written
+                       while the next frame is scanned
+                    """
+                    with evd.EvdWriter(scan["filename"], append=False, background=True):
+                        for frame in range(frame_start, frame_end+1):
+                            record["frames"].append(run_frame(scene, obj, scan, frame,
+                                                              last_frame=(frame == frame_end)))
+        else:
+            frame = int(scan.get("frame", frame_current))
+            record["frames"].append(run_frame(scene, obj, scan, frame))
+    except Exception as e:
+        traceback.print_exc()
+        record["error"] = str(e)
+
+    scene.frame_set(frame_current)
+    record["time"] = time.time()-start_time
+    return record
+
+
+"""Run all scans of a job spec and write the manifest"""
+def run_job(spec, manifest_filename=None):
+    scene = bpy.context.scene
+    manifest = {"blend_file": bpy.data.filepath, "blensor_version": blensor.__version__,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S"), "scans": []}
+    start_time = time.time()
+
+    for scan in spec["scans"]:
+        manifest["scans"].append(run_scan(scene, scan))
+
+    manifest["time"] = time.time()-start_time
+    manifest["failed"] = len([s for s in manifest["scans"] if "error" in s])
+
+    if manifest_filename is None:
+        manifest_filename = spec.get("manifest")
+    if manifest_filename:
+        with open(manifest_filename, "w") as fh:
+            json.dump(manifest, fh, indent=2)
+        print ("Manifest written to %s"%manifest_filename)
+    return manifest
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else []
+    if len(argv) < 1:
+        print ("Usage: blender -b scene.blend --python-expr \"import blensor.batch; blensor.batch.main()\" -- job.json [manifest.json]")
+        sys.exit(2)
+
+    try:
+        spec = load_job_spec(argv[0])
+    except (IOError, ValueError, JobSpecException) as e:
+        print ("Invalid job spec: %s"%str(e))
+        sys.exit(2)
+
+    manifest = run_job(spec, argv[1] if len(argv) > 1 else None)
+    if manifest["failed"] > 0:
+        print ("%d of %d scans failed"%(manifest["failed"], len(manifest["scans"])))
+        sys.exit(1)
@@ -19,6 +19,8 @@ from mathutils import Vector, Euler, Matrix
 
 from blensor import evd
 from blensor import mesh_utils
+from blensor import ray_pattern
+from blensor import scan_processing
 
 import blensor
 import numpy
@@ -29,7 +31,7 @@ BLENSOR_VELODYNE_HDL32E = "hdl32e"
 
 parameters = {"angle_resolution":0.1728, "rotation_speed":10,"max_dist":120,"noise_mu":0.0,"noise_sigma":0.01,
               "start_angle":0,"end_angle":360, "distance_bias_noise_mu": 0, "distance_bias_noise_sigma": 0.078,
-              "reflectivity_distance":50,"reflectivity_limit":0.1,"reflectivity_slope":0.01,
+              "reflectivity_distance":50,"reflectivity_limit":0.1,"reflectivity_slope":0.01, "time_slices": 1,
               "noise_types": [("gaussian", "Gaussian", "Gaussian distribution (mu/simga)"),("laplace","Laplace","Laplace distribution (sigma=b)")],
               "models": [(BLENSOR_VELODYNE_HDL64E2, "HDL-64E2", "HDL-64E2"), (BLENSOR_VELODYNE_HDL32E, "HDL-32E", "HDL-32E")]}
 
@@ -51,6 +53,7 @@ def addProperties(cType):
  
     cType.velodyne_noise_type = bpy.props.EnumProperty( items= parameters["noise_types"], name = "Noise distribution", description = "Which noise model to use for the distance bias" )
     cType.velodyne_model = bpy.props.EnumProperty( items= parameters["models"], name = "Model", description = "Velodyne Model" )
+    cType.velodyne_time_slices = bpy.props.IntProperty( name = "Time slices", default = parameters["time_slices"], min = 1, max = 256, description = "Number of sub-frame scene samples per sweep (rolling shutter), 1 scans a frozen scene" )
  
 
 
@@ -144,9 +147,11 @@ def randomize_distance_bias(scanner_object, noise_mu = 0.0, noise_sigma = 0.04):
 
 """
 @param world_transformation The transformation for the resulting pointcloud
+@param time_slices Number of times the scene is sampled during the sweep
+                   (see scan_interface.scan_rays_sliced)
 
 """
-def scan_advanced(scanner_object, rotation_speed = 10.0, simulation_fps=24, angle_resolution = 0.1728, max_distance = 120, evd_file=None,noise_mu=0.0, noise_sigma=0.03, start_angle = 0.0, end_angle = 360.0, evd_last_scan=True, add_blender_mesh = False, add_noisy_blender_mesh = False, frame_time = (1.0 / 24.0), simulation_time = 0.0, world_transformation=Matrix()):
+def scan_advanced(scanner_object, rotation_speed = 10.0, simulation_fps=24, angle_resolution = 0.1728, max_distance = 120, evd_file=None,noise_mu=0.0, noise_sigma=0.03, start_angle = 0.0, end_angle = 360.0, evd_last_scan=True, add_blender_mesh = False, add_noisy_blender_mesh = False, frame_time = (1.0 / 24.0), simulation_time = 0.0, world_transformation=Matrix(), time_slices=1):
     
     scanner_angles = laser_angles
     scanner_noise = laser_noise
@@ -164,51 +169,24 @@ def scan_advanced(scanner_object, rotation_speed = 10.0, simulation_fps=24, angl
 
     evd_storage = evd.evd_file(evd_file)
 
-    xaxis = Vector([1,0,0])
-    yaxis = Vector([0,1,0])
-    zaxis = Vector([0,0,1])
-
-    rays = []
-    ray_info = []
-
     steps_per_rotation = 360.0/angle_resolution
     time_per_step = (1.0 / rotation_speed) / steps_per_rotation
     angles = end_angle-start_angle
   
     lines = (end_angle-start_angle)/angle_resolution
-    ray = Vector([0.0,0.0,0.0])
-    for line in range(int(lines)):
-        for laser_idx in range(len(scanner_angles)):
-            ray.xyz = [0,0,max_distance]
-            rot_angle = 1e-6 + start_angle+float(line)*angle_resolution + 180.0
-            timestamp = ( (rot_angle-180.0)/angle_resolution) * time_per_step 
-            rot_angle = rot_angle%360.0
-            ray_info.append([deg2rad(rot_angle), deg2rad(scanner_angles[laser_idx]), timestamp])
-            
-            rotator = Euler( [deg2rad(-scanner_angles[laser_idx]), deg2rad(rot_angle), 0.0] )
-            ray.rotate( rotator )
-            rays.extend([ray[0],ray[1],ray[2]])
+    rays, yaws, pitches, timestamps = ray_pattern.rotating(scanner_angles, 
+        start_angle, end_angle, angle_resolution, time_per_step, max_distance)
 
-    returns = blensor.scan_interface.scan_rays(rays, max_distance, inv_scan_x = inv_scan_x, inv_scan_y = inv_scan_y, inv_scan_z = inv_scan_z)
-
-#    for idx in range((len(rays)//3)):
-    
-    reusable_4dvector = Vector([0.0,0.0,0.0,0.0])
-    
-    for i in range(len(returns)):
-        idx = returns[i][-1]
-        reusable_4dvector.xyzw = (returns[i][1],returns[i][2],returns[i][3],1.0)
-        vt = (world_transformation * reusable_4dvector).xyz
-        v = [returns[i][1],returns[i][2],returns[i][3]]
+    sweep = blensor.scan_interface.scan_rays_sliced(scanner_object, rays, timestamps, time_slices, 
+        max_distance, world_transformation, inv_scan_x = inv_scan_x, inv_scan_y = inv_scan_y, inv_scan_z = inv_scan_z,
+        **blensor.scan_interface.adaptive_scan_args(scanner_object))
 
-        distance_noise =  laser_noise[idx%len(scanner_angles)] + random.gauss(noise_mu, noise_sigma) 
-        vector_length = math.sqrt(v[0]**2+v[1]**2+v[2]**2)
-        norm_vector = [v[0]/vector_length, v[1]/vector_length, v[2]/vector_length]
-        vector_length_noise = vector_length+distance_noise
-        reusable_4dvector.xyzw=[norm_vector[0]*vector_length_noise, norm_vector[1]*vector_length_noise, norm_vector[2]*vector_length_noise,1.0]
-        v_noise = (world_transformation * reusable_4dvector).xyz
+    for returns, slice_transformation in sweep:
+        distance_noise = (numpy.asarray(laser_noise)[returns["idx"]%len(scanner_angles)] + 
+                          numpy.random.normal(noise_mu, noise_sigma, len(returns)))
 
-        evd_storage.addEntry(timestamp = ray_info[idx][2], yaw =(ray_info[idx][0]+math.pi)%(2*math.pi), pitch=ray_info[idx][1], distance=vector_length, distance_noise=vector_length_noise, x=vt[0], y=vt[1], z=vt[2], x_noise=v_noise[0], y_noise=v_noise[1], z_noise=v_noise[2], object_id=returns[i][4], color=returns[i][5])
+        evd_storage.addEntries(scan_processing.process_returns(returns, timestamps, yaws, pitches, 
+                                                               distance_noise, slice_transformation))
 
 
     current_angle = start_angle+float(float(int(lines))*angle_resolution)
@@ -219,16 +197,15 @@ def scan_advanced(scanner_object, rotation_speed = 10.0, simulation_fps=24, angl
         evd_storage.appendEvdFile()
 
     if not evd_storage.isEmpty():
-        scan_data = numpy.array(evd_storage.buffer)
         additional_data = None
         if scanner_object.store_data_in_mesh:
             additional_data = evd_storage.buffer
 
         if add_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,5:8], "Scan", world_transformation, buffer=additional_data)
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(), "Scan", world_transformation, buffer=additional_data, scanner=scanner_object)
 
         if add_noisy_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,8:11], "NoisyScan", world_transformation, buffer=additional_data) 
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(noisy=True), "NoisyScan", world_transformation, buffer=additional_data, scanner=scanner_object) 
             
         bpy.context.scene.update()
 
@@ -244,7 +221,7 @@ def scan_advanced(scanner_object, rotation_speed = 10.0, simulation_fps=24, angl
 
 # This Function creates scans over a range of frames
 
-def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/landscape.evd", frame_time = (1.0/24.0), rotation_speed = 10.0, add_blender_mesh=False, add_noisy_blender_mesh=False, angle_resolution = 0.1728, max_distance = 120.0, noise_mu = 0.0, noise_sigma= 0.02, last_frame = True, world_transformation=Matrix()):
+def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/landscape.evd", frame_time = (1.0/24.0), rotation_speed = 10.0, add_blender_mesh=False, add_noisy_blender_mesh=False, angle_resolution = 0.1728, max_distance = 120.0, noise_mu = 0.0, noise_sigma= 0.02, last_frame = True, world_transformation=Matrix(), time_slices=1, raise_errors=False):
     start_time = time.time()
 
     angle_per_second = 360.0 * rotation_speed
@@ -262,19 +239,19 @@ def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/landscape.
                     add_noisy_blender_mesh=add_noisy_blender_mesh, 
                     frame_time=frame_time, simulation_time = float(i)*frame_time,
                     max_distance=max_distance, noise_mu = noise_mu, 
-                    noise_sigma=noise_sigma, world_transformation=world_transformation)
+                    noise_sigma=noise_sigma, world_transformation=world_transformation,
+                    time_slices=time_slices)
 
                 if not ok:
                     break
     except:
         print ("Scan aborted")
+        if raise_errors:
+            raise
 
 
     if last_frame:
-        #TODO: move this into the evd module
-        evd_file = open(filename,"a")
-        evd_file.buffer.write(struct.pack("i",-1))
-        evd_file.close()
+        evd.finish_evd_stream(filename)
 
 
     end_time = time.time()
@@ -8,8 +8,10 @@ import ctypes
 import time
 import random
 import bpy
+import numpy
 import blensor.globals
 from blensor import mesh_utils
+from blensor import scan_processing
 from blensor.not_implemented_handler import NotImplemented
 
 try:
@@ -20,11 +22,12 @@ except:
 
 from mathutils import Vector, Euler, Matrix
 
-parameters = {"max_dist":200}
+parameters = {"max_dist":200, "format": "dmap"}
 
 def addProperties(cType):
     global parameters
     cType.depthmap_max_dist = bpy.props.FloatProperty( name = "Scan distance", default = parameters["max_dist"], min = 0, max = 1000, description = "How far the laser can see" )
+    cType.depthmap_format = bpy.props.EnumProperty( items = DEPTHMAP_FORMATS, name = "Format", default = parameters["format"], description = "File format of the depth maps of a range scan" )
 
 def deg2rad(deg):
     return deg*math.pi/180.0
@@ -39,17 +42,68 @@ def tuples_to_list(tuples):
     return l
 
 
+"""Output formats of the depth map, the file extension and a description
+   dmap      width, height (int) and one double per pixel (the original format)
+   npy       height x width float32 array, can be memory mapped
+   half.npz  height x width float16 array, compressed
+"""
+DEPTHMAP_FORMATS = [("dmap", "Double", "Width, height and one double per pixel (.dmap)"),
+                    ("npy", "Float", "Float32 numpy array, can be memory mapped (.npy)"),
+                    ("half.npz", "Half float compressed", "Compressed float16 numpy array (.half.npz)")]
+
+
+def write_depthmap(filename, depthmap, width, height, depthmap_format="dmap"):
+    if depthmap_format == "npy":
+        numpy.save(filename, depthmap.astype(numpy.float32).reshape(height, width))
+    elif depthmap_format == "half.npz":
+        """numpy.savez appends .npz if the name does not end with it"""
+        numpy.savez_compressed(filename, depthmap=depthmap.astype(numpy.float16).reshape(height, width))
+    else:
+        fh = open(filename, "wb")
+        fh.write(struct.pack("ii",width,height) + depthmap.astype(numpy.float64).tobytes())
+        fh.close()
+
+
+"""Read a depth map written by scan_advanced as a height x width array.
+   .dmap and .npy files can be memory mapped.
+"""
+def read_depthmap(filename, mmap=False):
+    if filename.endswith(".npz"):
+        with numpy.load(filename) as archive:
+            return archive["depthmap"]
+    elif filename.endswith(".npy"):
+        return numpy.load(filename, mmap_mode="r" if mmap else None)
+    else:
+        with open(filename, "rb") as fh:
+            width, height = struct.unpack("ii", fh.read(8))
+        if mmap:
+            return numpy.memmap(filename, dtype=numpy.float64, mode="r", offset=8, shape=(height, width))
+        return numpy.fromfile(filename, dtype=numpy.float64, offset=8).reshape(height, width)
+
+
+"""The zbuffer of the render result as a float32 array"""
+def render_zbuffer(width, height):
+    image = bpy.data.images["Render Result"]
+    zbuffer = numpy.zeros(width*height, dtype=numpy.float32)
+    try:
+        blensorintern.copy_zbuf_buffer(image, zbuffer)
+    except AttributeError:
+        """Older native code without buffer support"""
+        zbuffer[:] = blensorintern.copy_zbuf(image)
+    return zbuffer
+
+
 def scan_advanced(scanner_object, max_distance = 120, filename=None, add_blender_mesh = False,
-    world_transformation=Matrix()):
+    world_transformation=Matrix(), depthmap_format="dmap"):
     start_time = time.time()
 
     inv_scan_x = scanner_object.inv_scan_x
     inv_scan_y = scanner_object.inv_scan_y
     inv_scan_z = scanner_object.inv_scan_z    
 
-    x_multiplier = -1.0 if inv_scan_x else 1.0
-    y_multiplier = -1.0 if inv_scan_y else 1.0
-    z_multiplier = -1.0 if inv_scan_z else 1.0
+    multiplier = numpy.array([-1.0 if inv_scan_x else 1.0,
+                              -1.0 if inv_scan_y else 1.0,
+                              -1.0 if inv_scan_z else 1.0])
 
     add_noisy_blender_mesh = scanner_object.add_noise_scan_mesh
 
@@ -73,49 +127,31 @@ def scan_advanced(scanner_object, max_distance = 120, filename=None, add_blender
 
     bpy.ops.render.render()
 
-    zbuffer = blensorintern.copy_zbuf(bpy.data.images["Render Result"])
-    depthmap = [0.0]*len(zbuffer)
-
-    verts = []
+    zbuffer = render_zbuffer(width, height).astype(numpy.float64)
 
-    reusable_vector = Vector([0.0,0.0,0.0,0.0])
-    for idx in range( len(zbuffer) ):
-            x = float(idx % width)
-            y = float(idx // width)
-            dx = x - cx
-            dy = y - cy
+    idx = numpy.arange(width*height)
+    dx = (idx % width) - cx
+    dy = (idx // width) - cy
 
-            ddist = math.sqrt(dx**2 + dy**2)
-            
+    world_ddist = ( numpy.sqrt(dx**2 + dy**2) * zbuffer ) / focal_length
+    depthmap = numpy.sqrt(world_ddist ** 2 + zbuffer ** 2)
 
-            world_ddist = ( ddist * zbuffer[idx] ) / focal_length
-
-
-            object_distance =  math.sqrt(world_ddist ** 2 + zbuffer[idx] ** 2)
-            
-            depthmap[idx] = object_distance
-            if add_blender_mesh or add_noisy_blender_mesh:
-                if object_distance < max_distance:
-                    Z = -zbuffer[idx] 
-                    X = -( Z * dx ) / focal_length
-                    Y = -( Z * dy ) / focal_length
-                    reusable_vector.xyzw = [X,Y,Z,1.0]
-                    vt = (world_transformation * reusable_vector).xyz
-
-                    verts.append((x_multiplier * vt[0], y_multiplier*vt[1], z_multiplier*vt[2]))                
+    verts = numpy.zeros((0,3))
+    if add_blender_mesh or add_noisy_blender_mesh:
+        valid = depthmap < max_distance
+        Z = -zbuffer[valid]
+        X = -( Z * dx[valid] ) / focal_length
+        Y = -( Z * dy[valid] ) / focal_length
+        verts = multiplier * scan_processing.transform_points(world_transformation, numpy.column_stack((X,Y,Z)))
 
     if filename:
-        fh = open(filename, "w")
-        fh.buffer.write(struct.pack("ii",width,height))
-        for idx in range( width*height ):
-            fh.buffer.write(struct.pack("d", depthmap[idx]))
-        fh.close()
+        write_depthmap(filename, depthmap, width, height, depthmap_format)
 
     if add_blender_mesh:
-        mesh_utils.add_mesh_from_points_tf(verts, "Scan", world_transformation)
+        mesh_utils.add_mesh_from_points_tf(verts, "Scan", world_transformation, scanner=scanner_object)
 
     if add_noisy_blender_mesh:
-        mesh_utils.add_mesh_from_points_tf(verts, "NoisyScan", world_transformation)
+        mesh_utils.add_mesh_from_points_tf(verts, "NoisyScan", world_transformation, scanner=scanner_object)
         
     bpy.context.scene.update()
 
@@ -132,7 +168,7 @@ def scan_advanced(scanner_object, max_distance = 120, filename=None, add_blender
 
 # This Function creates scans over a range of frames
 
-def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/depthmap", frame_time = (1.0/24.0), fps = 24, add_blender_mesh=False, max_distance = 120.0, last_frame = True,world_transformation=Matrix()):
+def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/depthmap", frame_time = (1.0/24.0), fps = 24, add_blender_mesh=False, max_distance = 120.0, last_frame = True,world_transformation=Matrix(), depthmap_format="dmap", raise_errors=False):
 
     start_time = time.time()
 
@@ -143,12 +179,14 @@ def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/depthmap",
 
             bpy.context.scene.frame_current = i
 
-            ok,start_radians,scan_time = scan_advanced(scanner_object, filename = filename+"%04d.dmap"%i , add_blender_mesh=add_blender_mesh,  max_distance=max_distance,world_transformation=world_transformation)
+            ok,start_radians,scan_time = scan_advanced(scanner_object, filename = filename+"%04d.%s"%(i, depthmap_format), add_blender_mesh=add_blender_mesh,  max_distance=max_distance,world_transformation=world_transformation, depthmap_format=depthmap_format)
 
             if not ok:
                 break
     except:
         print ("Scan aborted")
+        if raise_errors:
+            raise
 
     end_time = time.time()
     print ("Total scan time: %.2f"%(end_time-start_time))
@@ -1,7 +1,14 @@
+import os
 import sys
 import traceback
 import struct
+import zlib
 import math
+import queue
+import threading
+import numpy
+
+from blensor import pcd
 
 PCL_HEADER = """# .PCD v.7 - Exported by BlenSor
 VERSION .7
@@ -13,7 +20,7 @@ WIDTH %d
 HEIGHT %d
 VIEWPOINT 0 0 0 1 0 0 0
 POINTS %d
-DATA ascii
+DATA %s
 """
 
 PCL_HEADER_WITH_LABELS = """# .PCD v0.7 - Point Cloud Data file format
@@ -26,14 +33,15 @@ WIDTH %d
 HEIGHT %d
 VIEWPOINT 0 0 0 1 0 0 0
 POINTS %d
-DATA ascii
+DATA %s
 """
 
 
 
 PGM_VALUE_RANGE = 65535
 
-PGM_HEADER ="""P2
+"""Binary PGM, 16 bit values are stored big endian"""
+PGM_HEADER ="""P5
 #BlenSor output
 %d %d
 %d
@@ -41,11 +49,60 @@ PGM_HEADER ="""P2
 
 INVALID_POINT = [0.0, 0.0, 0.0, float('NaN'), float('NaN'),
                  float('NaN'),float('NaN'),float('NaN'),float('NaN'),
-                 float('NaN'),float('NaN'),-1,(0,0,0),-1]
+                 float('NaN'),float('NaN'),-1,0,0,0,-1]
+
+"""DATA formats of the PCD writer. The format is taken from the file
+   extension (scan.binary.pcd, scan.binary_compressed.pcd) or from the
+   pcd_format global which is set from the scanner settings
+"""
+PCD_FORMATS = ["ascii", "binary", "binary_compressed"]
+
+
+"""One evd entry. evd_file.buffer is an array of this type, the field
+   order is the column order of the former list based buffer
+"""
+ENTRY_DTYPE = numpy.dtype([("timestamp", numpy.float64),
+                           ("yaw", numpy.float64),
+                           ("pitch", numpy.float64),
+                           ("distance", numpy.float64),
+                           ("distance_noise", numpy.float64),
+                           ("x", numpy.float64),
+                           ("y", numpy.float64),
+                           ("z", numpy.float64),
+                           ("x_noise", numpy.float64),
+                           ("y_noise", numpy.float64),
+                           ("z_noise", numpy.float64),
+                           ("object_id", numpy.int64),
+                           ("r", numpy.int64),
+                           ("g", numpy.int64),
+                           ("b", numpy.int64),
+                           ("idx", numpy.int64)])
+
+
+"""A record of the evd file format, equivalent to struct "14dQ" """
+EVD_RECORD_DTYPE = numpy.dtype([("timestamp", numpy.float64),
+                                ("yaw", numpy.float64),
+                                ("pitch", numpy.float64),
+                                ("distance", numpy.float64),
+                                ("distance_noise", numpy.float64),
+                                ("x", numpy.float64),
+                                ("y", numpy.float64),
+                                ("z", numpy.float64),
+                                ("x_noise", numpy.float64),
+                                ("y_noise", numpy.float64),
+                                ("z_noise", numpy.float64),
+                                ("r", numpy.float64),
+                                ("g", numpy.float64),
+                                ("b", numpy.float64),
+                                ("object_id", numpy.uint64)])
+
+#Initial number of entries of an evd_file, the storage grows as needed
+DEFAULT_CAPACITY = 1024
 
 
 #Globals (should be removed at some point)
 output_labels = True
+pcd_format = "ascii"
 frame_counter = 0
 
 
@@ -56,6 +113,8 @@ WRITER_MODE_PCL = 2
 WRITER_MODE_PGM = 3
 WRITER_MODE_NUMPY = 4
 
+NUMPY_BINARY_EXTENSIONS = [".npy", ".npz", ".compressed.npz"]
+
 
 class evd_file:
     filename = ""
@@ -63,9 +122,10 @@ class evd_file:
     height = 0
     max_depth=1.0
 
-    def __init__(self, filename, width=0, height=0, max_depth=1.0):
+    def __init__(self, filename, width=0, height=0, max_depth=1.0, capacity=DEFAULT_CAPACITY):
         self.filename = filename
-        self.buffer = []
+        self.entries = numpy.zeros(max(capacity,1), dtype=ENTRY_DTYPE)
+        self.count = 0
         self.extension = ""
         self.mode = WRITER_MODE_EVD
         self.output_labels = output_labels
@@ -75,6 +135,11 @@ class evd_file:
           if self.filename[-4:] == ".pcd":
             self.mode = WRITER_MODE_PCL
             self.filename = self.filename[:-4]
+            self.pcd_format = pcd_format
+            for fmt in PCD_FORMATS:
+              if self.filename.endswith("."+fmt):
+                self.pcd_format = fmt
+                self.filename = self.filename[:-len(fmt)-1]
           elif self.filename[-6:] == ".numpy":
             self.mode = WRITER_MODE_NUMPY
             self.filename = self.filename[:-6]
@@ -83,18 +148,37 @@ class evd_file:
             self.mode = WRITER_MODE_NUMPY
             self.filename = self.filename[:-9]
             self.extension = ".numpy.gz"
-          elif self.filename[-4:] == ".pgm":
+          elif self.filename[-4:] == ".npy":
+            self.mode = WRITER_MODE_NUMPY
+            self.filename = self.filename[:-4]
+            self.extension = ".npy"
+          elif self.filename[-15:] == ".compressed.npz":
+            self.mode = WRITER_MODE_NUMPY
+            self.filename = self.filename[:-15]
+            self.extension = ".compressed.npz"
+          elif self.filename[-4:] == ".npz":
+            self.mode = WRITER_MODE_NUMPY
+            self.filename = self.filename[:-4]
+            self.extension = ".npz"
+          elif self.filename[-4:] == ".pgm" or self.filename[-4:] == ".png":
             if width==0 or height==0:
               raise Exception("Width or Height not set")
-            self.image = [0.0]*(width*height)
-            self.image_noisy = [0.0]*(width*height)
+            self.image = numpy.zeros(width*height, dtype=numpy.float64)
+            self.image_noisy = numpy.zeros(width*height, dtype=numpy.float64)
             self.max_depth=max_depth
             self.mode = WRITER_MODE_PGM
+            self.extension = self.filename[-4:]
             self.filename = self.filename[:-4]
         except:
           pass
 
     def fromMesh(self, mesh):
+      from blensor import mesh_utils
+      side_buffer = mesh_utils.get_side_buffer(mesh)
+      if side_buffer is not None and len(side_buffer) == len(mesh.vertices):
+        self.addEntries(side_buffer)
+        return
+
       import bmesh
       bm = bmesh.new()
       bm.from_mesh(mesh)
@@ -138,6 +222,19 @@ class evd_file:
 
       bm.free()
 
+    """The valid entries, a view of the preallocated storage"""
+    @property
+    def buffer(self):
+        return self.entries[:self.count]
+
+    """Make sure that additional entries fit into the storage"""
+    def reserve(self, additional):
+        required = self.count + additional
+        if required > len(self.entries):
+            entries = numpy.zeros(max(required, 2*len(self.entries)), dtype=ENTRY_DTYPE)
+            entries[:self.count] = self.entries[:self.count]
+            self.entries = entries
+
     def addEntry(self, timestamp=0.0, yaw=0.0, pitch=0.0, distance=0.0, 
                  distance_noise=0.0, x=0.0, y=0.0, z=0.0,
                  x_noise = 0.0, y_noise = 0.0, z_noise = 0.0, object_id=0, color=(1.0,1.0,1.0), idx=0):
@@ -147,40 +244,74 @@ class evd_file:
             self.image[idx]=distance
             self.image_noisy[idx]=distance_noise
         
-        
-        self.buffer.append([timestamp, yaw, pitch, distance,distance_noise,
-                       x,y,z,x_noise,y_noise,z_noise,object_id,int(255*color[0]),int(255*color[1]),int(255*color[2]),idx])
+        self.reserve(1)
+        self.entries[self.count] = (timestamp, yaw, pitch, distance,distance_noise,
+                       x,y,z,x_noise,y_noise,z_noise,object_id,int(255*color[0]),int(255*color[1]),int(255*color[2]),idx)
+        self.count += 1
+
+    """Add a whole array of entries of type ENTRY_DTYPE at once"""
+    def addEntries(self, entries):
+        if self.mode == WRITER_MODE_PGM:
+          valid = (entries["idx"] >= 0) & (entries["idx"] < len(self.image))
+          self.image[entries["idx"][valid]] = entries["distance"][valid]
+          self.image_noisy[entries["idx"][valid]] = entries["distance_noise"][valid]
+
+        self.reserve(len(entries))
+        self.entries[self.count:self.count+len(entries)] = entries
+        self.count += len(entries)
+
+    """The clean (or noisy) points as an N x 3 array"""
+    def getPoints(self, noisy=False):
+        names = ("x_noise","y_noise","z_noise") if noisy else ("x","y","z")
+        return numpy.column_stack([self.buffer[name] for name in names])
+
+    """The buffer as an N x 16 float64 array, one column per field"""
+    def asArray(self):
+        buffer = self.buffer
+        return numpy.column_stack([buffer[name].astype(numpy.float64) for name in ENTRY_DTYPE.names])
+
+    """The buffer as records of the evd file format"""
+    def evdRecords(self):
+        buffer = self.buffer
+        records = numpy.empty(len(buffer), dtype=EVD_RECORD_DTYPE)
+        for name in EVD_RECORD_DTYPE.names:
+          if name != "object_id":
+            records[name] = buffer[name]
+        #The evd format does not allow negative object ids
+        records["object_id"] = numpy.maximum(buffer["object_id"], 0)
+        return records
+
+    def writeEvdBlock(self, evd):
+        records = self.evdRecords()
+        evd.write(struct.pack("i", len(records)))
+        evd.write(records.tobytes())
+        return len(records)
 
     def writeEvdFile(self):
         if self.mode == WRITER_MODE_PCL:
           self.writePCLFile()
-        if self.mode == WRITER_MODE_NUMPY:
+        elif self.mode == WRITER_MODE_NUMPY:
               self.writeNUMPYFile()
         elif self.mode == WRITER_MODE_PGM:
           self.writePGMFile()
         else:
-          evd = open(self.filename,"w")
-          evd.buffer.write(struct.pack("i", len(self.buffer)))
-          for e in self.buffer:
-              #The evd format does not allow negative object ids
-              evd.buffer.write(struct.pack("14dQ", float(e[0]),float(e[1]),float(e[2]),float(e[3]),float(e[4]),float(e[5]),float(e[6]),float(e[7]),float(e[8]),float(e[9]),float(e[10]), float(e[12]),float(e[13]),float(e[14]),max(0,int(e[11]))))
+          evd = open(self.filename,"wb")
+          self.writeEvdBlock(evd)
           evd.close()
 
     def appendEvdFile(self):
         if self.mode == WRITER_MODE_PCL:
           self.writePCLFile()
-        if self.mode == WRITER_MODE_NUMPY:
+        elif self.mode == WRITER_MODE_NUMPY:
               self.writeNUMPYFile()
         elif self.mode == WRITER_MODE_PGM:
           self.writePGMFile()
+        elif self.filename in active_writers:
+          idx = active_writers[self.filename].writeFrame(self.evdRecords())
+          print ("Written: %d entries"%idx)
         else:
-          evd = open(self.filename,"a")
-          evd.buffer.write(struct.pack("i", len(self.buffer)))
-          idx = 0
-          for e in self.buffer:
-              #The evd format does not allow negative object ids
-              evd.buffer.write(struct.pack("14dQ", float(e[0]),float(e[1]),float(e[2]),float(e[3]),float(e[4]),float(e[5]),float(e[6]),float(e[7]),float(e[8]),float(e[9]),float(e[10]), float(e[12]),float(e[13]),float(e[14]),max(0,int(e[11])))) 
-              idx = idx + 1
+          evd = open(self.filename,"ab")
+          idx = self.writeEvdBlock(evd)
           print ("Written: %d entries"%idx)
           evd.close()
   
@@ -201,6 +332,10 @@ class evd_file:
     def writePCLFile(self):
       global frame_counter    #Not nice to have it global but it needs to persist
       
+      if self.pcd_format != "ascii":
+        self.writeBinaryPCLFile()
+        return
+
       sparse_mode = True #Write only valid points
       if self.width == 0 or self.height == 0:
         width=len(self.buffer)
@@ -213,11 +348,11 @@ class evd_file:
         pcl = open("%s%05d.pcd"%(self.filename,frame_counter),"w")
         pcl_noisy = open("%s_noisy%05d.pcd"%(self.filename,frame_counter),"w")
         if self.output_labels:
-          pcl.write(PCL_HEADER_WITH_LABELS%(width,height,width*height))
-          pcl_noisy.write(PCL_HEADER_WITH_LABELS%(width,height,width*height))
+          pcl.write(PCL_HEADER_WITH_LABELS%(width,height,width*height,"ascii"))
+          pcl_noisy.write(PCL_HEADER_WITH_LABELS%(width,height,width*height,"ascii"))
         else:
-          pcl.write(PCL_HEADER%(width,height,width*height))
-          pcl_noisy.write(PCL_HEADER%(width,height,width*height))
+          pcl.write(PCL_HEADER%(width,height,width*height,"ascii"))
+          pcl_noisy.write(PCL_HEADER%(width,height,width*height,"ascii"))
         idx = 0
         for e in self.buffer:
           if e[15] > idx and not sparse_mode: # e[15] is the idx of the point
@@ -238,6 +373,86 @@ class evd_file:
       except Exception as e:
         traceback.print_exc()      
 
+    """The clean and the noisy points as PCD records (x, y, z, rgb, label)
+       In dense mode the points are placed at their index, all other points
+       are invalid (NaN). Labels are written like the ascii writer does,
+       invalid points and points without an object get -1 (as uint32)
+    """
+    def pclPoints(self, count, sparse_mode):
+      #rgb holds the bits of the packed color, the header declares it as float
+      fields = [("x", numpy.float32), ("y", numpy.float32), ("z", numpy.float32), ("rgb", numpy.uint32)]
+      if self.output_labels:
+        fields.append(("label", numpy.uint32))
+
+      buffer = self.buffer
+      if sparse_mode:
+        target = slice(None)
+      else:
+        valid = (buffer["idx"] >= 0) & (buffer["idx"] < count)
+        buffer = buffer[valid]
+        target = buffer["idx"]
+
+      #Storing color values packed into a single floating point number??? 
+      #That is really required by the pcl library!
+      rgb = (buffer["r"] << 16) | (buffer["g"] << 8) | buffer["b"]
+
+      points = []
+      for names in (("x","y","z"), ("x_noise","y_noise","z_noise")):
+        p = numpy.zeros(count, dtype=fields)
+        p["x"] = p["y"] = p["z"] = float('NaN')
+        p["x"][target] = buffer[names[0]]
+        p["y"][target] = buffer[names[1]]
+        p["z"][target] = buffer[names[2]]
+        p["rgb"][target] = rgb
+        if self.output_labels:
+          p["label"] = numpy.uint32(INVALID_POINT[11] & 0xffffffff)
+          p["label"][target] = buffer["object_id"].astype(numpy.uint32)
+        points.append(p)
+      return points
+
+    def writeBinaryPCLFile(self):
+      global frame_counter    #Not nice to have it global but it needs to persist
+
+      sparse_mode = True #Write only valid points
+      if self.width == 0 or self.height == 0:
+        width=len(self.buffer)
+        height = 1
+      else:
+        sparse_mode = False # Write all points
+        width = self.width
+        height = self.height
+      try:
+        header = PCL_HEADER_WITH_LABELS if self.output_labels else PCL_HEADER
+        header = (header%(width,height,width*height,self.pcd_format)).encode("ascii")
+        points, points_noisy = self.pclPoints(width*height, sparse_mode)
+
+        for filename, p in (("%s%05d.pcd"%(self.filename,frame_counter), points),
+                            ("%s_noisy%05d.pcd"%(self.filename,frame_counter), points_noisy)):
+          pcl = open(filename, "wb")
+          pcl.write(header)
+          if self.pcd_format == "binary_compressed":
+            #binary_compressed stores the fields one after the other
+            data = b"".join(p[name].tobytes() for name in p.dtype.names)
+            compressed = pcd.lzf_compress(data)
+            pcl.write(struct.pack("II", len(compressed), len(data)))
+            pcl.write(compressed)
+          else:
+            pcl.write(p.tobytes())
+          pcl.close()
+      except Exception as e:
+        traceback.print_exc()
+
+    """The buffer as a structured ENTRY_DTYPE array. In dense mode the
+       entries are placed at their index, all other entries are invalid
+    """
+    def denseEntries(self, count):
+      entries = numpy.empty(count, dtype=ENTRY_DTYPE)
+      entries[:] = tuple(INVALID_POINT)
+      buffer = self.buffer
+      valid = (buffer["idx"] >= 0) & (buffer["idx"] < count)
+      entries[buffer["idx"][valid]] = buffer[valid]
+      return entries
+
     def writeNUMPYFile(self):
       global frame_counter    #Not nice to have it global but it needs to persist
       
@@ -251,49 +466,200 @@ class evd_file:
         height = self.height
       try:
         import numpy as np
-        data = np.array(self.buffer)
-        if not sparse_mode:
-          tmp = np.zeros((width*height,data.shape[1]),dtype=np.float64)
-          tmp[np.int64(data[:,-1])] = data
-          data = tmp
-        np.savetxt("%s%05d%s"%(self.filename,frame_counter,self.extension), data)
+        filename = "%s%05d%s"%(self.filename,frame_counter,self.extension)
+        if self.extension in NUMPY_BINARY_EXTENSIONS:
+          #.npy and .npz store the structured array, no text conversion
+          data = self.buffer if sparse_mode else self.denseEntries(width*height)
+          if self.extension == ".npy":
+            np.save(filename, data)
+          elif self.extension == ".npz":
+            #np.savez appends .npz if the name does not end with it
+            np.savez(filename, scan=data)
+          else:
+            np.savez_compressed(filename, scan=data)
+        else:
+          data = self.asArray()
+          if not sparse_mode:
+            tmp = np.zeros((width*height,data.shape[1]),dtype=np.float64)
+            tmp[np.int64(data[:,-1])] = data
+            data = tmp
+          np.savetxt(filename, data)
       except Exception as e:
         traceback.print_exc()      
 
+    """The clean and the noisy image as 16 bit values, scaled to
+       max_depth. Invalid (NaN) pixels are 0
+    """
+    def depthImages(self):
+      images = numpy.stack((self.image, self.image_noisy))
+      with numpy.errstate(invalid="ignore"):
+        values = numpy.nan_to_num(PGM_VALUE_RANGE*images/self.max_depth)
+      values = numpy.clip(numpy.trunc(values), 0, PGM_VALUE_RANGE).astype(numpy.uint16)
+      return values.reshape(2, self.height, self.width)
+
     def writePGMFile(self):
       global frame_counter    #Not nice to have it global but it needs to persist
       try:
-        print ("Writing PGM file %s%05d.pgm"%(self.filename,frame_counter))
-        pgm = open("%s%05d.pgm"%(self.filename,frame_counter),"w")
-        pgm_noisy = open("%s_noisy%05d.pgm"%(self.filename,frame_counter),"w")
-        pgm.write(PGM_HEADER%(self.width,self.height, PGM_VALUE_RANGE))
-        pgm_noisy.write(PGM_HEADER%(self.width,self.height, PGM_VALUE_RANGE))
-        for val in range(len(self.image)):
-          if not math.isnan(self.image[val]):
-            ival = int(PGM_VALUE_RANGE*self.image[val]/self.max_depth)
-          else:
-            ival = 0
-          pgm.write("%d\n"%(ival if ival < PGM_VALUE_RANGE else PGM_VALUE_RANGE))
-        for val in range(len(self.image_noisy)):
-          if not math.isnan(self.image_noisy[val]):
-            ival = int(PGM_VALUE_RANGE*self.image_noisy[val]/self.max_depth)
+        filenames = ["%s%05d%s"%(self.filename,frame_counter,self.extension),
+                     "%s_noisy%05d%s"%(self.filename,frame_counter,self.extension)]
+        print ("Writing depth image %s"%filenames[0])
+        for filename, values in zip(filenames, self.depthImages()):
+          if self.extension == ".png":
+            write_png16(filename, values)
           else:
-            ival = 0
-          pgm_noisy.write("%d\n"%(ival if ival < PGM_VALUE_RANGE else PGM_VALUE_RANGE))
-        
-        pgm.close()
-        pgm_noisy.close()
+            pgm = open(filename,"wb")
+            pgm.write((PGM_HEADER%(self.width,self.height, PGM_VALUE_RANGE)).encode("ascii"))
+            pgm.write(values.astype(">u2").tobytes())
+            pgm.close()
       except Exception as e:
         traceback.print_exc()
 
 
     def finishEvdFile(self):
-        evd = open(self.filename,"a")
-        evd.buffer.write(struct.pack("i", -1))
-        evd.close()
+        finish_evd_stream(self.filename)
 
     def isEmpty(self):
-      return (len(self.buffer) == 0)
+      return (self.count == 0)
+
+"""One PNG chunk: length, type, data and the CRC of type and data"""
+def png_chunk(chunk_type, data):
+  return (struct.pack(">I", len(data)) + chunk_type + data +
+          struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
+
+"""Write a height x width uint16 image as 16 bit grayscale PNG. The
+   values are written as they are (big endian rows like the PGM files),
+   there is no color management involved
+"""
+def write_png16(filename, values):
+  height, width = values.shape
+  rows = numpy.empty((height, 1 + 2*width), dtype=numpy.uint8)
+  rows[:,0] = 0 #Filter type none
+  rows[:,1:] = numpy.ascontiguousarray(values, dtype=">u2").view(numpy.uint8).reshape(height, 2*width)
+
+  #Bit depth 16, color type 0 (grayscale), no interlacing
+  header = struct.pack(">IIBBBBB", width, height, 16, 0, 0, 0, 0)
+  with open(filename, "wb") as png:
+    png.write(b"\x89PNG\r\n\x1a\n")
+    png.write(png_chunk(b"IHDR", header))
+    png.write(png_chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+    png.write(png_chunk(b"IEND", b""))
+
+
+"""Open EvdWriters by filename, evd_file.appendEvdFile writes through them"""
+active_writers = {}
+
+
+"""A long-lived writer for an evd stream
+
+   While the writer is open every evd_file with the same filename appends
+   its frames through it instead of opening the file for every frame.
+   A frame is packed into a single buffer (block header and records) and
+   written at once. With background=True the buffers are written by a
+   thread, so the disk I/O overlaps with the raycasting of the next
+   frame. At most max_pending frames are queued. Write errors of the
+   thread are raised by the next call of the writer.
+
+   with evd.EvdWriter("/tmp/scan.evd", append=False, background=True) as writer:
+     for frame in frames:
+       ...scan frame with evd_file="/tmp/scan.evd"...
+     writer.finish()
+"""
+class EvdWriter:
+  def __init__(self, filename, append=True, background=False, max_pending=4):
+    self.filename = filename
+    self.handle = open(filename, "ab" if append else "wb")
+    self.finished = False
+    self.error = None
+    self.queue = None
+    self.thread = None
+    if background:
+      self.queue = queue.Queue(max_pending)
+      self.thread = threading.Thread(target=self.flushLoop, name="EvdWriter")
+      self.thread.daemon = True
+      self.thread.start()
+    active_writers[filename] = self
+
+  def __enter__(self):
+    return self
+
+  """If the with block raises, a write error of the thread must not
+     replace its exception, the write error is only printed then
+  """
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.close(raise_errors=False)
+      if self.error is not None:
+        print ("Error writing %s: %s"%(self.filename, str(self.error)))
+        self.error = None
+
+  def checkError(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def write(self, data):
+    self.checkError()
+    if self.queue is not None:
+      self.queue.put(data)
+    else:
+      self.handle.write(data)
+
+  """Write one frame of EVD_RECORD_DTYPE records, returns the number of records"""
+  def writeFrame(self, records):
+    self.write(struct.pack("i", len(records)) + records.tobytes())
+    return len(records)
+
+  """Terminate the stream, no frames can follow"""
+  def finish(self):
+    if not self.finished:
+      self.write(struct.pack("i", -1))
+      self.finished = True
+
+  def flushLoop(self):
+    while True:
+      data = self.queue.get()
+      try:
+        if data is None:
+          break
+        self.handle.write(data)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+
+  """Wait until all queued frames are written"""
+  def flush(self):
+    if self.queue is not None:
+      self.queue.join()
+    self.handle.flush()
+    self.checkError()
+
+  def close(self, raise_errors=True):
+    if self.handle is None:
+      return
+    if self.thread is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+    self.handle.close()
+    self.handle = None
+    if active_writers.get(self.filename) is self:
+      del active_writers[self.filename]
+    if raise_errors:
+      self.checkError()
+
+
+"""Terminate an evd stream, through the open writer if there is one"""
+def finish_evd_stream(filename):
+  if filename in active_writers:
+    active_writers[filename].finish()
+  else:
+    evd = open(filename,"ab")
+    evd.write(struct.pack("i", -1))
+    evd.close()
+
 
 class evd_reader:
   rayIndex = 0
@@ -315,3 +681,124 @@ class evd_reader:
     
 
         
+
+
+
+"""Random access to the frames of an evd file
+
+   The file is memory mapped and every frame is returned as a structured
+   EVD_RECORD_DTYPE array that is a view of the mapping, nothing is read
+   until the data is accessed. An evd file is a chain of blocks
+   (int count, count records) terminated by -1, every block is one frame.
+   The offsets of the blocks are stored in a sidecar index
+   (filename.index.npy) so large files are only walked once. The index is
+   rebuilt if the size of the file changed, a block that is still being
+   written is not part of the dataset.
+
+   dataset = evd.EvdDataset("/tmp/scan.evd")
+   for frame in dataset:
+     points = numpy.column_stack((frame["x"], frame["y"], frame["z"]))
+"""
+class EvdDataset:
+  def __init__(self, filename, use_index=True):
+    self.filename = filename
+    self.index_filename = filename + ".index.npy"
+    self.size = os.path.getsize(filename)
+    if self.size > 0:
+      self.data = numpy.memmap(filename, dtype=numpy.uint8, mode="r")
+    else:
+      self.data = numpy.zeros(0, dtype=numpy.uint8)
+
+    index = self.loadIndex() if use_index else None
+    if index is None:
+      index = self.buildIndex()
+      if use_index:
+        self.saveIndex(index)
+    self.offsets = index[:,0]
+    self.counts = index[:,1]
+
+  """The index is an N x 2 array of (record offset, record count), the
+     first row of the sidecar file holds the file size and the frame count
+  """
+  def buildIndex(self):
+    index = []
+    header = struct.calcsize("i")
+    position = 0
+    while position + header <= self.size:
+      count = struct.unpack("i", self.data[position:position+header].tobytes())[0]
+      end = position + header + count*EVD_RECORD_DTYPE.itemsize
+      if count < 0 or end > self.size:
+        break
+      index.append((position+header, count))
+      position = end
+    return numpy.array(index, dtype=numpy.int64).reshape(-1,2)
+
+  def loadIndex(self):
+    try:
+      index = numpy.load(self.index_filename)
+    except (IOError, ValueError):
+      return None
+    if len(index) == 0 or index[0,0] != self.size or index[0,1] != len(index)-1:
+      return None
+    return index[1:]
+
+  def saveIndex(self, index):
+    try:
+      numpy.save(self.index_filename, numpy.vstack(([[self.size, len(index)]], index)))
+    except IOError:
+      print ("Could not write the evd index %s"%self.index_filename)
+
+  def __len__(self):
+    return len(self.offsets)
+
+  """Frame i as EVD_RECORD_DTYPE view of the file"""
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if i < 0 or i >= len(self):
+      raise IndexError("Frame %d not in %s"%(i, self.filename))
+    start = self.offsets[i]
+    end = start + self.counts[i]*EVD_RECORD_DTYPE.itemsize
+    return self.data[start:end].view(EVD_RECORD_DTYPE)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def __enter__(self):
+    return self
+
+  """If the with block raises, a write error of the thread must not
+     replace its exception, the write error is only printed then
+  """
+  def __exit__(self, exc_type, exc_value, exc_traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.close(raise_errors=False)
+      if self.error is not None:
+        print ("Error writing %s: %s"%(self.filename, str(self.error)))
+        self.error = None
+
+  def close(self):
+    self.data = None
+
+
+"""Read a frame written by the numpy writer as a structured ENTRY_DTYPE
+   array. .npy files can be memory mapped (mmap=True), then the data is
+   only read from disk when it is accessed. .npz archives are always
+   read completely. The text formats (.numpy, .numpy.gz) are converted
+   to the structured layout.
+"""
+def read_numpy_file(filename, mmap=False):
+  if filename.endswith(".npy"):
+    return numpy.load(filename, mmap_mode="r" if mmap else None)
+  elif filename.endswith(".npz"):
+    with numpy.load(filename) as archive:
+      return archive["scan"]
+  else:
+    data = numpy.loadtxt(filename, ndmin=2)
+    entries = numpy.zeros(len(data), dtype=ENTRY_DTYPE)
+    for column, name in enumerate(ENTRY_DTYPE.names):
+      entries[name] = data[:,column]
+    return entries
@@ -19,3 +19,10 @@ class GaussianErrorModel:
     if self.sigma < 0.0000001:
       return self.mu
     return np.random.normal(self.mu,self.sigma) 
+
+  """One error for every distance in the array, drawn in a single call"""
+  def drawErrorsFromModel(self,distances):
+    shape = np.shape(distances)
+    if self.sigma < 0.0000001:
+      return np.full(shape, self.mu, dtype=np.float64)
+    return np.random.normal(self.mu,self.sigma,shape)
@@ -26,6 +26,8 @@ from mathutils import Vector, Euler,geometry, Matrix
 
 from blensor import evd
 from blensor import mesh_utils
+from blensor import ray_pattern
+from blensor import scan_processing
 
 import blensor
 
@@ -131,49 +133,24 @@ def scan_advanced(scanner_object, rotation_speed = 25.0, simulation_fps=24, angl
 
     evd_storage = evd.evd_file(evd_file)
 
-    xaxis = Vector([1,0,0])
-    yaxis = Vector([0,1,0])
-    zaxis = Vector([0,0,1])
-
-    rays = []
-    ray_info = []
-
     angles = end_angle-start_angle
     steps_per_rotation = angles/angle_resolution
     time_per_step = (1.0/rotation_speed) / steps_per_rotation
 
     lines = (end_angle-start_angle)/angle_resolution
 
-    for line in range(int(lines)):
-        for laser_idx in range(len(laser_angles)):
-            current_angle = start_angle + float(line)*angles/float(lines)
-            [ray, origion, laser_angle] = calculateRay(laser_angles[laser_idx], deg2rad(current_angle), laser_mirror_distance) 
-            #TODO: Use the origin to cast the ray. Requires changes to the blender patch
-            rot_angle = 1e-6 + current_angle + 180.0
-            timestamp = ( (rot_angle-180.0)/angle_resolution) * time_per_step 
-            rot_angle = rot_angle%360.0
-            ray_info.append([deg2rad(rot_angle), laser_angle, timestamp])
-            
-            rays.extend([ray[0],ray[1],ray[2]])
-
-
-    returns = blensor.scan_interface.scan_rays(rays, max_distance, inv_scan_x = inv_scan_x, inv_scan_y = inv_scan_y, inv_scan_z = inv_scan_z)
+    #TODO: Use the reflection point on the mirror as the origin of the rays
+    rays, yaws, pitches, timestamps = ray_pattern.mirror(laser_angles, 
+        start_angle, end_angle, angle_resolution, time_per_step)
 
-    reusable_vector = Vector([0.0,0.0,0.0,0.0])
-    for i in range(len(returns)):
-        idx = returns[i][-1]
-        reusable_vector.xyzw = [returns[i][1],returns[i][2],returns[i][3],1.0]
-        vt = (world_transformation * reusable_vector).xyz
-        v = [returns[i][1],returns[i][2],returns[i][3]]
+    returns = blensor.scan_interface.scan_rays_array(rays, max_distance, inv_scan_x = inv_scan_x, inv_scan_y = inv_scan_y, inv_scan_z = inv_scan_z,
+                 **blensor.scan_interface.adaptive_scan_args(scanner_object))
 
-        distance_noise =  laser_noise[idx%len(laser_noise)] + random.gauss(noise_mu, noise_sigma) 
-        vector_length = math.sqrt(v[0]**2+v[1]**2+v[2]**2)
-        norm_vector = [v[0]/vector_length, v[1]/vector_length, v[2]/vector_length]
-        vector_length_noise = vector_length+distance_noise
-        reusable_vector.xyzw = [norm_vector[0]*vector_length_noise, norm_vector[1]*vector_length_noise, norm_vector[2]*vector_length_noise,1.0]
-        v_noise = (world_transformation * reusable_vector).xyz
+    distance_noise = (numpy.asarray(laser_noise)[returns["idx"]%len(laser_noise)] + 
+                      numpy.random.normal(noise_mu, noise_sigma, len(returns)))
 
-        evd_storage.addEntry(timestamp = ray_info[idx][2], yaw =(ray_info[idx][0]+math.pi)%(2*math.pi), pitch=ray_info[idx][1], distance=vector_length, distance_noise=vector_length_noise, x=vt[0], y=vt[1], z=vt[2], x_noise=v_noise[0], y_noise=v_noise[1], z_noise=v_noise[2], object_id=returns[i][4], color=returns[i][5])
+    evd_storage.addEntries(scan_processing.process_returns(returns, timestamps, yaws, pitches, 
+                                                           distance_noise, world_transformation))
 
     current_angle = start_angle+float(float(int(lines))*angle_resolution)
             
@@ -181,16 +158,15 @@ def scan_advanced(scanner_object, rotation_speed = 25.0, simulation_fps=24, angl
         evd_storage.appendEvdFile()
 
     if not evd_storage.isEmpty():
-        scan_data = numpy.array(evd_storage.buffer)
         additional_data = None
         if scanner_object.store_data_in_mesh:
             additional_data = evd_storage.buffer
 
         if add_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,5:8], "Scan", world_transformation, buffer=additional_data)
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(), "Scan", world_transformation, buffer=additional_data, scanner=scanner_object)
 
         if add_noisy_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,8:11], "NoisyScan", world_transformation, buffer=additional_data) 
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(noisy=True), "NoisyScan", world_transformation, buffer=additional_data, scanner=scanner_object) 
 
         bpy.context.scene.update()
 
@@ -205,7 +181,7 @@ def scan_advanced(scanner_object, rotation_speed = 25.0, simulation_fps=24, angl
 
 # This Function creates scans over a range of frames
 
-def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/landscape.evd", frame_time = (1.0/24.0), rotation_speed = 25.0, fps = 24, add_blender_mesh=False, add_noisy_blender_mesh=False, angle_resolution = 0.5, max_distance = 90.0, noise_mu = 0.0, noise_sigma= 0.02, laser_mirror_distance = 0.05, start_angle=-35.0, end_angle=50.0, last_frame = True, world_transformation=Matrix()):
+def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/landscape.evd", frame_time = (1.0/24.0), rotation_speed = 25.0, fps = 24, add_blender_mesh=False, add_noisy_blender_mesh=False, angle_resolution = 0.5, max_distance = 90.0, noise_mu = 0.0, noise_sigma= 0.02, laser_mirror_distance = 0.05, start_angle=-35.0, end_angle=50.0, last_frame = True, world_transformation=Matrix(), raise_errors=False):
 
     fps = rotation_speed # The Ibeo Module does not yet support an update
                          # rate different to the simulation speed
@@ -238,11 +214,11 @@ def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/landscape.
                     break
     except:
         print ("Scan aborted")
+        if raise_errors:
+            raise
 
     if last_frame:
-        evd_file = open(filename,"a")
-        evd_file.buffer.write(struct.pack("i",-1))
-        evd_file.close()
+        evd.finish_evd_stream(filename)
 
     end_time = time.time()
     print ("Total scan time: %.2f"%(end_time-start_time))
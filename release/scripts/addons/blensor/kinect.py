@@ -29,14 +29,19 @@ import blensor.scan_interface
 from blensor import evd
 from blensor import mesh_utils
 from blensor import kinect_dots
+from blensor import ray_pattern
+from blensor import scan_processing
 
 """Highly experimental. Just a quick hack for alexandru"""
-from blensor.noise import PerlinNoise
+from blensor import noise
 """---------"""  
 
 
 WINDOW_INLIER_DISTANCE = 0.1
 
+#Number of 9x9 windows that are evaluated at once
+WINDOW_CHUNK_SIZE = 65536
+
 from mathutils import Vector, Euler, Matrix
 
 def deg2rad(deg):
@@ -56,7 +61,7 @@ INVALID_DISPARITY = 99999999.9
 
 parameters = {"max_dist":6.0,"min_dist": 0.7, "noise_mu":0.0,"noise_sigma":0.0,  
               "xres": 640, "yres": 480, "flength": 4.73, "reflectivity_distance":0.0,
-              "reflectivity_limit":0.01,"reflectivity_slope":0.16, "noise_scale": 0.25, "noise_smooth":1.5,
+              "reflectivity_limit":0.01,"reflectivity_slope":0.16, "noise_scale": 0.25, "noise_smooth":1.5, "noise_fields": 0,
               "inlier_distance": 0.05, "vert_fov":43.1845, "horiz_fov":55.6408 }
 
 def addProperties(cType):
@@ -77,6 +82,7 @@ def addProperties(cType):
 
     cType.kinect_noise_smooth = bpy.props.FloatProperty( name = "Global Noise Smoothness", default = parameters["noise_smooth"], min = 1.0, max = 100.0, description = "Smoothness of the global noise (higher values are smoother" )
     cType.kinect_noise_scale = bpy.props.FloatProperty( name = "Global Noise Scale", default = parameters["noise_scale"], min = 0.0, max = 10.0, description = "Strength of the global noise" )
+    cType.kinect_noise_fields = bpy.props.IntProperty( name = "Global Noise Fields", default = parameters["noise_fields"], min = 0, max = 1000, description = "Number of cached global noise fields, frame n uses field n modulo this number. 0 draws a new field for every frame" )
     cType.kinect_inlier_distance = bpy.props.FloatProperty( name = "Inlier Distance", default = parameters["inlier_distance"], min = 0.0, max = 10.0, description = "Which points are considered valid for the 9x9 window" )
 
 
@@ -96,6 +102,15 @@ def get_pixel_from_world(X,Z,flength_px):
   return (flength_px*X/Z)
 
 
+"""The seed of the global noise field of the current frame, None if every
+   frame gets a new field
+"""
+def frame_noise_seed(scanner_object, frame):
+  if scanner_object.kinect_noise_fields > 0:
+    return frame % scanner_object.kinect_noise_fields
+  return None
+
+
 """This checks a 9x9 window around the point in idx if the depth values
    would allow the kinect to do a correct matching. If for example some
    value would be missing, the kinect could not match the image to the
@@ -104,15 +119,14 @@ def get_pixel_from_world(X,Z,flength_px):
    valid depth measurement. Note: This has to be verified by a real kinect
 """
     
-def fast_9x9_window(distances, res_x, res_y, disparity_map, noise_smooth, noise_scale):
+def fast_9x9_window(distances, res_x, res_y, disparity_map, noise_smooth, noise_scale, noise_seed=None, noise_fields=None):
   data = distances.reshape(res_y, res_x)
   disp_data = disparity_map.reshape(res_y, res_x)
   disp_data[:] = INVALID_DISPARITY
   
   """Highly experimental. Just a quick hack for alexandru"""
-  pnoise = PerlinNoise(size=(res_x,res_y))
   #It is important to reshape it exactly as it was generated (w,h)
-  noise_field = (pnoise.getData(scale=32.0)-1.0).reshape((res_x,res_y)) 
+  noise_field = (noise.noise_field((res_x,res_y), scale=32.0, seed=noise_seed, max_fields=noise_fields)-1.0).reshape((res_x,res_y)) 
   """-------------"""
 
   
@@ -122,35 +136,77 @@ def fast_9x9_window(distances, res_x, res_y, disparity_map, noise_smooth, noise_
      this fills too much gaps in the depthmap
   """
   fill_weights = numpy.array([1.0/(1.0+float(x**2+y**2)) if math.sqrt(x**2+y**2)<3.1 else -1.0 for x in range(-4,5) for y in range (-4,5)]).reshape((9,9))
-  
+
+  rows = min(kinect_dots.mask.shape[0]-9, data.shape[0]-9)
+  cols = min(kinect_dots.mask.shape[1]-9, data.shape[1]-9)
+  if rows <= 0 or cols <= 0:
+    return
+
+  """All 9x9 windows as views, window [y,x] is centered on pixel [y+4,x+4]"""
+  data_windows = sliding_9x9_windows(data[:rows+8,:cols+8])
+  dot_windows = sliding_9x9_windows(kinect_dots.mask[:rows+8,:cols+8])
+
+  center_data = data[4:rows+4,4:cols+4]
+  cy, cx = numpy.nonzero(kinect_dots.mask[4:rows+4,4:cols+4] & (center_data < INVALID_DISPARITY))
+
+  """Only the windows of candidate pixels are tested, in chunks to limit
+     the size of the temporary arrays
+  """
+  accepted = numpy.zeros(len(cy), dtype=bool)
+  for start in range(0, len(cy), WINDOW_CHUNK_SIZE):
+    y = cy[start:start+WINDOW_CHUNK_SIZE]
+    x = cx[start:start+WINDOW_CHUNK_SIZE]
+    window = data_windows[y,x]
+    dot_window = dot_windows[y,x]
+    valid_values = window < INVALID_DISPARITY
+    valid_dots = valid_values&dot_window
+    min_dots = numpy.sum(dot_window, axis=(1,2))/1.5
+
+    mean = (numpy.sum(numpy.where(valid_values, window, 0.0), axis=(1,2)) / 
+            numpy.sum(valid_values, axis=(1,2)))
+    differences = numpy.abs(window-mean[:,numpy.newaxis,numpy.newaxis])*weights
+    valids = (differences<WINDOW_INLIER_DISTANCE) & valid_dots
+
+    accepted[start:start+WINDOW_CHUNK_SIZE] = ((numpy.sum(valid_dots, axis=(1,2)) > min_dots) & 
+                                               (numpy.sum(valids, axis=(1,2)) > min_dots))
+
+  cy = cy[accepted]+4
+  cx = cx[accepted]+4
+  accu = data[cy,cx]
+  values = numpy.round((accu + noise_scale*
+      noise_field[(cx/noise_smooth).astype(numpy.int32),(cy/noise_smooth).astype(numpy.int32)])*8.0)/8.0
+  #round(accu*8.0)/8.0 #Values need to be requantified
+
+  """Every pixel takes the value of the accepted pixel with the highest
+     fill weight at its offset. For equal weights the pixel that comes
+     first in row major order wins, like in a sequential scan that only
+     replaces values with a strictly higher weight. Accepted pixels keep
+     their own value because only the offset 0 has a weight of 1.
+  """
   interpolation_map = numpy.zeros((res_y,res_x))
-    
-  for y in range(min(kinect_dots.mask.shape[0]-9, data.shape[0]-9)):
-    for x in range(min(kinect_dots.mask.shape[1]-9,data.shape[1]-9)):
-      if kinect_dots.mask[y+4,x+4] and data[y+4,x+4] < INVALID_DISPARITY:
-        window = data[y:y+9,x:x+9]
-        dot_window = kinect_dots.mask[y:y+9,x:x+9]
-        valid_values = window < INVALID_DISPARITY
-        valid_dots = valid_values&dot_window
-        if numpy.sum(valid_dots) > numpy.sum(dot_window)/1.5:
-          mean = numpy.sum(window[valid_values])/numpy.sum(valid_values)
-          differences = numpy.abs(window-mean)*weights
-
-          valids = (differences<WINDOW_INLIER_DISTANCE) & valid_dots
-            
-          pointcount = numpy.sum(weights[valids])
-          if numpy.sum(valids) > numpy.sum(dot_window)/1.5:
-            accu = window[4,4]
-            
-            disp_data[y+4,x+4] = round((accu + noise_scale*
-                noise_field[numpy.int32((x+4)/noise_smooth),numpy.int32((y+4)/noise_smooth)])*8.0)/8.0
-            #round(accu*8.0)/8.0 #Values need to be requantified
-            
-            interpolation_window = interpolation_map[y:y+9,x:x+9]
-            disp_data_window = disp_data[y:y+9,x:x+9]
-            substitutes = interpolation_window < fill_weights
-            disp_data_window[substitutes] = disp_data[y+4,x+4]
-            interpolation_window[substitutes] = fill_weights[substitutes]
+  source_map = numpy.zeros((res_y,res_x), dtype=numpy.int64)
+  source = cy*res_x + cx
+  for dy, dx in zip(*numpy.nonzero(fill_weights > 0.0)):
+    weight = fill_weights[dy,dx]
+    ty = cy+dy-4
+    tx = cx+dx-4
+    current = interpolation_map[ty,tx]
+    substitutes = (current < weight) | ((current == weight) & (source < source_map[ty,tx]))
+    ty = ty[substitutes]
+    tx = tx[substitutes]
+    disp_data[ty,tx] = values[substitutes]
+    interpolation_map[ty,tx] = weight
+    source_map[ty,tx] = source[substitutes]
+
+
+"""Read-only view of all 9x9 windows of a 2D array,
+   result[y,x] is data[y:y+9,x:x+9]
+"""
+def sliding_9x9_windows(data):
+  rows = data.shape[0]-8
+  cols = data.shape[1]-8
+  return numpy.lib.stride_tricks.as_strided(data, shape=(rows,cols,9,9), 
+                strides=data.strides+data.strides, writeable=False)
 
 def scan_advanced(scanner_object, evd_file=None, 
                   evd_last_scan=True, 
@@ -199,51 +255,13 @@ def scan_advanced(scanner_object, evd_file=None,
     cx = float(res_x) /2.0
     cy = float(res_y) /2.0 
 
-    evd_buffer = []
-
-    rays = [0.0]*res_y*res_x*6
-    ray_info = [[0.0,0.0,0.0]]*res_y*res_x
-
-    baseline = Vector([0.075,0.0,0.0]) #Kinect has a baseline of 7.5 centimeters
+    baseline = numpy.array([0.075,0.0,0.0]) #Kinect has a baseline of 7.5 centimeters
+    multiplier = numpy.array([x_multiplier, y_multiplier, z_multiplier])
 
-
-    
-    rayidx=0
-    ray = Vector([0.0,0.0,0.0])
     """Calculate the rays from the projector"""
-    for y in range(res_y):
-        for x in range(res_x):
-            """Calculate a vector that originates at the principal point
-               and points to the pixel in the sensor. This vector is then
-               scaled to the maximum scanning distance 
-            """ 
-
-            physical_x = float(x-cx) * pixel_width
-            physical_y = float(y-cy) * pixel_height
-            physical_z = -float(flength)
-
-            #ray = Vector([physical_x, physical_y, physical_z])
-            ray.xyz=[physical_x, physical_y, physical_z]
-            ray.normalize()
-            final_ray = max_distance*ray
-            rays[rayidx*6] = final_ray[0]
-            rays[rayidx*6+1] = final_ray[1]
-            rays[rayidx*6+2] = final_ray[2]
-            rays[rayidx*6+3] = baseline.x
-            rays[rayidx*6+4] = baseline.y
-            rays[rayidx*6+5] = baseline.z
-
-            """ pitch and yaw are added for completeness, normally they are
-                not provided by a ToF Camera but can be derived 
-                from the pixel position and the camera parameters.
-            """
-            yaw = math.atan(physical_x/flength)
-            pitch = math.atan(physical_y/flength)
-            ray_info[rayidx][0] = yaw
-            ray_info[rayidx][1] = pitch
-            ray_info[rayidx][2] = timestamp
-
-            rayidx += 1
+    rays, yaws, pitches, timestamps = ray_pattern.pinhole(res_x, res_y, 
+        pixel_width, pixel_height, flength, max_distance, timestamp)
+    rays = ray_pattern.with_origin(rays, baseline)
 
     """ Max distance is increased because the kinect is limited by 4m
         _normal distance_ to the imaging plane, We don't need shading in the
@@ -251,144 +269,104 @@ def scan_advanced(scanner_object, evd_file=None,
         #TODO: the shading requirements might change when transmission
         is implemented (the rays might pass through glass)
     """
-    returns = blensor.scan_interface.scan_rays(rays, 2.0*max_distance, True,True,True,True)
+    returns = blensor.scan_interface.scan_rays_array(rays, 2.0*max_distance, True, True, True)
+    projector_hits = numpy.column_stack((returns["x"], returns["y"], returns["z"])).astype(numpy.float64)
 
-    camera_rays = []
-    projector_ray_index = -1 * numpy.ones(len(returns), dtype=numpy.uint32)
+    """Every pixel gets an entry, pixels without a measurement stay invalid"""
+    kinect_image = numpy.empty(res_x*res_y, dtype=evd.ENTRY_DTYPE)
+    kinect_image[:] = tuple(evd.INVALID_POINT)
+    kinect_image["idx"] = numpy.arange(res_x*res_y)
+    kinect_image["r"] = (255*returns["r"]).astype(numpy.int64)
+    kinect_image["g"] = (255*returns["g"]).astype(numpy.int64)
+    kinect_image["b"] = (255*returns["b"]).astype(numpy.int64)
 
-    kinect_image = numpy.zeros((res_x*res_y,16))
-    kinect_image[:,3:11] = float('NaN')
-    kinect_image[:,11] = -1.0
     """Calculate the rays from the camera to the hit points of the projector rays"""
-    for i in range(len(returns)):
-        idx = returns[i][-1]
-        kinect_image[idx,12:15] = returns[i][5]
-
-        if returns[i][0] < max_distance:
-          camera_rays.extend([returns[i][1]+baseline.x, returns[i][2]+baseline.y, 
-                            returns[i][3]+baseline.z])
-          projector_ray_index[i] = idx
-
-
-    camera_returns = blensor.scan_interface.scan_rays(camera_rays, 2*max_distance, False,False,False)
+    projected = (returns["distance"] > 0.0) & (returns["distance"] < max_distance)
+    projector_ray_index = numpy.nonzero(projected)[0] # projector ray of every camera ray
+    camera_rays = projector_hits[projected] + baseline
+
+    camera_returns = blensor.scan_interface.scan_rays_array(camera_rays, 2*max_distance, False, False)
+    camera_hits = numpy.column_stack((camera_returns["x"], camera_returns["y"], camera_returns["z"]))
+    camera_ray_index = camera_returns["idx"].astype(numpy.int64)
+    projector_idx = projector_ray_index[camera_ray_index] # Get the index of the original ray
     
     evd_storage = evd.evd_file(evd_file, res_x, res_y, max_distance)
 
     all_quantized_disparities = numpy.empty(res_x*res_y)
     all_quantized_disparities[:] = INVALID_DISPARITY
     
-    disparity_weight = numpy.empty(res_x*res_y)
-    disparity_weight[:] = INVALID_DISPARITY
-
-    all_quantized_disp_mat = all_quantized_disparities.reshape(res_y,res_x)
-    disp_weight_mat = disparity_weight.reshape(res_y,res_x)
-
-    weights = numpy.array([1.0/float((1.2*x)**2+(1.2*y)**2) if x!=0 or y!=0 else 1.0 for x in range(-4,5) for y in range (-4,5)]).reshape((9,9))
-    
-    """Build a quantized disparity map"""
-    for i in range(len(camera_returns)):
-        idx = camera_returns[i][-1] 
-        projector_idx = projector_ray_index[idx] # Get the index of the original ray
-
-        if (abs(camera_rays[idx*3]-camera_returns[i][1]) < thresh and
-            abs(camera_rays[idx*3+1]-camera_returns[i][2]) < thresh and
-            abs(camera_rays[idx*3+2]-camera_returns[i][3]) < thresh and
-            abs(camera_returns[i][3]) <= max_distance and
-            abs(camera_returns[i][3]) >= min_distance):
-            """The ray hit the projected ray, so this is a valid measurement"""
-            projector_point = get_uv_from_idx(projector_idx, res_x,res_y)
-
-            camera_x = get_pixel_from_world(camera_rays[idx*3],camera_rays[idx*3+2],
-                                   flength/pixel_width) + random.gauss(noise_mu, noise_sigma)
-
-            camera_y = get_pixel_from_world(camera_rays[idx*3+1],camera_rays[idx*3+2],
-                                   flength/pixel_width)
-
-            """ Kinect calculates the disparity with an accuracy of 1/8 pixel"""
-
-            camera_x_quantized = round(camera_x*8.0)/8.0
-            
-            #I don't know if this accurately represents the kinect 
-            camera_y_quantized = round(camera_y*8.0)/8.0 
-
-            disparity_quantized = camera_x_quantized + projector_point[0]
-            if projector_idx >= 0: 
-              all_quantized_disparities[projector_idx] = disparity_quantized
+    """Build a quantized disparity map. A camera ray that hit the projected 
+       ray is a valid measurement
+    """
+    camera_rays = camera_rays[camera_ray_index]
+    valid = (numpy.all(numpy.abs(camera_rays-camera_hits) < thresh, axis=1) &
+             (numpy.abs(camera_hits[:,2]) <= max_distance) &
+             (numpy.abs(camera_hits[:,2]) >= min_distance))
+    valid_rays = camera_rays[valid]
+    valid_idx = projector_idx[valid]
+
+    camera_x = (get_pixel_from_world(valid_rays[:,0], valid_rays[:,2], flength/pixel_width) + 
+                numpy.random.normal(noise_mu, noise_sigma, len(valid_rays)))
+
+    """ Kinect calculates the disparity with an accuracy of 1/8 pixel"""
+    camera_x_quantized = numpy.round(camera_x*8.0)/8.0
+    projector_x, projector_y = get_uv_from_idx(valid_idx, res_x, res_y)
+    all_quantized_disparities[valid_idx] = camera_x_quantized + projector_x
         
     processed_disparities = numpy.empty(res_x*res_y)
-    fast_9x9_window(all_quantized_disparities, res_x, res_y, processed_disparities, noise_smooth, noise_scale)
+    fast_9x9_window(all_quantized_disparities, res_x, res_y, processed_disparities, noise_smooth, noise_scale,
+                    frame_noise_seed(scanner_object, bpy.context.scene.frame_current),
+                    scanner_object.kinect_noise_fields)
     
-    """We reuse the vector objects to spare us the object creation every
-       time
-    """
-    v = Vector([0.0,0.0,0.0])
-    vn = Vector([0.0,0.0,0.0])
     """Check if the rays of the camera meet with the rays of the projector and
-       add them as valid returns if they do"""
-    image_idx = 0
-    
-    
-    for i in range(len(camera_returns)):
-        idx = camera_returns[i][-1] 
-        projector_idx = projector_ray_index[idx] # Get the index of the original ray
-        camera_x,camera_y = get_uv_from_idx(projector_idx, res_x,res_y)
-
-        if projector_idx >= 0:
-          disparity_quantized = processed_disparities[projector_idx] 
-        else:
-          disparity_quantized = INVALID_DISPARITY
-        
-        if disparity_quantized < INVALID_DISPARITY and disparity_quantized != 0.0:
-            disparity_quantized = -disparity_quantized
-            Z_quantized = (flength*(baseline.x))/(disparity_quantized*pixel_width)
-            X_quantized = baseline.x+Z_quantized*camera_x*pixel_width/flength
-            Y_quantized = baseline.y+Z_quantized*camera_y*pixel_width/flength
-            Z_quantized = -(Z_quantized+baseline.z)
-            
-            v.xyz=[x_multiplier*(returns[idx][1]+baseline.x),\
-                   y_multiplier*(returns[idx][2]+baseline.y),\
-                   z_multiplier*(returns[idx][3]+baseline.z)]
-            vector_length = math.sqrt(v[0]**2+v[1]**2+v[2]**2)
-
-            vt = (world_transformation * v.to_4d()).xyz
-
-            vn.xyz = [x_multiplier*X_quantized,y_multiplier*Y_quantized,z_multiplier*Z_quantized]
-            vector_length_noise = vn.magnitude
-            
-            #TODO@mgschwan: prevent object creation here too
-            v_noise = (world_transformation * vn.to_4d()).xyz 
-             
-            kinect_image[projector_idx] = [ray_info[projector_idx][2], 
-               0.0, 0.0, -returns[idx][3], -Z_quantized, vt[0], 
-               vt[1], vt[2], v_noise[0], v_noise[1], v_noise[2], 
-               returns[idx][4], returns[idx][5][0], returns[idx][5][1],
-               returns[idx][5][2],projector_idx]
-            image_idx += 1
-        else:
-          """Occlusion"""
-          pass
-
-    for e in kinect_image:
-      evd_storage.addEntry(timestamp = e[0], yaw = e[1], pitch=e[2], 
-        distance=e[3], distance_noise=e[4], x=e[5], y=e[6], z=e[7], 
-        x_noise=e[8], y_noise=e[9], z_noise=e[10], object_id=e[11], 
-        color=[e[12],e[13],e[14]], idx=e[15])
+       add them as valid returns if they do, the others are occluded"""
+    disparity_quantized = processed_disparities[projector_idx] 
+    measured = (disparity_quantized < INVALID_DISPARITY) & (disparity_quantized != 0.0)
+    projector_idx = projector_idx[measured]
+    disparity_quantized = -disparity_quantized[measured]
+    camera_x, camera_y = get_uv_from_idx(projector_idx, res_x, res_y)
+
+    Z_quantized = (flength*(baseline[0]))/(disparity_quantized*pixel_width)
+    X_quantized = baseline[0]+Z_quantized*camera_x*pixel_width/flength
+    Y_quantized = baseline[1]+Z_quantized*camera_y*pixel_width/flength
+    Z_quantized = -(Z_quantized+baseline[2])
+
+    v = multiplier*(projector_hits[projector_idx]+baseline)
+    vn = multiplier*numpy.column_stack((X_quantized, Y_quantized, Z_quantized))
+    vt = scan_processing.transform_points(world_transformation, v)
+    v_noise = scan_processing.transform_points(world_transformation, vn)
+
+    measurements = kinect_image[projector_idx]
+    measurements["timestamp"] = timestamps[projector_idx]
+    measurements["yaw"] = 0.0
+    measurements["pitch"] = 0.0
+    measurements["distance"] = -projector_hits[projector_idx,2]
+    measurements["distance_noise"] = -Z_quantized
+    measurements["x"] = vt[:,0]
+    measurements["y"] = vt[:,1]
+    measurements["z"] = vt[:,2]
+    measurements["x_noise"] = v_noise[:,0]
+    measurements["y_noise"] = v_noise[:,1]
+    measurements["z_noise"] = v_noise[:,2]
+    measurements["object_id"] = returns["object_id"][projector_idx]
+    kinect_image[projector_idx] = measurements
+
+    evd_storage.addEntries(kinect_image)
         
 
     if evd_file:
         evd_storage.appendEvdFile()
     
     if not evd_storage.isEmpty():
-        scan_data = numpy.array(evd_storage.buffer)
         additional_data = None
         if scanner_object.store_data_in_mesh:
             additional_data = evd_storage.buffer
 
         if add_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,5:8], "Scan", world_transformation, buffer=additional_data)
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(), "Scan", world_transformation, buffer=additional_data, scanner=scanner_object)
 
         if add_noisy_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,8:11], "NoisyScan", world_transformation, buffer=additional_data) 
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(noisy=True), "NoisyScan", world_transformation, buffer=additional_data, scanner=scanner_object) 
 
         bpy.context.scene.update()  
         
@@ -403,7 +381,7 @@ def scan_advanced(scanner_object, evd_file=None,
 
 # This Function creates scans over a range of frames
 
-def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/kinect.evd", frame_time = (1.0/24.0), fps = 24, last_frame = True,world_transformation=Matrix()):
+def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/kinect.evd", frame_time = (1.0/24.0), fps = 24, last_frame = True,world_transformation=Matrix(), raise_errors=False):
 
 
 
@@ -411,6 +389,12 @@ def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/kinect.evd
 
     time_per_frame = 1.0 / float(fps)
 
+    if scanner_object.kinect_noise_fields > 0:
+        """Build the noise fields of the sequence before scanning"""
+        noise.precompute_noise_fields((scanner_object.kinect_xres, scanner_object.kinect_yres), 32.0,
+            sorted(set(frame_noise_seed(scanner_object, i) for i in range(frame_start, frame_end))),
+            scanner_object.kinect_noise_fields)
+
     try:
         for i in range(frame_start,frame_end):
 
@@ -423,11 +407,11 @@ def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/kinect.evd
                 break
     except:
         print ("Scan aborted")
+        if raise_errors:
+            raise
 
     if last_frame:
-        evd_file = open(filename,"a")
-        evd_file.buffer.write(struct.pack("i",-1))
-        evd_file.close()
+        evd.finish_evd_stream(filename)
 
     end_time = time.time()
     print ("Total scan time: %.2f"%(end_time-start_time))
@@ -7,6 +7,7 @@ import time
 import random
 import bpy
 import bmesh
+import numpy
 from mathutils import Vector, Euler, Matrix
 
 from blensor import evd
@@ -22,7 +23,7 @@ def tuples_to_list(tuples):
 
 # Creates and adds a mesh_object from a set of points or from a flattened 
 # list
-def add_mesh_from_points(points, name="mesh"):
+def add_mesh_from_points(points, name="mesh", scanner=None):
     flattened = points
 
     if len(points) > 0:
@@ -36,59 +37,84 @@ def add_mesh_from_points(points, name="mesh"):
     obj = bpy.data.objects.new(name, mesh)
     bpy.context.scene.objects.link(obj)
 
-    scanner = bpy.context.object
+    if scanner is None:
+      scanner = bpy.context.object
     if scanner.show_in_frame: 
       blensor.show_in_frame(obj, bpy.context.scene.frame_current)
 
 
 
+"""Vertex layers written for store_data_in_mesh, layer name and evd field"""
+DATA_LAYERS = [("color_red", "r"),
+               ("color_green", "g"),
+               ("color_blue", "b"),
+               ("object_id", "object_id"),
+               ("point_index", "idx"),
+               ("timestamp", "timestamp"),
+               ("yaw", "yaw"),
+               ("pitch", "pitch"),
+               ("distance", "distance")]
+
+
+"""Scan data kept outside of the meshes, by mesh name. A copy of the evd
+   entries is much smaller than nine float layers and is not saved with
+   the .blend file
+"""
+side_buffers = {}
+
+def store_side_buffer(mesh, buffer):
+    for name in list(side_buffers.keys()):
+        if name not in bpy.data.meshes:
+            del side_buffers[name]
+    side_buffers[mesh.name] = numpy.array(buffer, dtype=evd.ENTRY_DTYPE)
+
+"""The evd entries of a mesh that was created with a side buffer, or None"""
+def get_side_buffer(mesh):
+    return side_buffers.get(mesh.name)
+
+
 """Add a mesh from points or from a flattened list and transform it according to
    world_transformation, or according to the transformation of the camera
+
+   buffer holds the evd entries of the points, they are stored as float
+   vertex layers or, with side_buffer, in side_buffers. If side_buffer is
+   None the store_data_side_buffer setting of the scanner is used.
+   If the scanner displays scans as a sequence the points are written to
+   the cache of the sequence object instead (see scan_sequence).
+   The settings are taken from scanner, by default the active object.
 """
-def add_mesh_from_points_tf(points, name="Scan", world_transformation = Matrix(), buffer = None):
-    bm = bmesh.new()
-    for p in points:
-        bm.verts.new(p)
-
-    bm.verts.ensure_lookup_table()
-
-    if buffer:
-        color_red_id = bm.verts.layers.float.new("color_red")
-        color_green_id = bm.verts.layers.float.new("color_green")
-        color_blue_id = bm.verts.layers.float.new("color_blue")
-        object_id = bm.verts.layers.float.new("object_id")
-        object_id = bm.verts.layers.float.new("object_id")
-        point_idx_id = bm.verts.layers.float.new("point_index")
-        timestamp_id = bm.verts.layers.float.new("timestamp")
-        yaw_id = bm.verts.layers.float.new("yaw")
-        pitch_id = bm.verts.layers.float.new("pitch")
-        distance_id = bm.verts.layers.float.new("distance")
-
-        for idx,e in enumerate(buffer):
-            v = bm.verts[idx]
-            v[color_red_id] = e[12]
-            v[color_green_id] = e[13]
-            v[color_blue_id] = e[14]
-            v[object_id] = e[11]
-            v[point_idx_id] = e[15]
-            v[timestamp_id] = e[0]
-            v[yaw_id] = e[1]
-            v[pitch_id] = e[2]
-            v[distance_id] = e[3]
-            
+def add_mesh_from_points_tf(points, name="Scan", world_transformation = Matrix(), buffer = None, side_buffer = None, scanner = None):
+    points = numpy.asarray(points, dtype=numpy.float32).reshape(-1,3)
+
+    if scanner is None:
+        scanner = bpy.context.object
+    if scanner.scan_display_mode == "sequence":
+        from blensor import scan_sequence
+        matrix = scanner.matrix_world if world_transformation == Matrix() else Matrix()
+        scan_sequence.store_frame(scanner, name, points, matrix, buffer)
+        return
+
     mesh = bpy.data.meshes.new(name+"_mesh")
-    bm.to_mesh(mesh)
-    bm.free()
+    mesh.vertices.add(len(points))
+    mesh.vertices.foreach_set("co", points.ravel())
+
+    if side_buffer is None:
+        side_buffer = scanner.store_data_side_buffer
+
+    if buffer is not None:
+        if side_buffer:
+            store_side_buffer(mesh, buffer)
+        else:
+            for layer_name, field in DATA_LAYERS:
+                layer = mesh.vertex_layers_float.new(name=layer_name)
+                layer.data.foreach_set("value", numpy.asarray(buffer[field], dtype=numpy.float32))
+
     mesh.update()
     mesh_object = bpy.data.objects.new("{0}.{1}".format(name,bpy.context.scene.frame_current), mesh)
     bpy.context.scene.objects.link(mesh_object)
 
-    scanner = bpy.context.object
     if scanner.show_in_frame: 
       blensor.show_in_frame(mesh_object, bpy.context.scene.frame_current)
 
     if world_transformation == Matrix():
-       mesh_object.matrix_world = bpy.context.object.matrix_world
-
-
-
+       mesh_object.matrix_world = scanner.matrix_world
@@ -1,39 +1,56 @@
 #Taken from http://www.siafoo.net/snippet/229
 
-from numpy import array, abs, arange, dot, int8, int32, float32, floor, fromfunction,\
-                  hypot, ones, prod, random, indices, newaxis, poly1d
+from collections import OrderedDict
+
+from numpy import array, abs, arange, clip, dot, int8, int32, float32, floor, fromfunction,\
+                  hypot, ones, prod, random, indices, newaxis, poly1d, zeros
 
 
 class PerlinNoise(object):
 
     def noise(self, coords):
-
-        ijk = (floor(coords) + self.idx_ar).astype(int32)
-
-        uvw = coords - ijk
-
-        indexes = self.P[ijk[:,:, self.order - 1]]
-
-        for i in range(self.order - 1):
-            indexes = self.P[(ijk[:,:, i] + indexes) % len(self.P)]
-
-        gradiens = self.G[indexes % len(self.G)]
-#        gradiens = self.G[(ijk[:,:, 0] + indexes) % len(self.G)]
-        
-        res = (self.drop(abs(uvw)).prod(axis=2)*prod([gradiens, uvw], axis=0).sum(axis=2)).sum(axis=1)
-
-        res[res > 1.0] = 1.0
-        res[res < -1.0] = -1.0
+        coords = coords.reshape(-1, self.order)
+        base = floor(coords).astype(int32)
+        res = zeros(len(coords))
+
+        """Sum up the contribution of every corner of the grid cell one
+           after the other, this keeps the temporaries at one value per point
+        """
+        for corner in self.idx_ar:
+            ijk = base + corner
+            uvw = coords - ijk
+
+            indexes = self.P[ijk[:, self.order - 1]]
+            for i in range(self.order - 1):
+                indexes = self.P[(ijk[:, i] + indexes) % len(self.P)]
+            gradiens = self.G[indexes % len(self.G)]
+
+            weight = self.fade(uvw[:, 0])
+            contribution = gradiens[:, 0] * uvw[:, 0]
+            for i in range(1, self.order):
+                weight *= self.fade(uvw[:, i])
+                contribution += gradiens[:, i] * uvw[:, i]
+            res += weight * contribution
+
+        clip(res, -1.0, 1.0, out=res)
 
         return ((res + 1)).astype(float32)
 
+    """The drop polynomial -6t^5+15t^4-10t^3+1 of |t| in Horner form"""
+    @staticmethod
+    def fade(t):
+        t = abs(t)
+        return ((-6.0*t + 15.0)*t - 10.0)*t*t*t + 1.0
+
     def getData(self, scale=32.0):
         return self.noise(indices(self.size).reshape(self.order, 1, -1).T / scale)
 
     
-    def __init__(self, size=None, n=None):
+    def __init__(self, size=None, n=None, seed=None):
 
         n = n if n else  256        
+        """A seeded field does not touch the global random state"""
+        rand = random if seed is None else random.RandomState(seed)
         self.size = size if size else (256, 256)
 
         self.order = len(self.size)
@@ -42,7 +59,7 @@ class PerlinNoise(object):
         # because we are throwing out all the numbers not inside a unit
         # sphere.  Something of a hack but statistically speaking
         # it should work fine... or crash.
-        G = (random.uniform(size=2*self.order*n)*2 - 1).reshape(-1, self.order)
+        G = (rand.uniform(size=2*self.order*n)*2 - 1).reshape(-1, self.order)
 
         # GAH! How do I generalize this?!
         #length = hypot(G[:,i] for i in range(self.order))
@@ -57,8 +74,49 @@ class PerlinNoise(object):
         self.G = (G[length < 1] / (length[length < 1])[:,newaxis])[:n,]
         self.P = arange(n, dtype=int32)
         
-        random.shuffle(self.P)
+        rand.shuffle(self.P)
         
         self.idx_ar = indices(int32(2*ones(self.order)), dtype=int8).reshape(self.order, -1).T
         self.drop = poly1d((-6, 15, -10, 0, 0, 1.0))
 
+
+"""Noise fields by seed for a single (size, scale). Building a field
+   shuffles a new permutation table and evaluates the noise for every
+   pixel, so fields that are needed again (the same seed for the same
+   resolution) are kept. Fields of another size or scale are dropped when
+   the size or scale changes, at most max_fields are kept (oldest first
+   out)
+"""
+noise_fields = OrderedDict()
+noise_fields_key = None
+
+"""The noise field of PerlinNoise(size).getData(scale) for a seed, a seed
+   of None draws a new field from the global random state every time
+"""
+def noise_field(size, scale=32.0, seed=None, max_fields=None):
+    global noise_fields_key
+    if seed is None:
+        return PerlinNoise(size=size).getData(scale=scale)
+    key = (tuple(size), float(scale))
+    if key != noise_fields_key:
+        noise_fields.clear()
+        noise_fields_key = key
+    if seed not in noise_fields:
+        if max_fields is not None:
+            while noise_fields and len(noise_fields) >= max(1, max_fields):
+                noise_fields.popitem(last=False)
+        noise_fields[seed] = PerlinNoise(size=size, seed=seed).getData(scale=scale).astype(float32, copy=False)
+    return noise_fields[seed]
+
+"""Build the fields of all seeds in advance, e.g. a bank of fields that is
+   cycled through over a sequence
+"""
+def precompute_noise_fields(size, scale=32.0, seeds=range(16), max_fields=None):
+    for seed in seeds:
+        noise_field(size, scale, seed, max_fields)
+
+def clear_noise_fields():
+    global noise_fields_key
+    noise_fields.clear()
+    noise_fields_key = None
+
@@ -0,0 +1,198 @@
+"""Scan a range of frames with several background Blender processes
+
+   The coordinator (scan_range_parallel) splits the frames among N worker
+   processes. Every worker runs
+       blender -b scene.blend --python-expr WORKER_EXPR -- <job>
+   loads the same .blend file, sets the frame and runs dispatch_scan_range
+   for each of its frames.
+
+   Formats that write one file per frame (.pcd, .npy, .pgm, .png, depthmaps, ...)
+   are written to their final name directly. The evd format is a single
+   stream, so every frame is written to a part file in the work directory
+   and the coordinator concatenates the parts in frame order when all
+   frames are done.
+
+   A finished frame is marked with a small json file in the work directory.
+   Frames whose scan raised an error (or wrote no evd block) are not
+   marked and the worker exits with a non-zero code. If a scan is
+   interrupted or failed, running it again with resume=True only scans
+   the frames that are not marked as done.
+"""
+
+import os
+import sys
+import json
+import struct
+import subprocess
+import time
+import traceback
+
+
+WORKER_EXPR = "import blensor.parallel; blensor.parallel.worker_main()"
+
+"""Extensions of the writers that create one file per frame"""
+PER_FRAME_EXTENSIONS = [".pcd", ".numpy", ".numpy.gz", ".npy", ".npz", ".pgm", ".png"]
+
+
+def default_workdir(filename):
+    return filename + ".parts"
+
+def part_filename(workdir, frame):
+    return os.path.join(workdir, "frame%05d.evd"%frame)
+
+def done_filename(workdir, frame):
+    return os.path.join(workdir, "frame%05d.done"%frame)
+
+def is_done(workdir, frame):
+    return os.path.exists(done_filename(workdir, frame))
+
+"""The record a worker wrote for a finished frame (frame and scan time),
+   None if the frame is not done
+"""
+def frame_record(workdir, frame):
+    if not is_done(workdir, frame):
+        return None
+    with open(done_filename(workdir, frame)) as fh:
+        return json.load(fh)
+
+def is_per_frame_output(filename, scan_type):
+    if scan_type == "depthmap":
+        return True
+    return any(filename.endswith(extension) for extension in PER_FRAME_EXTENSIONS)
+
+
+"""Split the frames among the workers. Neighbouring frames go to different
+   workers so all workers progress through the sequence at the same pace
+"""
+def split_frames(frames, workers):
+    workers = max(1, min(workers, len(frames)))
+    return [frames[i::workers] for i in range(workers)]
+
+
+"""Scan the frames frame_start..frame_end (inclusive, like the scan range
+   operator) of the scanner object named scanner in blend_file.
+
+   workers is the number of Blender processes, blender the path of the
+   Blender executable (defaults to the running Blender). properties are
+   scanner properties the workers set before scanning. If seed is set,
+   frame n is scanned with the random seed seed+n (see batch.seed_random).
+   Returns the list of frames that were not completed, an empty list on
+   success.
+"""
+def scan_range_parallel(blend_file, scanner, filename, frame_start, frame_end,
+                        workers=2, blender=None, resume=True, workdir=None,
+                        output_labels=True, properties=None, seed=None):
+    if blender is None:
+        import bpy
+        blender = bpy.app.binary_path
+    if workdir is None:
+        workdir = default_workdir(filename)
+    os.makedirs(workdir, exist_ok=True)
+
+    frames = list(range(frame_start, frame_end+1))
+    if resume:
+        pending = [frame for frame in frames if not is_done(workdir, frame)]
+    else:
+        for frame in frames:
+            if is_done(workdir, frame):
+                os.remove(done_filename(workdir, frame))
+        pending = frames
+
+    print ("Scanning %d of %d frames with %d workers"%(len(pending), len(frames), workers))
+    start_time = time.time()
+
+    processes = []
+    for worker_frames in split_frames(pending, workers):
+        job = {"scanner": scanner, "filename": filename, "workdir": workdir,
+               "frames": worker_frames, "output_labels": output_labels,
+               "properties": properties or {}, "seed": seed}
+        processes.append(subprocess.Popen([blender, "-b", blend_file,
+                                           "--python-expr", WORKER_EXPR,
+                                           "--", json.dumps(job)]))
+
+    for process in processes:
+        if process.wait() != 0:
+            print ("Worker exited with code %d"%process.returncode)
+
+    missing = [frame for frame in frames if not is_done(workdir, frame)]
+    if missing:
+        print ("Frames not completed: %s"%str(missing))
+        print ("Run again with resume=True to scan the missing frames")
+    else:
+        merge_frames(workdir, filename, frames)
+
+    print ("Parallel scan time: %.3f"%(time.time()-start_time))
+    return missing
+
+
+"""Concatenate the evd part files in frame order and terminate the stream"""
+def merge_frames(workdir, filename, frames):
+    parts = [part_filename(workdir, frame) for frame in frames
+             if os.path.exists(part_filename(workdir, frame))]
+    if not parts:
+        return
+
+    with open(filename, "wb") as evd:
+        for part in parts:
+            with open(part, "rb") as fh:
+                evd.write(fh.read())
+        evd.write(struct.pack("i", -1))
+
+
+"""Entry point of a worker process, the job is the json argument after --"""
+def worker_main(argv=None):
+    import bpy
+    import blensor
+    from blensor import batch
+
+    if argv is None:
+        argv = sys.argv[sys.argv.index("--")+1:]
+    job = json.loads(argv[0])
+
+    scene = bpy.context.scene
+    obj = bpy.data.objects[job["scanner"]]
+    scene.camera = obj
+    scene.objects.active = obj
+    """Meshes added in a background process would be lost anyway"""
+    obj.add_scan_mesh = False
+    obj.add_noise_scan_mesh = False
+    for name, value in job.get("properties", {}).items():
+        setattr(obj, name, value)
+
+    time_per_frame = 1.0/(scene.render.fps / scene.render.fps_base)
+    per_frame_output = is_per_frame_output(job["filename"], obj.scan_type)
+
+    failed = []
+    for frame in job["frames"]:
+        start_time = time.time()
+        batch.seed_random(job, frame)
+        scene.frame_set(frame)
+
+        if per_frame_output:
+            target = job["filename"]
+        else:
+            target = part_filename(job["workdir"], frame)
+            """Truncate the part of an interrupted run"""
+            open(target, "wb").close()
+
+        try:
+            blensor.dispatch_scan_range(obj, target, frame=frame, last_frame=False,
+                                        time_per_frame=time_per_frame,
+                                        output_labels=job["output_labels"],
+                                        raise_errors=True)
+            """Every scanned frame writes at least the block header"""
+            if not per_frame_output and os.path.getsize(target) == 0:
+                raise RuntimeError("No evd block written")
+        except Exception:
+            traceback.print_exc()
+            print ("Worker failed frame %d"%frame)
+            failed.append(frame)
+            continue
+
+        with open(done_filename(job["workdir"], frame), "w") as fh:
+            json.dump({"frame": frame, "time": time.time()-start_time}, fh)
+        print ("Worker finished frame %d"%frame)
+
+    if failed:
+        print ("Worker failed frames: %s"%str(failed))
+        sys.exit(1)
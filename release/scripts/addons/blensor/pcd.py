@@ -1,3 +1,5 @@
+import numpy
+
 fieldnames = ["x","y","z","rgb"]
 
 class PCDObject:
@@ -52,3 +54,56 @@ class PCDObject:
 
 
 
+
+"""LZF compression for DATA binary_compressed
+
+   If the lzf module (python-lzf) is available it is used. Otherwise the
+   data is encoded with a simple LZF encoder that only uses back references
+   for repeated 32 bit words, which are the common case in point clouds
+   (invalid points, labels, colors of the same object). The result can be
+   read by every LZF decoder, i.e. by PCL.
+"""
+def lzf_compress(data):
+  try:
+    import lzf
+    compressed = lzf.compress(data)
+    if compressed is not None:
+      return compressed
+  except ImportError:
+    pass
+
+  words = numpy.frombuffer(data, dtype=numpy.uint32, count=len(data)//4)
+  repeated = numpy.zeros(len(words)+2, dtype=numpy.int8)
+  repeated[2:-1] = words[1:] == words[:-1]
+  edges = numpy.diff(repeated)
+  run_starts = numpy.nonzero(edges == 1)[0]
+  run_ends = numpy.nonzero(edges == -1)[0]
+
+  out = bytearray()
+  pos = 0
+  for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+    _lzf_literal(out, data[pos*4:start*4])
+    remaining = (end-start)*4
+    while remaining > 0:
+      length = min(remaining, 264)
+      _lzf_backref(out, 4, length)
+      remaining -= length
+    pos = end
+  _lzf_literal(out, data[pos*4:])
+  return bytes(out)
+
+def _lzf_literal(out, data):
+  for i in range(0, len(data), 32):
+    chunk = data[i:i+32]
+    out.append(len(chunk)-1)
+    out += chunk
+
+"""A back reference to the data offset bytes before, 3 <= length <= 264"""
+def _lzf_backref(out, offset, length):
+  offset -= 1
+  if length < 9:
+    out.append(((length-2) << 5) | (offset >> 8))
+  else:
+    out.append((7 << 5) | (offset >> 8))
+    out.append(length-9)
+  out.append(offset & 0xff)
@@ -0,0 +1,156 @@
+"""Batched ray pattern generation for the BlenSor scanner models.
+
+   Every function returns a tuple (rays, yaw, pitch, timestamp) of
+   C-contiguous arrays. rays is float32 (the raycaster buffer) and has one
+   row per ray (3 elements for the direction, 6 if a ray origin was
+   attached with with_origin). yaw, pitch and timestamp are float64, they
+   have one element per ray and take the place of
+   the former ray_info lists. The ray order is the same as the order of
+   the nested loops that were used before, so the ray index stored with
+   every return still refers to the same laser/pixel.
+
+   This module does not depend on bpy/mathutils so it can be used headless.
+"""
+
+import math
+import numpy
+
+
+"""yaw, pitch and timestamp end up in the (double precision) evd records
+   and stay float64. Timestamps are absolute sequence times, in float32 the
+   firings of a Velodyne would share timestamps after a few minutes
+"""
+def _as_pattern(rays, yaw, pitch, timestamp):
+    return (numpy.ascontiguousarray(rays, dtype=numpy.float32),
+            numpy.ascontiguousarray(yaw, dtype=numpy.float64),
+            numpy.ascontiguousarray(pitch, dtype=numpy.float64),
+            numpy.ascontiguousarray(timestamp, dtype=numpy.float64))
+
+
+"""Rays of a rotating multi-laser scanner (Velodyne, generic LIDAR)
+
+   laser_angles are the vertical angles of the lasers in degrees. For every
+   line between start_angle and end_angle (degrees, angle_resolution apart)
+   every laser fires once. This is the batched equivalent of rotating the
+   vector (0,0,max_distance) by Euler([-laser_angle, rot_angle, 0])
+   for every (line, laser) pair.
+"""
+def rotating(laser_angles, start_angle, end_angle, angle_resolution, time_per_step, max_distance):
+    lines = int((end_angle-start_angle)/angle_resolution)
+    laser_angles = numpy.asarray(laser_angles, dtype=numpy.float64)
+
+    rot_angle = 1e-6 + start_angle + numpy.arange(lines, dtype=numpy.float64)*angle_resolution + 180.0
+    timestamp = ((rot_angle-180.0)/angle_resolution) * time_per_step
+    rot_angle = numpy.deg2rad(rot_angle % 360.0)
+    laser_rad = numpy.deg2rad(laser_angles)
+
+    """Euler XYZ applied to the z axis reduces to these three components"""
+    cos_laser = numpy.cos(laser_rad)
+    rays = numpy.empty((lines, len(laser_angles), 3), dtype=numpy.float64)
+    rays[:,:,0] = max_distance * numpy.outer(numpy.sin(rot_angle), cos_laser)
+    rays[:,:,1] = max_distance * numpy.sin(laser_rad)[numpy.newaxis,:]
+    rays[:,:,2] = max_distance * numpy.outer(numpy.cos(rot_angle), cos_laser)
+
+    count = lines*len(laser_angles)
+    yaw = numpy.repeat(rot_angle, len(laser_angles))
+    pitch = numpy.tile(laser_rad, lines)
+    return _as_pattern(rays.reshape(count,3), yaw, pitch,
+                       numpy.repeat(timestamp, len(laser_angles)))
+
+
+"""Rays of a scanner with a rotating 45 degree mirror (Ibeo LUX)
+
+   laser_angles are in radians, start_angle, end_angle and the
+   angle_resolution in degrees. The laser is shot down onto the mirror
+   and reflected around the axis normal to the mirror and the laser.
+   The outgoing rays are unit vectors, the pitch is the outgoing vertical
+   angle of the reflected ray
+"""
+def mirror(laser_angles, start_angle, end_angle, angle_resolution, time_per_step):
+    lines = int((end_angle-start_angle)/angle_resolution)
+    laser_angles = numpy.asarray(laser_angles, dtype=numpy.float64)
+    angles = end_angle-start_angle
+    lines_f = angles/angle_resolution
+
+    current_angle = start_angle + numpy.arange(lines, dtype=numpy.float64)*angles/lines_f
+    rot_angle = 1e-6 + current_angle + 180.0
+    timestamp = ((rot_angle-180.0)/angle_resolution) * time_per_step
+    rot_angle = numpy.deg2rad(rot_angle % 360.0)
+    mirror_angle = numpy.deg2rad(current_angle)
+
+    """Ray pointing down towards the mirror rotated by the laser angle"""
+    ray = numpy.zeros((1, len(laser_angles), 3))
+    ray[0,:,1] = -numpy.cos(laser_angles)
+    ray[0,:,2] = -numpy.sin(laser_angles)
+
+    """Normal of the mirror triangle rotated around the y axis"""
+    normal = numpy.zeros((lines, 1, 3))
+    normal[:,0,0] = numpy.sin(mirror_angle)
+    normal[:,0,1] = -1.0
+    normal[:,0,2] = numpy.cos(mirror_angle)
+    normal /= math.sqrt(2.0)
+
+    cos_incoming = numpy.clip(numpy.sum(normal*ray, axis=2), -1.0, 1.0)
+    incoming_angle = numpy.arccos(cos_incoming) % (math.pi/2.0)
+
+    axis = numpy.cross(normal, ray)
+    axis_length = numpy.sqrt(numpy.sum(axis**2, axis=2))
+    """A zero length axis leaves the ray unchanged, like Matrix.Rotation"""
+    valid_axis = axis_length > 0.0
+    axis[valid_axis] /= axis_length[valid_axis][:,numpy.newaxis]
+    theta = numpy.where(valid_axis, 2.0*incoming_angle, 0.0)[:,:,numpy.newaxis]
+
+    """Rodrigues rotation, the axis is perpendicular to the ray"""
+    ray = numpy.broadcast_to(ray, axis.shape)
+    rays = ray*numpy.cos(theta) + numpy.cross(axis, ray)*numpy.sin(theta)
+
+    count = lines*len(laser_angles)
+    pitch = (math.pi/4.0 - incoming_angle).reshape(count)
+    return _as_pattern(rays.reshape(count,3), numpy.repeat(rot_angle, len(laser_angles)),
+                       pitch, numpy.repeat(timestamp, len(laser_angles)))
+
+
+"""Rays of a pinhole camera (ToF, Kinect)
+
+   A ray originates at the principal point and points to the center of
+   every pixel on the sensor, scaled to max_distance. pixel_width,
+   pixel_height and flength have to be in the same unit.
+   If x_major is True the rays are ordered
+       for x in range(res_x):
+         for y in range(res_y):
+   otherwise they are ordered row by row.
+"""
+def pinhole(res_x, res_y, pixel_width, pixel_height, flength, max_distance, timestamp=0.0, x_major=False):
+    cx = float(res_x) / 2.0
+    cy = float(res_y) / 2.0
+    physical_x = (numpy.arange(res_x, dtype=numpy.float64)-cx) * pixel_width
+    physical_y = (numpy.arange(res_y, dtype=numpy.float64)-cy) * pixel_height
+
+    if x_major:
+        px, py = numpy.meshgrid(physical_x, physical_y, indexing="ij")
+    else:
+        px, py = numpy.meshgrid(physical_x, physical_y, indexing="xy")
+    px = px.ravel()
+    py = py.ravel()
+
+    rays = numpy.empty((len(px), 3), dtype=numpy.float64)
+    rays[:,0] = px
+    rays[:,1] = py
+    rays[:,2] = -float(flength)
+    rays *= (max_distance / numpy.sqrt(numpy.sum(rays**2, axis=1)))[:,numpy.newaxis]
+
+    """ pitch and yaw are added for completeness, normally they are
+        not provided by a camera but can be derived from the pixel
+        position and the camera parameters.
+    """
+    yaw = numpy.arctan(px/flength)
+    pitch = numpy.arctan(py/flength)
+    return _as_pattern(rays, yaw, pitch, numpy.full(len(px), timestamp))
+
+
+"""Attach the same origin to every ray and return an N x 6 ray array"""
+def with_origin(rays, origin):
+    result = numpy.empty((len(rays), 6), dtype=numpy.float32)
+    result[:,0:3] = rays[:,0:3]
+    result[:,3:6] = numpy.asarray(origin, dtype=numpy.float32)
+    return result
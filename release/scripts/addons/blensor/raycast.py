@@ -4,47 +4,252 @@
 Created on Mon Dec  4 20:56:13 2017
 
 @author: anne
+
+Ray/triangle intersection in pure numpy. All functions work on batches of
+rays and triangles and do not need bpy, so scans can be computed headless
+(regression tests, workers without blender).
+
+triangles are T x 3 x 3 arrays (triangle, vertex, coordinate), origins and
+directions are N x 3 arrays or a single 3 element origin for all rays.
+Directions do not have to be normalized, distances are always euclidean.
+Rays that do not hit anything get a distance of inf and a face index of -1.
 """
 import numpy as np
 
 machineEpsilon = np.finfo(float).eps
 
+"""Maximum number of ray/triangle pairs that are intersected at once"""
+CHUNK_SIZE = 1 << 18
+
+
 def ray_triangle_intersection(ray_near, ray_dir, v1, v2, v3):
     """
-    Möller–Trumbore intersection algorithm in pure python
+    Möller–Trumbore intersection algorithm in numpy
     Based on http://en.wikipedia.org/wiki/M%C3%B6ller%E2%80%93Trumbore_intersection_algorithm
-    
+
     Implementation taken from https://github.com/kliment/Printrun/blob/master/printrun/stltool.py
-    
+
+    All arguments are arrays whose last axis holds the coordinates, the
+    other axes are broadcast against each other. Returns a boolean hit
+    array and the ray parameter t (inf where nothing was hit).
     """
-    rows = 1
-    if len(v1.shape) == 2:
-        rows = v1.shape[1]
-    
-    invalids = np.ones ((rows), dtype=np.bool)
     eps = machineEpsilon
     edge1 = v2 - v1
     edge2 = v3 - v1
     pvec = np.cross(ray_dir, edge2)
-    det = edge1.dot(pvec)
-    if abs(det) < eps:
-        return False, None
-    inv_det = 1. / det
+    det = np.sum(edge1 * pvec, axis=-1)
+    parallel = np.abs(det) < eps
+    inv_det = 1. / np.where(parallel, 1., det)
     tvec = ray_near - v1
-    u = tvec.dot(pvec) * inv_det
-    if u < 0. or u > 1.:
-        return False, None
-    qvec = numpy.cross(tvec, edge1)
-    v = ray_dir.dot(qvec) * inv_det
-    if v < 0. or u + v > 1.:
-        return False, None
+    u = np.sum(tvec * pvec, axis=-1) * inv_det
+    qvec = np.cross(tvec, edge1)
+    v = np.sum(ray_dir * qvec, axis=-1) * inv_det
+    t = np.sum(edge2 * qvec, axis=-1) * inv_det
+
+    hit = ~parallel & (u >= 0.) & (u <= 1.) & (v >= 0.) & (u + v <= 1.) & (t >= eps)
+    return hit, np.where(hit, t, np.inf)
+
+
+def _prepare_rays(origins, directions):
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1,3)
+    origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), directions.shape)
+    length = np.sqrt(np.sum(directions**2, axis=1))
+    length[length == 0.] = 1.
+    return origins, directions / length[:,np.newaxis]
+
+
+def _as_triangles(triangles):
+    return np.asarray(triangles, dtype=np.float64).reshape(-1,3,3)
+
+
+def closest_triangle_intersection(origins, directions, triangles, max_distance=np.inf):
+    """
+    Intersect every ray with every triangle and keep the closest hit.
+    The work is split into chunks of at most CHUNK_SIZE ray/triangle pairs.
+    Returns the distances and face indices of the closest hits.
+    """
+    origins, directions = _prepare_rays(origins, directions)
+    triangles = _as_triangles(triangles)
+
+    count = len(directions)
+    distances = np.full(count, np.inf)
+    faces = np.full(count, -1, dtype=np.int64)
+    if count == 0 or len(triangles) == 0:
+        return distances, faces
+
+    triangle_chunk = min(len(triangles), CHUNK_SIZE)
+    ray_chunk = max(1, CHUNK_SIZE // triangle_chunk)
+
+    for first_triangle in range(0, len(triangles), triangle_chunk):
+        tris = triangles[first_triangle:first_triangle+triangle_chunk]
+        v1 = tris[np.newaxis,:,0]
+        v2 = tris[np.newaxis,:,1]
+        v3 = tris[np.newaxis,:,2]
+        for first_ray in range(0, count, ray_chunk):
+            rays = slice(first_ray, first_ray+ray_chunk)
+            hit, t = ray_triangle_intersection(origins[rays,np.newaxis], directions[rays,np.newaxis], v1, v2, v3)
+            nearest = np.argmin(t, axis=1)
+            t = t[np.arange(len(nearest)), nearest]
+            closer = t < distances[rays]
+            distances[rays][closer] = t[closer]
+            faces[rays][closer] = nearest[closer] + first_triangle
+
+    too_far = distances > max_distance
+    distances[too_far] = np.inf
+    faces[too_far] = -1
+    return distances, faces
+
+
+def face_normals(triangles):
+    """
+    Unit normals of the triangles, (v2-v1) x (v3-v1) like Blender and
+    BVHTree compute them. Degenerate triangles get a zero normal.
+    """
+    triangles = _as_triangles(triangles)
+    normals = np.cross(triangles[:,1] - triangles[:,0], triangles[:,2] - triangles[:,0])
+    length = np.sqrt(np.sum(normals**2, axis=1))
+    length[length == 0.] = 1.
+    return normals / length[:,np.newaxis]
+
+
+def transform_normals(normals, matrix):
+    """
+    Transform N x 3 normals with the inverse transpose of the upper 3x3 of
+    matrix (object to world), so they stay perpendicular to the surface
+    under non-uniform scaling, and normalize them again. A mirroring
+    matrix flips the winding of the triangles, the normals are flipped
+    with it so they match face_normals of the transformed triangles.
+    """
+    rotation = np.asarray(matrix, dtype=np.float64)[0:3,0:3]
+    inverse = np.linalg.inv(rotation)
+    if np.linalg.det(rotation) < 0.:
+        inverse = -inverse
+    normals = np.dot(np.asarray(normals, dtype=np.float64).reshape(-1,3), inverse)
+    length = np.sqrt(np.sum(normals**2, axis=1))
+    length[length == 0.] = 1.
+    return normals / length[:,np.newaxis]
+
+
+class UniformGrid:
+    """
+    Uniform grid accelerator for closest_triangle_intersection.
+
+    Every triangle is stored in all cells its bounding box overlaps. Rays
+    walk through the grid cell by cell (3D-DDA), all rays advance in
+    lockstep so every step is a single batch of ray/triangle pairs. A ray
+    stops at the first cell that contains a hit.
+
+    density is the number of cells per triangle, the resolution per
+    axis is limited by max_resolution.
+    """
+    def __init__(self, triangles, density=2.0, max_resolution=128):
+        self.triangles = _as_triangles(triangles)
+        count = len(self.triangles)
+
+        if count > 0:
+            triangle_lo = self.triangles.min(axis=1)
+            triangle_hi = self.triangles.max(axis=1)
+            lo = triangle_lo.min(axis=0)
+            hi = triangle_hi.max(axis=0)
+        else:
+            triangle_lo = triangle_hi = np.zeros((0,3))
+            lo = hi = np.zeros(3)
+
+        pad = 1e-6 * max(1., np.max(hi-lo))
+        self.lo = lo - pad
+        self.hi = hi + pad
+        extent = self.hi - self.lo
+
+        """Flat axes must not collapse the cell volume"""
+        volume = np.prod(np.maximum(extent, 1e-3*np.max(extent)))
+        cell_size = (volume / (density*max(count,1)))**(1./3.)
+        self.resolution = np.clip(np.ceil(extent/cell_size), 1, max_resolution).astype(np.int64)
+        self.cell_size = extent / self.resolution
+
+        first = self._cell(triangle_lo)
+        span = self._cell(triangle_hi) - first + 1
+        counts = np.prod(span, axis=1)
+        triangle = np.repeat(np.arange(count), counts)
+        k = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts)-counts, counts)
+        sx = span[triangle,0]
+        sy = span[triangle,1]
+        cell = self._flat(first[triangle] + np.stack((k % sx, (k // sx) % sy, k // (sx*sy)), axis=1))
+
+        order = np.argsort(cell, kind="mergesort")
+        self.cell_triangles = triangle[order]
+        self.cell_start = np.searchsorted(cell[order], np.arange(np.prod(self.resolution)+1))
+
+    def _cell(self, points):
+        cell = np.floor((points - self.lo) / self.cell_size).astype(np.int64)
+        return np.clip(cell, 0, self.resolution-1)
+
+    def _flat(self, cell):
+        return (cell[:,2]*self.resolution[1] + cell[:,1])*self.resolution[0] + cell[:,0]
+
+    def closest_intersection(self, origins, directions, max_distance=np.inf):
+        """Same as closest_triangle_intersection for the triangles of the grid"""
+        origins, directions = _prepare_rays(origins, directions)
+        count = len(directions)
+        distances = np.full(count, np.inf)
+        faces = np.full(count, -1, dtype=np.int64)
+        if count == 0 or len(self.triangles) == 0:
+            return distances, faces
+
+        """Clip the rays against the grid bounds"""
+        parallel = directions == 0.
+        inside = (origins >= self.lo) & (origins <= self.hi)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t0 = (self.lo - origins) / directions
+            t1 = (self.hi - origins) / directions
+        t0 = np.where(parallel, np.where(inside, -np.inf, np.inf), t0)
+        t1 = np.where(parallel, np.where(inside, np.inf, -np.inf), t1)
+        t_enter = np.maximum(np.max(np.minimum(t0, t1), axis=1), 0.)
+        t_leave = np.min(np.maximum(t0, t1), axis=1)
+        active = (t_enter <= t_leave) & (t_enter <= max_distance)
+
+        cell = self._cell(origins + directions*t_enter[:,np.newaxis])
+        step = np.sign(directions).astype(np.int64)
+        with np.errstate(divide="ignore"):
+            t_delta = np.where(parallel, np.inf, self.cell_size / np.abs(directions))
+            boundary = self.lo + (cell + (step > 0)) * self.cell_size
+            t_next = np.where(parallel, np.inf, (boundary - origins) / np.where(parallel, 1., directions))
+
+        v1 = self.triangles[:,0]
+        v2 = self.triangles[:,1]
+        v3 = self.triangles[:,2]
+        while np.any(active):
+            rays = np.nonzero(active)[0]
+            t_exit = np.min(t_next[rays], axis=1)
 
-    t = edge2.dot(qvec) * inv_det
-    if t < eps:
-        return False, None
+            """All ray/triangle pairs of the current cells"""
+            flat = self._flat(cell[rays])
+            start = self.cell_start[flat]
+            counts = self.cell_start[flat+1] - start
+            pair_ray = np.repeat(rays, counts)
+            pair_exit = np.repeat(t_exit, counts)
+            pair_triangle = self.cell_triangles[np.repeat(start, counts) +
+                    np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts)-counts, counts)]
 
-    return True, t
+            for first in range(0, len(pair_ray), CHUNK_SIZE):
+                pairs = slice(first, first+CHUNK_SIZE)
+                r = pair_ray[pairs]
+                tri = pair_triangle[pairs]
+                hit, t = ray_triangle_intersection(origins[r], directions[r], v1[tri], v2[tri], v3[tri])
+                """Hits behind the cell are found again in a later cell"""
+                t[t > pair_exit[pairs] + 1e-9] = np.inf
+                np.minimum.at(distances, r, t)
+                closest = np.isfinite(t) & (t == distances[r])
+                faces[r[closest]] = tri[closest]
 
-#def closest_triangle_intersection(origin, ray_dir, triangles):
-    
+            """Advance the rays without a hit to the next cell"""
+            axis = np.argmin(t_next[rays], axis=1)
+            cell[rays, axis] += step[rays, axis]
+            t_next[rays, axis] += t_delta[rays, axis]
+            in_grid = np.all((cell[rays] >= 0) & (cell[rays] < self.resolution), axis=1)
+            active[rays] = (np.isinf(distances[rays]) & in_grid &
+                            (t_exit <= max_distance) & (t_exit <= t_leave[rays]))
 
+        too_far = distances > max_distance
+        distances[too_far] = np.inf
+        faces[too_far] = -1
+        return distances, faces
@@ -2,11 +2,10 @@ import math
 import sys
 import traceback
 import os
-import struct 
-import ctypes
 import time
 import random
 import bpy
+import numpy
 from mathutils import Vector, Euler
 import blensor.scan_interface_pure
 
@@ -23,85 +22,353 @@ except:
 ELEMENTS_PER_RETURN = 8
 SIZEOF_FLOAT = 4
 
+"""Layout of a single return. The first ELEMENTS_PER_RETURN fields are
+   written by the raycaster, idx is the index of the ray that produced the
+   return. A return buffer of this type is handed to the raycaster
+   directly, there is no intermediate copy.
+"""
+RETURN_DTYPE = numpy.dtype([("distance", numpy.float32),
+                            ("x", numpy.float32),
+                            ("y", numpy.float32),
+                            ("z", numpy.float32),
+                            ("object_id", numpy.uint32),
+                            ("r", numpy.float32),
+                            ("g", numpy.float32),
+                            ("b", numpy.float32),
+                            ("idx", numpy.uint32)])
+
+
+""" rays is a C-contiguous float32 array with 3 (direction) or 6 
+         (direction, origin) columns
+    max_distance is a float that determines the maximum distance a ray can travel
+    keep_render_setup is passed to the blender internal code to keep the renderer
+    setup for additional calls
+    threads is the number of threads the native raycaster uses, 0 uses the
+    render threads of the scene
+
+    adaptive_step, adaptive_bin_size and adaptive_margin enable adaptive
+    ray casting (see cast_rays_adaptive), an adaptive_step of 0 or 1 casts
+    every ray
+
+    Returns a structured array of type RETURN_DTYPE. If return_all is set
+    the result is the return buffer that was written by the raycaster, with
+    one entry per ray. Otherwise only the valid returns are gathered.
+"""
+def scan_rays_array(rays, max_distance, keep_render_setup=False, do_shading=True, return_all = False, inv_scan_x = False, inv_scan_y = False, inv_scan_z = False, threads = 0,
+                    adaptive_step = 0, adaptive_bin_size = 2.0, adaptive_margin = 1):
+    rays = numpy.ascontiguousarray(rays, dtype=numpy.float32)
+    if rays.ndim != 2 or rays.shape[1] not in (3,6):
+        raise ValueError("rays must be an N x 3 or N x 6 array")
+
+    numberOfRays, elementsPerRay = rays.shape
+
+    returns_buffer = numpy.zeros(numberOfRays, dtype=RETURN_DTYPE)
+    returns_buffer["idx"] = numpy.arange(numberOfRays, dtype=numpy.uint32)
+   
+    print ("Raycount: ", numberOfRays)
+    if numberOfRays == 0:
+        return returns_buffer
+
+    if adaptive_step > 1:
+        cast_rays_adaptive(rays, max_distance, returns_buffer, keep_render_setup, do_shading, threads,
+                           adaptive_step, adaptive_bin_size, adaptive_margin)
+    else:
+        cast_rays_into(rays, max_distance, returns_buffer, keep_render_setup, do_shading, threads)
+
+    multiplier = numpy.array([-1.0 if inv_scan_x else 1.0,
+                              -1.0 if inv_scan_y else 1.0,
+                              -1.0 if inv_scan_z else 1.0], dtype=numpy.float32)
+
+    print ("X: %f Y: %f Z: %f"%tuple(multiplier))
+
+    distance = returns_buffer["distance"]
+    if return_all:
+        returns = returns_buffer
+    else:
+        returns = returns_buffer[(distance < max_distance) & (distance > 0.0)]
+        distance = returns["distance"]
+
+    #The ray may have been reflected and refracted. But the laser
+    #does not know that so we need to calculate the point which
+    #is the measured distance away from the sensor but without
+    #beeing reflected/refracted. We use the original ray direction
+    directions = rays[returns["idx"],0:3]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        scale = distance / numpy.sqrt(numpy.sum(directions**2, axis=1))
+    scale[distance <= 0.0] = float('NaN')
+    returns["x"] = multiplier[0] * scale * directions[:,0]
+    returns["y"] = multiplier[1] * scale * directions[:,1]
+    returns["z"] = multiplier[2] * scale * directions[:,2]
+
+    return returns
+
+
+"""Cast the rays with the native or the pure python raycaster and write
+   the returns into returns_buffer (one entry per ray)
+"""
+def cast_rays_into(rays, max_distance, returns_buffer, keep_render_setup, do_shading, threads):
+    numberOfRays, elementsPerRay = rays.shape
+    if blensorintern:
+        cast_rays = rays
+        if shared_setup is not None:
+            keep_render_setup = True
+            cast_rays = shared_setup.transform_rays(rays)
+        blensorintern.scan_buffer(numberOfRays, max_distance, cast_rays.shape[1], keep_render_setup, do_shading,
+              cast_rays, returns_buffer, threads)
+    else:
+        blensor.scan_interface_pure.scan(numberOfRays, max_distance, elementsPerRay, keep_render_setup, do_shading,
+              rays.ravel(), returns_buffer.view(numpy.float32), RETURN_DTYPE.itemsize // SIZEOF_FLOAT)
+
+
+"""Cast the rays with the given indices into the matching entries of
+   returns_buffer
+"""
+def cast_ray_subset(rays, indices, max_distance, returns_buffer, keep_render_setup, do_shading, threads):
+    subset_buffer = numpy.zeros(len(indices), dtype=RETURN_DTYPE)
+    subset_buffer["idx"] = indices
+    cast_rays_into(numpy.ascontiguousarray(rays[indices]), max_distance, subset_buffer,
+                   keep_render_setup, do_shading, threads)
+    returns_buffer[indices] = subset_buffer
+
+
+"""Index of the angular bin of every ray direction and the shape
+   (elevation, azimuth) of the bin grid. The azimuth is measured around
+   the y axis, which is the up axis of the scanners
+"""
+def angular_bins(directions, bin_size):
+    directions = numpy.asarray(directions, dtype=numpy.float64)
+    bin_size = math.radians(bin_size)
+    azimuth = numpy.arctan2(directions[:,0], directions[:,2]) + math.pi
+    elevation = numpy.arctan2(directions[:,1], numpy.hypot(directions[:,0], directions[:,2])) + 0.5*math.pi
+
+    shape = (int(math.ceil(math.pi/bin_size)), int(math.ceil(2.0*math.pi/bin_size)))
+    azimuth_bin = numpy.minimum((azimuth/bin_size).astype(numpy.int64), shape[1]-1)
+    elevation_bin = numpy.minimum((elevation/bin_size).astype(numpy.int64), shape[0]-1)
+    return elevation_bin*shape[1] + azimuth_bin, shape
+
+
+"""Grow the occupied bins by margin bins in every direction, the azimuth
+   wraps around
+"""
+def dilate_bins(occupied, margin):
+    for _ in range(margin):
+        grown = occupied.copy()
+        grown |= numpy.roll(occupied, 1, axis=1)
+        grown |= numpy.roll(occupied, -1, axis=1)
+        grown[1:] |= occupied[:-1]
+        grown[:-1] |= occupied[1:]
+        occupied = grown
+    return occupied
+
+
+"""Adaptive coarse to fine ray casting
+
+   The ray directions are sorted into angular bins of bin_size degrees and
+   every step-th ray of each bin is cast first. The remaining rays are only
+   cast in bins where a coarse ray returned a hit within max_distance,
+   grown by margin bins. All other rays are treated as misses, so scans
+   with a lot of sky or out of range directions cast only a fraction of
+   the rays.
+
+   Objects that are smaller than the coarse ray spacing and lie in an
+   empty bin next to no other geometry can be missed; a smaller step or a
+   larger margin make the scan more conservative. With a step of 1 the
+   result is the same as a full scan.
+   The bins are computed from the ray directions only, the rays should
+   have a common origin.
+"""
+def cast_rays_adaptive(rays, max_distance, returns_buffer, keep_render_setup, do_shading, threads,
+                       step, bin_size=2.0, margin=1):
+    bins, shape = angular_bins(rays[:,0:3], bin_size)
+
+    """Rank of every ray within its bin, in ray order"""
+    order = numpy.argsort(bins, kind="mergesort")
+    sorted_bins = bins[order]
+    bin_start = numpy.searchsorted(sorted_bins, sorted_bins)
+    is_coarse = numpy.zeros(len(rays), dtype=bool)
+    is_coarse[order] = (numpy.arange(len(rays)) - bin_start) % step == 0
+    coarse = numpy.nonzero(is_coarse)[0].astype(numpy.uint32)
+
+    """The fine pass reuses the render setup of the coarse pass"""
+    cast_ray_subset(rays, coarse, max_distance, returns_buffer, True, do_shading, threads)
+
+    distance = returns_buffer["distance"][coarse]
+    hits = coarse[(distance > 0.0) & (distance < max_distance)]
+
+    occupied = numpy.zeros(shape[0]*shape[1], dtype=bool)
+    occupied[bins[hits]] = True
+    occupied = dilate_bins(occupied.reshape(shape), margin).ravel()
+
+    fine = numpy.nonzero(occupied[bins] & ~is_coarse)[0].astype(numpy.uint32)
+
+    print ("Adaptive scan: %d coarse rays, %d of %d remaining rays cast"%(len(coarse), len(fine), len(rays)-len(coarse)))
+    if len(fine) > 0:
+        cast_ray_subset(rays, fine, max_distance, returns_buffer, keep_render_setup, do_shading, threads)
+    elif not keep_render_setup and shared_setup is None and blensorintern:
+        blensorintern.free_render_setup()
+
+
+"""Keyword arguments of scan_rays_array for the adaptive ray casting
+   settings of a scanner object
+"""
+def adaptive_scan_args(scanner_object):
+    return {"adaptive_step": scanner_object.adaptive_scan_step,
+            "adaptive_bin_size": scanner_object.adaptive_scan_bin_size,
+            "adaptive_margin": scanner_object.adaptive_scan_margin}
+
+
+"""Rolling shutter scan of a sweep of rays
+
+   rays and timestamps are ordered by time, like the patterns of
+   ray_pattern. The sweep is split into time_slices slices of equal
+   duration and every slice is cast against the scene evaluated at the
+   (fractional) frame of its middle timestamp, the first ray is fired at
+   the current frame. Moving objects and a moving scanner are therefore
+   skewed like in a real scan.
+   The scene is converted only once per sweep: the native raycaster keeps
+   the render setup of the first slice and only moves the objects that
+   were transformed (see blensor_update_render_setup), the rays are
+   transformed into the camera space of the first slice like the rays of
+   a rig scan. The pure python raycaster only updates the matrices of
+   moved objects. Deforming meshes keep the shape of the first slice.
+
+   If the scanner does not write local coordinates the world
+   transformation of every slice is the scanner matrix at that time.
+   Returns a list of (returns, world_transformation) tuples, the idx of
+   the returns refers to the rays of the whole sweep. The remaining
+   arguments are passed to scan_rays_array.
+"""
+def scan_rays_sliced(scanner_object, rays, timestamps, time_slices, max_distance, world_transformation, **scan_args):
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    if time_slices <= 1 or len(timestamps) < 2:
+        return [(scan_rays_array(rays, max_distance, **scan_args), world_transformation)]
+
+    scene = bpy.context.scene
+    frame = scene.frame_current
+    subframe = scene.frame_subframe
+    fps = scene.render.fps / scene.render.fps_base
+
+    elapsed = timestamps - timestamps[0]
+    duration = max(elapsed[-1], 1e-12)
+    slice_index = numpy.minimum((elapsed / duration * time_slices).astype(numpy.int64), time_slices-1)
+    bounds = numpy.searchsorted(slice_index, numpy.arange(time_slices+1))
+
+    """Keep the render setup for all slices unless a rig scan already does"""
+    own_setup = shared_setup is None
+    if own_setup:
+        begin_shared_render_setup()
+
+    results = []
+    try:
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if first == last:
+                continue
+            slice_frame = frame + subframe + 0.5*(elapsed[first]+elapsed[last-1]) * fps
+            scene.frame_set(int(math.floor(slice_frame)), slice_frame - math.floor(slice_frame))
+
+            returns = scan_rays_array(rays[first:last], max_distance, **scan_args)
+            returns["idx"] += numpy.uint32(first)
+
+            if scanner_object.local_coordinates:
+                results.append((returns, world_transformation))
+            else:
+                results.append((returns, scanner_object.matrix_world.copy()))
+    finally:
+        if own_setup:
+            end_shared_render_setup()
+        scene.frame_set(frame, subframe)
+
+    return results
+
+
+"""Render setup shared by several scans of the same frame
+
+   The native raycaster converts the whole scene into a render database and
+   raytree for every scan. Between begin_shared_render_setup and
+   end_shared_render_setup all scans keep and reuse the setup of the first
+   scan, so a rig of sensors converts the scene only once per frame.
+
+   The raytree is in the view space of the camera that was active for the
+   first scan. The rays of other sensors are transformed into that space,
+   the returns are still computed from the original rays, so every sensor
+   gets its results in its own coordinate system.
+"""
+class SharedRenderSetup:
+    def __init__(self):
+        self.reference = None
+        self.frame = None
+
+    def transform_rays(self, rays):
+        scene = bpy.context.scene
+        camera = normalized_matrix(scene.camera.matrix_world)
+        """The native code rebuilds the setup if the frame changed, for
+           another subframe it only moves the objects and keeps the view
+           space of the setup
+        """
+        frame = scene.frame_current
+        if self.reference is None or self.frame != frame:
+            self.reference = camera
+            self.frame = frame
+            return rays
+
+        transform = numpy.dot(numpy.linalg.inv(self.reference), camera)
+        if numpy.allclose(transform, numpy.identity(4)):
+            return rays
+
+        cast_rays = numpy.empty((len(rays),6), dtype=numpy.float32)
+        cast_rays[:,0:3] = numpy.dot(rays[:,0:3], transform[0:3,0:3].T)
+        cast_rays[:,3:6] = transform[0:3,3]
+        if rays.shape[1] >= 6:
+            cast_rays[:,3:6] += numpy.dot(rays[:,3:6], transform[0:3,0:3].T)
+        return cast_rays
+
+
+"""The camera matrix without scale, like the view matrix of the renderer"""
+def normalized_matrix(matrix):
+    matrix = numpy.array(matrix, dtype=numpy.float64)
+    matrix[0:3,0:3] /= numpy.sqrt(numpy.sum(matrix[0:3,0:3]**2, axis=0))
+    return matrix
+
+
+shared_setup = None
+
+def begin_shared_render_setup():
+    global shared_setup
+    end_shared_render_setup()
+    shared_setup = SharedRenderSetup()
+
+def end_shared_render_setup():
+    global shared_setup
+    shared_setup = None
+    if blensorintern:
+        blensorintern.free_render_setup()
+
+
 """ rays is an array of vectors that describe the laser direction and also the
          ray origin if the ray_origin field is setp
     max_distance is a float that determines the maximum distance a ray can travel
     keep_render_setup is passed to the blender internal code to keep the renderer
     setup for additional calls
+
+    Returns a list of [distance, x, y, z, object_id, (r, g, b), ray_index]
+    entries. New code should use scan_rays_array instead.
 """
-def scan_rays(rays, max_distance, ray_origins=False, keep_render_setup=False, do_shading=True, return_all = False, inv_scan_x = False, inv_scan_y = False, inv_scan_z = False):
+def scan_rays(rays, max_distance, ray_origins=False, keep_render_setup=False, do_shading=True, return_all = False, inv_scan_x = False, inv_scan_y = False, inv_scan_z = False, threads = 0):
 
     elementsPerRay = 3
     if ray_origins == True:
       elementsPerRay = 6
   
+    rays = numpy.asarray(rays, dtype=numpy.float32).ravel()
     numberOfRays = int(len(rays)/elementsPerRay)
 
-
-    rays_buffer = (ctypes.c_float * numberOfRays*elementsPerRay)()
-    struct.pack_into("%df"%(numberOfRays*elementsPerRay), rays_buffer, 0, *rays[:numberOfRays*elementsPerRay])
-
-    returns_buffer = (ctypes.c_float * (numberOfRays * ELEMENTS_PER_RETURN))()
-   
-    print ("Raycount: ", numberOfRays)
-    
-    returns_buffer_uint = ctypes.cast(returns_buffer, ctypes.POINTER(ctypes.c_uint))
+    returns = scan_rays_array(rays[:numberOfRays*elementsPerRay].reshape(numberOfRays, elementsPerRay),
+                              max_distance, keep_render_setup, do_shading, return_all, 
+                              inv_scan_x, inv_scan_y, inv_scan_z, threads)
 
     array_of_returns = []
-    if True:
-    #try:
-      if blensorintern:
-          blensorintern.scan(numberOfRays, max_distance, elementsPerRay, keep_render_setup, do_shading,                 
-                "%016X"%(ctypes.addressof(rays_buffer)), "%016X"%(ctypes.addressof(returns_buffer)))
-      else:
-          blensor.scan_interface_pure.scan(numberOfRays, max_distance, elementsPerRay, keep_render_setup, do_shading,                 
-                rays, returns_buffer, ELEMENTS_PER_RETURN)
-
-
-      x_multiplier = -1.0 if inv_scan_x else 1.0
-      y_multiplier = -1.0 if inv_scan_y else 1.0
-      z_multiplier = -1.0 if inv_scan_z else 1.0
-
-      print ("X: %f Y: %f Z: %f"%(x_multiplier,y_multiplier,z_multiplier))
-
-      for idx in range(numberOfRays):
-          if return_all or (returns_buffer[idx*ELEMENTS_PER_RETURN] < max_distance and returns_buffer[idx*ELEMENTS_PER_RETURN]>0.0 ):
-              ret = [ float(returns_buffer[e + idx*ELEMENTS_PER_RETURN]) for e in range(4) ]            
-              ret[1] = float('NaN')
-              ret[2] = float('NaN')
-              ret[3] = float('NaN')
-              
-              if returns_buffer[idx*ELEMENTS_PER_RETURN] > 0.0:
-                #The ray may have been reflected and refracted. But the laser
-                #does not know that so we need to calculate the point which
-                #is the measured distance away from the sensor but without
-                #beeing reflected/refracted. We use the original ray direction
-                vec = [float(rays[idx*elementsPerRay]), 
-                       float(rays[idx*elementsPerRay+1]),
-                       float(rays[idx*elementsPerRay+2])]
-                veclen = math.sqrt(vec[0]**2+vec[1]**2+vec[2]**2)
-                raydistance = float(returns_buffer[idx*ELEMENTS_PER_RETURN])
-                vec[0] = x_multiplier * raydistance * vec[0]/veclen
-                vec[1] = y_multiplier * raydistance * vec[1]/veclen
-                vec[2] = z_multiplier * raydistance * vec[2]/veclen
-
-
-                ret[1] = vec[0]
-                ret[2] = vec[1]
-                ret[3] = vec[2]
-              ret.append(returns_buffer_uint[idx*ELEMENTS_PER_RETURN+4]) #objectid
-              ret.append((returns_buffer[idx*ELEMENTS_PER_RETURN+5],
-                          returns_buffer[idx*ELEMENTS_PER_RETURN+6],
-                          returns_buffer[idx*ELEMENTS_PER_RETURN+7])) # RGB Value of the material
-              ret.append(idx) # Store the index per return as the last element
-              array_of_returns.append(ret)
-    #except TypeError as e:
-    #  exc_type, exc_value, exc_traceback = sys.exc_info()
-    #  traceback.print_tb(exc_traceback)
-    #finally:
-    #  del rays_buffer
-    #  del returns_buffer
+    for ret in returns.tolist():
+        array_of_returns.append([ret[0], ret[1], ret[2], ret[3], ret[4], 
+                                 (ret[5], ret[6], ret[7]), ret[8]])
 
     return array_of_returns
-    
-
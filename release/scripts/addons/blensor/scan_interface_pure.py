@@ -1,23 +1,67 @@
 import bpy
-from mathutils import Matrix, Vector
+from bpy.app.handlers import persistent
 from mathutils.bvhtree import BVHTree
 import numpy as np
 
+from blensor import raycast
+
+"""The scanner casts rays against per object uniform grids (raycast.py),
+   set this to True to use a BVHTree of the whole scene and cast the rays
+   one by one instead
+"""
+USE_BVHTREE = False
+
 machineEpsilon = np.finfo(float).eps
 
 
 # Calculate the minimum reflectivty that will cause a laser return
+# dist may be a single distance or an array of distances
 def blensor_calculate_reflectivity_limit(dist, 
                                          reflectivity_distance,
                                          reflectivity_limit,
                                          reflectivity_slope):
-    min_reflectivity = -1.0
-    if dist >= reflectivity_distance:
-        min_reflectivity = reflectivity_limit + reflectivity_slope * (dist-reflectivity_distance)
+    min_reflectivity = np.where(dist >= reflectivity_distance,
+                                reflectivity_limit + reflectivity_slope * (dist-reflectivity_distance),
+                                -1.0)
     
     return min_reflectivity
 
 
+"""Cast a batch of rays against a BVHTree, one BVHTree.ray_cast call per ray.
+   This is the fallback of BVHCache.ray_cast if USE_BVHTREE is set
+
+   origins and directions are N x 3 arrays. Returns
+   locations N x 3 hit locations, NaN if the ray did not hit anything
+   normals   N x 3 hit normals, NaN if the ray did not hit anything
+   faces     N face indices, -1 if the ray did not hit anything
+   distances N hit distances, inf if the ray did not hit anything
+"""
+def ray_cast_batch(bvh, origins, directions, max_distance):
+    count = len(directions)
+    locations = np.full((count,3), np.nan)
+    normals = np.full((count,3), np.nan)
+    faces = np.full(count, -1, dtype=np.int64)
+    distances = np.full(count, np.inf)
+
+    ray_cast = bvh.ray_cast
+    origins = np.broadcast_to(origins, (count,3)).tolist()
+    hits = []
+    for idx, (origin, direction) in enumerate(zip(origins, directions.tolist())):
+        hit = ray_cast(origin, direction, max_distance)
+        if hit[0] is not None:
+            hits.append((idx,) + hit)
+
+    if hits:
+        hit_idx, hit_loc, hit_normal, hit_face, hit_distance = zip(*hits)
+        hit_idx = list(hit_idx)
+        locations[hit_idx] = [loc.to_tuple() for loc in hit_loc]
+        normals[hit_idx] = [normal.to_tuple() for normal in hit_normal]
+        faces[hit_idx] = hit_face
+        distances[hit_idx] = hit_distance
+
+    return locations, normals, faces, distances
+
+
 """Raycast scene with individual rays
    Return per hit:
    distance,
@@ -30,24 +74,17 @@ def blensor_calculate_reflectivity_limit(dist,
    B
 """
 
-"""This is the fallback scan interface if native blensor support is not available"""
+"""This is the fallback scan interface if native blensor support is not available
+
+   rays_buffer and returns_buffer are flat float32 arrays, the object_id
+   is stored as uint32 like the native implementation does
+"""
 def scan(numberOfRays, max_distance, elementsPerRay, keep_render_setup, do_shading, rays_buffer, returns_buffer, ELEMENTS_PER_RETURN): 
-    if ELEMENTS_PER_RETURN != 8:
+    if ELEMENTS_PER_RETURN < 8:
         raise Exception("Scan interface incompatible")
     
-    # Step 1: Scene to polygons / store face indices and materials
-    tris = []
-    faces = []
-    face_array,obj_array,mat_array = scene_to_mesh()
-
-    for idx,f in enumerate(face_array):
-        tris.append(list(f[0]))
-        tris.append(list(f[1]))
-        tris.append(list(f[2]))
-        faces.append([idx*3,idx*3+1,idx*3+2])
-
-    # Step 2: Polygons to BVH tree
-    scene_bvh = BVHTree.FromPolygons(tris, faces, all_triangles = True)
+    # Step 1 + 2: Scene to ray cast structures, unchanged objects are taken from the cache
+    bvh_cache.update()
 
     # Step 3: Raycast rays
     scanner = bpy.context.scene.camera
@@ -55,139 +92,355 @@ def scan(numberOfRays, max_distance, elementsPerRay, keep_render_setup, do_shadi
     reflectivity_limit = scanner.ref_limit
     reflectivity_slope = scanner.ref_slope
 
-    origin = Vector([0.0,0.0,0.0])
-    direction = Vector([0.0,0.0,0.0])
+    rays = np.asarray(rays_buffer, dtype=np.float64)[:numberOfRays*elementsPerRay]
+    rays = rays.reshape(numberOfRays, elementsPerRay)
 
-    hit_indices = [-1]*numberOfRays
+    # Rotate the directions like Vector.rotate does, the scale is removed
+    rotation = np.array(scanner.matrix_world.to_3x3(), dtype=np.float64)
+    rotation /= np.sqrt(np.sum(rotation**2, axis=0))
+    directions = np.dot(rays[:,0:3], rotation.T)
+    
+    if elementsPerRay>=6:
+        origins = rays[:,3:6]
+    else:
+        origins = np.array(scanner.location)
 
-    for idx in range(numberOfRays):
-        direction.x = rays_buffer[idx*elementsPerRay]
-        direction.y = rays_buffer[idx*elementsPerRay+1]
-        direction.z = rays_buffer[idx*elementsPerRay+2]
-        
-        if elementsPerRay>=6:
-            origin.x = rays_buffer[idx*elementsPerRay+3]
-            origin.y = rays_buffer[idx*elementsPerRay+4]
-            origin.z = rays_buffer[idx*elementsPerRay+5]
-        else:
-            origin.x = bpy.context.scene.camera.location.x
-            origin.y = bpy.context.scene.camera.location.y
-            origin.z = bpy.context.scene.camera.location.z
+    locations, normals, faces, distances = bvh_cache.ray_cast(origins, directions, max_distance)
 
-        direction.rotate (scanner.matrix_world)
+    # Faces without a material use the last entry, white with an intensity of 1
+    hit = faces >= 0
+    mat_idx = np.where(hit, bvh_cache.face_material_index[np.maximum(faces,0)], -1)
 
-        (hit_loc, hit_normal, hit_idx, hit_distance) = scene_bvh.ray_cast(origin,direction,max_distance)
+    #Calculate the required diffuse reflectivity of the material to create a return
+    diffuse_intensity = np.append(bvh_cache.material_intensity, 1.0)[mat_idx]
+    ref_limit = blensor_calculate_reflectivity_limit(distances, reflectivity_distance, reflectivity_limit, reflectivity_slope)
+    valid = hit & (diffuse_intensity > ref_limit)
 
-        valid_return = False
-        if hit_loc:
-            mat = mat_array[hit_idx]
+    returns = np.asarray(returns_buffer)[:numberOfRays*ELEMENTS_PER_RETURN]
+    returns = returns.reshape(numberOfRays, ELEMENTS_PER_RETURN)
+    returns[:,0:8] = 0.0
 
-            diffuse_intensity = 1.0
-            if mat:
-                diffuse_intensity = mat.diffuse_intensity
+    returns[valid,0] = distances[valid]
+    returns[valid,1:4] = locations[valid]
+    returns[valid,5:8] = np.append(bvh_cache.material_color, [[1.0,1.0,1.0]], axis=0)[mat_idx[valid]]
+    returns.view(np.uint32)[valid,4] = bvh_cache.face_object_ids[faces[valid]]
 
-            #Calculate the required diffuse reflectivity of the material to create a return
-            ref_limit = blensor_calculate_reflectivity_limit(hit_distance, reflectivity_distance, reflectivity_limit, reflectivity_slope)
+    # Step 3: Shade rays
+    # TODO: Implement material solver
 
-            if diffuse_intensity > ref_limit:
-                valid_return = True
-                if mat:
-                    color = mat.diffuse_color
-                    returns_buffer[idx*ELEMENTS_PER_RETURN+5] = color.r
-                    returns_buffer[idx*ELEMENTS_PER_RETURN+6] = color.g
-                    returns_buffer[idx*ELEMENTS_PER_RETURN+7] = color.b
-                else:
-                    returns_buffer[idx*ELEMENTS_PER_RETURN+5] = 1.0
-                    returns_buffer[idx*ELEMENTS_PER_RETURN+6] = 1.0
-                    returns_buffer[idx*ELEMENTS_PER_RETURN+7] = 1.0
 
-                returns_buffer[idx*ELEMENTS_PER_RETURN] = hit_distance
-                returns_buffer[idx*ELEMENTS_PER_RETURN+1] = hit_loc.x
-                returns_buffer[idx*ELEMENTS_PER_RETURN+2] = hit_loc.y
-                returns_buffer[idx*ELEMENTS_PER_RETURN+3] = hit_loc.z
+"""Geometry of a single object
 
-                obj = obj_array[hit_idx]
-                name = obj.name
-                returns_buffer[idx*ELEMENTS_PER_RETURN+4] = ord(name[0]) + (ord(name[1])<<8) + (ord(name[2])<<16) + (ord(name[3])<<24)  
+   local_triangles is a T x 3 x 3 float32 array in object space.
+   materials has one entry per triangle. key is used to detect if the mesh
+   or modifier stack was replaced since the entry was built. The uniform
+   grid is built in object space, if only the matrix changed the grid is
+   kept and the rays are transformed into object space (refit).
+"""
+class ObjectGeometry:
+    def __init__(self, key, matrix, local_triangles, materials):
+        self.key = key
+        self.local_triangles = local_triangles
+        self.materials = materials
+        self.grid = None
+        self.local_normals = None
+        self.refit(matrix)
+
+    def refit(self, matrix):
+        self.matrix = matrix
+        m = np.array(matrix, dtype=np.float64)
+        self.world_matrix = m
+        try:
+            self.inverse = np.linalg.inv(m)
+        except np.linalg.LinAlgError:
+            """Scaled to zero, the object can not be hit"""
+            self.inverse = None
+
+        """World space bounding box of the object"""
+        if len(self.local_triangles) > 0:
+            lo = self.local_triangles.min(axis=(0,1))
+            hi = self.local_triangles.max(axis=(0,1))
+            corners = np.array([[x,y,z] for x in (lo[0],hi[0]) for y in (lo[1],hi[1]) for z in (lo[2],hi[2])])
+            corners = np.dot(corners, m[0:3,0:3].T) + m[0:3,3]
+            self.lo = corners.min(axis=0)
+            self.hi = corners.max(axis=0)
+
+    """World space triangles, only needed by the BVHTree fallback"""
+    @property
+    def triangles(self):
+        m = self.world_matrix.astype(np.float32)
+        return np.dot(self.local_triangles, m[0:3,0:3].T) + m[0:3,3]
+
+    """Indices of the rays that can hit the bounding box before limit,
+       origins and unit directions are N x 3 arrays, limit one value per ray
+    """
+    def candidates(self, origins, directions, limit):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t0 = (self.lo - origins) / directions
+            t1 = (self.hi - origins) / directions
+        """Rays parallel to a slab are inside it for all t or never"""
+        parallel = directions == 0.0
+        inside = (origins >= self.lo) & (origins <= self.hi)
+        t0 = np.where(parallel, np.where(inside, -np.inf, np.inf), t0)
+        t1 = np.where(parallel, np.where(inside, np.inf, -np.inf), t1)
+        t_enter = np.maximum(np.max(np.minimum(t0, t1), axis=1), 0.0)
+        t_leave = np.min(np.maximum(t0, t1), axis=1)
+        return np.nonzero((t_enter <= t_leave) & (t_enter <= limit))[0]
+
+    """Cast rays with world space origins and unit directions, returns the
+       world space distances (inf for misses) and the object face indices
+    """
+    def ray_cast(self, origins, directions, limit):
+        if self.grid is None:
+            self.grid = raycast.UniformGrid(self.local_triangles)
+
+        local_origins = np.dot(origins, self.inverse[0:3,0:3].T) + self.inverse[0:3,3]
+        local_directions = np.dot(directions, self.inverse[0:3,0:3].T)
+        """Object space length of a unit world direction"""
+        scale = np.sqrt(np.sum(local_directions**2, axis=1))
+
+        local_distances, faces = self.grid.closest_intersection(local_origins, local_directions,
+                                                               np.max(limit*scale))
+        return local_distances/scale, faces
+
+    """World space unit normals of object faces"""
+    def normals(self, faces):
+        if self.local_normals is None:
+            self.local_normals = raycast.face_normals(self.local_triangles)
+        return raycast.transform_normals(self.local_normals[faces], self.world_matrix)
+
+
+"""Cache for the ray cast structures used by the pure python scanner
+
+   Every renderable object is converted to triangles and a uniform grid in
+   object space only once and reused until its mesh data or modifier stack
+   changes, or the scene update handler reports that its data was changed
+   (animated modifiers, shape keys, armatures, edit mode, ...). Objects
+   that were only moved keep their grid, the rays are transformed into
+   object space. Static scenes are converted once for all frames and all
+   scanners.
+   The per face object ids and material indices of all objects are kept as
+   arrays, the face index of a hit is the index into these arrays. With
+   USE_BVHTREE a BVHTree of the whole scene is built instead of the grids.
+"""
+class BVHCache:
+    def __init__(self):
+        self.objects = {}
+        self.dirty = set()
+        self.scene_bvh = None
+        self.build_face_tables()
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.objects = {}
+            self.scene_bvh = None
+            self.build_face_tables()
+        else:
+            self.dirty.add(name)
+
+    def update(self):
+        changed = False
+        moved = False
+        seen = set()
+        for ob in bpy.data.objects:
+            if ob.hide_render or ob.type not in GEOMETRY_TYPES:
+                continue
+            seen.add(ob.name)
+            key = object_key(ob)
+            matrix = object_matrix(ob)
+            entry = self.objects.get(ob.name)
+            if entry is None or entry.key != key or ob.name in self.dirty:
+                triangles, materials = object_triangles(ob)
+                self.objects[ob.name] = ObjectGeometry(key, matrix, triangles, materials)
+                changed = True
+            elif entry.matrix != matrix:
+                entry.refit(matrix)
+                moved = True
+        self.dirty.clear()
+
+        for name in list(self.objects.keys()):
+            if name not in seen:
+                del self.objects[name]
+                changed = True
+
+        if changed:
+            self.build_face_tables()
+        if changed or moved:
+            self.scene_bvh = None
+
+    """Object ids and material indices of all faces, the faces of every
+       object start at face_offsets[name]
+    """
+    def build_face_tables(self):
+        object_ids = []
+        material_index = []
+        materials = {}
+        self.face_offsets = {}
+        offset = 0
+        for name, entry in self.objects.items():
+            if len(entry.local_triangles) == 0:
+                continue
+            self.face_offsets[name] = offset
+            offset += len(entry.local_triangles)
+            object_ids.append(np.full(len(entry.local_triangles), object_id(name), dtype=np.uint32))
+            material_index.append([materials.setdefault(m, len(materials)) if m is not None else -1 for m in entry.materials])
+
+        if object_ids:
+            self.face_object_ids = np.concatenate(object_ids)
+            self.face_material_index = np.concatenate(material_index).astype(np.int64)
+        else:
+            self.face_object_ids = np.zeros(0, dtype=np.uint32)
+            self.face_material_index = np.zeros(0, dtype=np.int64)
 
-                hit_indices[idx] = hit_idx
+        materials = sorted(materials, key=materials.get)
+        self.material_intensity = np.array([m.diffuse_intensity for m in materials], dtype=np.float64)
+        self.material_color = np.array([tuple(m.diffuse_color) for m in materials], dtype=np.float64).reshape(-1,3)
 
-        if not valid_return:
-            for r in range(ELEMENTS_PER_RETURN):
-                returns_buffer[idx*ELEMENTS_PER_RETURN+r] = 0.0
+    def build_scene_bvh(self):
+        triangles = [self.objects[name].triangles for name in self.face_offsets]
+        if triangles:
+            tris = np.concatenate(triangles).reshape(-1,3)
+        else:
+            tris = np.zeros((0,3), dtype=np.float32)
+        faces = np.arange(len(tris)).reshape(-1,3)
+        self.scene_bvh = BVHTree.FromPolygons(tris.tolist(), faces.tolist(), all_triangles = True)
 
-    # Step 3: Shade rays
-    # TODO: Implement material solver
-    if do_shading:
-        for idx,mat_idx in enumerate(hit_indices):
-            if mat_idx >= 0:
-                #shade hit point
-                pass
-            
-
-def scene_to_mesh():
-    # TODO: Return materials per face as well
-    global_matrix = Matrix() #identity
-
-    scene_faces = []
-    scene_obj = []
-    scene_materials = []
-
-    idx = 0
-    for ob in bpy.data.objects:
-        if not ob.hide_render:
-            faces = faces_from_mesh(ob,Matrix(), use_mesh_modifiers=True)
-            for f in faces:
-                scene_faces.append(list(map(list,f[0:3])))
-                scene_obj.append(ob)
-                scene_materials.append(f[3])
-    return scene_faces, scene_obj, scene_materials
-
-def faces_from_mesh(ob, global_matrix, use_mesh_modifiers=False):
+    """Cast rays against all objects
+
+       origins and directions are N x 3 arrays (or a single origin), the
+       directions do not have to be normalized. Returns the N x 3 hit
+       locations and world space face normals (NaN for misses), the face
+       indices (-1 for misses) and the distances (inf for misses) like
+       ray_cast_batch
     """
-    From an object, return a generator over a list of faces.
+    def ray_cast(self, origins, directions, max_distance):
+        if USE_BVHTREE:
+            if self.scene_bvh is None:
+                self.build_scene_bvh()
+            return ray_cast_batch(self.scene_bvh, origins, directions, max_distance)
+
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1,3)
+        count = len(directions)
+        origins = np.broadcast_to(np.asarray(origins, dtype=np.float64), (count,3))
+        length = np.sqrt(np.sum(directions**2, axis=1))
+        length[length == 0.0] = 1.0
+        directions = directions / length[:,np.newaxis]
+
+        distances = np.full(count, np.inf)
+        faces = np.full(count, -1, dtype=np.int64)
+        normals = np.full((count,3), np.nan)
+        for name, offset in self.face_offsets.items():
+            entry = self.objects[name]
+            if entry.inverse is None:
+                continue
+            """Only rays that reach the bounding box before their closest hit so far"""
+            limit = np.minimum(distances, max_distance)
+            rays = entry.candidates(origins, directions, limit)
+            if len(rays) == 0:
+                continue
+
+            hit_distances, hit_faces = entry.ray_cast(origins[rays], directions[rays], limit[rays])
+            closer = (hit_faces >= 0) & (hit_distances <= limit[rays])
+            distances[rays[closer]] = hit_distances[closer]
+            faces[rays[closer]] = hit_faces[closer] + offset
+            normals[rays[closer]] = entry.normals(hit_faces[closer])
+
+        hit = faces >= 0
+        locations = np.full((count,3), np.nan)
+        locations[hit] = origins[hit] + directions[hit]*distances[hit,np.newaxis]
+        return locations, normals, faces, distances
+
+
+GEOMETRY_TYPES = {'MESH', 'CURVE', 'SURFACE', 'FONT', 'META'}
+
+bvh_cache = BVHCache()
+
+
+"""Everything that requires a rebuild of the object geometry and can be
+   checked without evaluating the object. Changes of the evaluated data
+   are reported by bvh_cache_update_handler
+"""
+def object_key(ob):
+    data_pointer = ob.data.as_pointer() if ob.data else 0
+    modifiers = tuple((m.name, m.type, m.show_render) for m in ob.modifiers)
+    return (data_pointer, modifiers)
 
-    Each faces is a list of his vertexes. Each vertex is a tuple of
-    his coordinate.
 
-    use_mesh_modifiers
-        Apply the preview modifier to the returned liste
+def object_matrix(ob):
+    return tuple(tuple(row) for row in ob.matrix_world)
+
+
+"""The object id of a return, the first 4 bytes of the object name"""
+def object_id(name):
+    return int.from_bytes(name.encode("utf-8")[:4].ljust(4, b"\0"), "little")
+
+
+"""Mark objects whose data was changed by the last scene update"""
+@persistent
+def bvh_cache_update_handler(scene):
+    if not bpy.data.objects.is_updated:
+        return
+    for ob in bpy.data.objects:
+        if ob.is_updated_data or (ob.data and ob.data.is_updated):
+            bvh_cache.invalidate(ob.name)
+
+
+"""Drop the whole cache if a new file is loaded"""
+@persistent
+def bvh_cache_load_handler(dummy):
+    bvh_cache.invalidate()
 
-    triangulate
-        Split the quad into two triangles
-    """
 
+def register_handlers():
+    if bvh_cache_update_handler not in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.append(bvh_cache_update_handler)
+    if bvh_cache_load_handler not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(bvh_cache_load_handler)
+
+
+def unregister_handlers():
+    if bvh_cache_update_handler in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.remove(bvh_cache_update_handler)
+    if bvh_cache_load_handler in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(bvh_cache_load_handler)
+    bvh_cache.invalidate()
+
+
+"""Convert an object with its render modifiers to object space triangles
+
+   Returns a T x 3 x 3 float32 array and the material of every triangle.
+   Quads are split into two triangles. Tessfaces are triangles if the
+   fourth vertex index is 0, blender never stores a quad that way.
+"""
+def object_triangles(ob):
     # get the editmode data
     ob.update_from_editmode()
 
-    # get the modifiers
     try:
-        mesh = ob.to_mesh(bpy.context.scene, use_mesh_modifiers, "PREVIEW")
+        mesh = ob.to_mesh(bpy.context.scene, True, "PREVIEW")
     except RuntimeError:
-        raise StopIteration
-
-    mat = global_matrix * ob.matrix_world
-    mesh.transform(mat)
-    if mat.is_negative:
-        mesh.flip_normals()
-        mesh.calc_tessface()
-
-    def iter_face_index():
-        for face in mesh.tessfaces:
-            vertices = face.vertices[:]
-            material = None
-            if face.material_index < len(ob.material_slots):
-                material = ob.material_slots[face.material_index].material
-            if len(vertices) == 4:
-                yield vertices[0], vertices[1], vertices[2],material
-                yield vertices[2], vertices[3], vertices[0],material
-            else:
-                yield vertices[0],vertices[1],vertices[2],material
-
-    vertices = mesh.vertices
-
-    for face in iter_face_index():
-        yield [vertices[face[0]].co.copy(), vertices[face[1]].co.copy(), vertices[face[2]].co.copy(), face[3]]
+        return np.zeros((0,3,3), dtype=np.float32), []
+
+    mesh.calc_tessface()
+
+    vertices = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", vertices)
+    vertices = vertices.reshape(-1,3)
+
+    face_count = len(mesh.tessfaces)
+    faces = np.empty(face_count*4, dtype=np.int32)
+    mesh.tessfaces.foreach_get("vertices_raw", faces)
+    faces = faces.reshape(-1,4)
+    material_index = np.empty(face_count, dtype=np.int32)
+    mesh.tessfaces.foreach_get("material_index", material_index)
 
     bpy.data.meshes.remove(mesh)
 
+    quads = faces[:,3] != 0
+    indices = np.concatenate((faces[:,0:3], faces[quads][:,[2,3,0]]))
+    material_index = np.concatenate((material_index, material_index[quads]))
+
+    slots = [slot.material for slot in ob.material_slots]
+    materials = [slots[m] if m < len(slots) else None for m in material_index]
+
+    return vertices[indices], materials
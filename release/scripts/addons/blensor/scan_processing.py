@@ -0,0 +1,68 @@
+"""Post-processing of raycast returns shared by the scanner models
+
+   The raycaster delivers a structured array of returns (see
+   scan_interface.RETURN_DTYPE) in sensor coordinates. This module turns
+   them into evd entries (see evd.ENTRY_DTYPE): distances, noisy
+   distances, both world transformations and the ray information of the
+   ray pattern, all as whole array operations.
+"""
+
+import math
+import numpy
+
+from blensor import evd
+
+
+"""Transform N x 3 points with a 4x4 mathutils.Matrix (or nested list)"""
+def transform_points(world_transformation, points):
+    matrix = numpy.array(world_transformation, dtype=numpy.float64)
+    return numpy.dot(points, matrix[0:3,0:3].T) + matrix[0:3,3]
+
+
+"""Convert the returns of scan_interface.scan_rays_array to evd entries
+
+   timestamps, yaws and pitches are the per ray arrays of the ray pattern,
+   they are indexed with the ray index of every return.
+   distance_noise is added to the measured distance, it is either a single
+   value or an array with one value per return.
+   If backfolding_distance is set, noisy distances beyond it are folded
+   back by that distance (ToF unambiguity range).
+"""
+def process_returns(returns, timestamps, yaws, pitches, distance_noise, world_transformation, backfolding_distance=None):
+    entries = numpy.zeros(len(returns), dtype=evd.ENTRY_DTYPE)
+    idx = returns["idx"].astype(numpy.int64)
+
+    v = numpy.empty((len(returns),3), dtype=numpy.float64)
+    v[:,0] = returns["x"]
+    v[:,1] = returns["y"]
+    v[:,2] = returns["z"]
+
+    distance = numpy.sqrt(numpy.sum(v**2, axis=1))
+    distance_noise = distance + distance_noise
+    if backfolding_distance is not None:
+        folded = distance_noise >= backfolding_distance
+        distance_noise[folded] -= backfolding_distance
+
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        v_noise = v * (distance_noise / distance)[:,numpy.newaxis]
+
+    vt = transform_points(world_transformation, v)
+    vt_noise = transform_points(world_transformation, v_noise)
+
+    entries["timestamp"] = numpy.asarray(timestamps)[idx]
+    entries["yaw"] = (numpy.asarray(yaws, dtype=numpy.float64)[idx]+math.pi)%(2*math.pi)
+    entries["pitch"] = numpy.asarray(pitches)[idx]
+    entries["distance"] = distance
+    entries["distance_noise"] = distance_noise
+    entries["x"] = vt[:,0]
+    entries["y"] = vt[:,1]
+    entries["z"] = vt[:,2]
+    entries["x_noise"] = vt_noise[:,0]
+    entries["y_noise"] = vt_noise[:,1]
+    entries["z_noise"] = vt_noise[:,2]
+    entries["object_id"] = returns["object_id"]
+    entries["r"] = (255*returns["r"]).astype(numpy.int64)
+    entries["g"] = (255*returns["g"]).astype(numpy.int64)
+    entries["b"] = (255*returns["b"]).astype(numpy.int64)
+    entries["idx"] = idx
+    return entries
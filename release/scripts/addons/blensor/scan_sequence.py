@@ -0,0 +1,125 @@
+"""Display the scans of a frame range as a single object
+
+   Instead of adding a new mesh object for every scanned frame the points
+   are written to a cache directory (one .npz file per frame) and one
+   sequence object per scanner and scan name shows the scan of the current
+   frame. A frame change handler swaps the mesh of the sequence objects,
+   so the scene size does not grow with the length of the sequence.
+
+   The cache file of a frame holds the points, the world matrix of the
+   object and, if the scan data is stored, the evd entries which are
+   available through mesh_utils.get_side_buffer after loading.
+"""
+
+import os
+import tempfile
+import numpy
+import bpy
+from bpy.app.handlers import persistent
+from mathutils import Matrix
+
+from blensor import mesh_utils
+
+
+"""Custom properties of a sequence object: the cache file prefix and the
+   frame that is currently loaded
+"""
+CACHE_PROPERTY = "blensor_scan_cache"
+FRAME_PROPERTY = "blensor_scan_frame"
+
+
+def cache_directory(scanner):
+    if scanner.scan_sequence_cache:
+        directory = bpy.path.abspath(scanner.scan_sequence_cache)
+    else:
+        directory = os.path.join(tempfile.gettempdir(), "blensor_%s"%bpy.path.clean_name(scanner.name))
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def cache_filename(prefix, frame):
+    return "%s%05d.npz"%(prefix, frame)
+
+
+"""The sequence object of a scanner for scans called name (Scan, NoisyScan)"""
+def sequence_object(scanner, name):
+    object_name = "%s.sequence.%s"%(name, scanner.name)
+    obj = bpy.data.objects.get(object_name)
+    if obj is None:
+        obj = bpy.data.objects.new(object_name, bpy.data.meshes.new(object_name+"_mesh"))
+        bpy.context.scene.objects.link(obj)
+    obj[CACHE_PROPERTY] = os.path.join(cache_directory(scanner), name)
+    return obj
+
+
+"""Write the scan of the current frame to the cache and show it"""
+def store_frame(scanner, name, points, matrix, buffer=None):
+    frame = bpy.context.scene.frame_current
+    obj = sequence_object(scanner, name)
+
+    data = {"points": numpy.asarray(points, dtype=numpy.float32).reshape(-1,3),
+            "matrix": numpy.array(matrix, dtype=numpy.float64)}
+    if buffer is not None:
+        data["scan"] = numpy.asarray(buffer)
+    numpy.savez(cache_filename(obj[CACHE_PROPERTY], frame), **data)
+
+    load_frame(obj, frame)
+
+
+"""Replace the mesh of a sequence object with the cached scan of frame,
+   frames without a scan show an empty mesh
+"""
+def load_frame(obj, frame):
+    old_mesh = obj.data
+    mesh = bpy.data.meshes.new(old_mesh.name)
+
+    scan = None
+    filename = cache_filename(obj[CACHE_PROPERTY], frame)
+    if os.path.exists(filename):
+        with numpy.load(filename) as data:
+            points = data["points"]
+            mesh.vertices.add(len(points))
+            mesh.vertices.foreach_set("co", points.ravel())
+            obj.matrix_world = Matrix(data["matrix"].tolist())
+            if "scan" in data:
+                scan = data["scan"]
+
+    mesh.update()
+    obj.data = mesh
+    name = old_mesh.name
+    bpy.data.meshes.remove(old_mesh)
+    mesh.name = name
+    """Side buffers are found by mesh name, store it under the final name
+       and drop the buffer of the previous frame
+    """
+    if scan is not None:
+        mesh_utils.store_side_buffer(mesh, scan)
+    else:
+        mesh_utils.side_buffers.pop(name, None)
+    obj[FRAME_PROPERTY] = frame
+
+
+def delete_cache(obj):
+    prefix = obj[CACHE_PROPERTY]
+    directory, name = os.path.split(prefix)
+    if not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if filename.startswith(name) and filename.endswith(".npz") and filename[len(name):-4].isdigit():
+            os.remove(os.path.join(directory, filename))
+
+
+@persistent
+def scan_sequence_frame_handler(scene):
+    for obj in scene.objects:
+        if CACHE_PROPERTY in obj and obj.get(FRAME_PROPERTY) != scene.frame_current:
+            load_frame(obj, scene.frame_current)
+
+
+def register_handlers():
+    if scan_sequence_frame_handler not in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.append(scan_sequence_frame_handler)
+
+
+def unregister_handlers():
+    if scan_sequence_frame_handler in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.remove(scan_sequence_frame_handler)
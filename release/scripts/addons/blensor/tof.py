@@ -34,6 +34,8 @@ import blensor.globals
 import blensor.scan_interface
 from blensor import evd
 from blensor import mesh_utils
+from blensor import ray_pattern
+from blensor import scan_processing
 
 
 
@@ -102,79 +104,37 @@ def scan_advanced(scanner_object, max_distance = 10.0, evd_file=None, add_blende
 
 
 
-    evd_buffer = []
-    rays = []
-    ray_info = []
+    rays, yaws, pitches, timestamps = ray_pattern.pinhole(tof_res_x, tof_res_y, 
+        pixel_width, pixel_height, flength, max_distance, timestamp, x_major=True)
 
-    ray = Vector([0.0,0.0,0.0])
-    for x in range(tof_res_x):
-        for y in range(tof_res_y):
-            """Calculate a vector that originates at the principal point
-               and points to the pixel in the sensor. This vector is then
-               scaled to the maximum scanning distance 
-            """ 
-            physical_x = float(x-cx) * pixel_width
-            physical_y = float(y-cy) * pixel_height
-            physical_z = -float(flength)
-            ray.xyz = [physical_x, physical_y, physical_z]
-            ray.normalize()
-            final_ray = max_distance*ray
-            rays.extend([final_ray[0],final_ray[1],final_ray[2]])
-
-
-            """ pitch and yaw are added for completeness, normally they are
-                not provided by a ToF Camera but can be derived 
-                from the pixel position and the camera parameters.
-            """
-            yaw = math.atan(physical_x/flength)
-            pitch = math.atan(physical_y/flength)
-
-            ray_info.append([yaw, pitch, timestamp])
-            
-
-    returns = blensor.scan_interface.scan_rays(rays, max_distance, inv_scan_x = inv_scan_x, inv_scan_y = inv_scan_y, inv_scan_z = inv_scan_z)
+    returns = blensor.scan_interface.scan_rays_array(rays, max_distance, inv_scan_x = inv_scan_x, inv_scan_y = inv_scan_y, inv_scan_z = inv_scan_z)
 
     evd_storage = evd.evd_file(evd_file, tof_res_x, tof_res_y, max_distance)
 
-    reusable_vector = Vector([0.0,0.0,0.0,0.0])
-    for i in range(len(returns)):
-        idx = returns[i][-1]
-        distance_noise =  random.gauss(noise_mu, noise_sigma)
-        #If everything works substitute the previous line with this
-        #distance_noise =  pixel_noise[returns[idx][-1]] + random.gauss(noise_mu, noise_sigma) 
-
-        reusable_vector.xyzw = [returns[i][1],returns[i][2],returns[i][3],1.0]
-        vt = (world_transformation * reusable_vector).xyz
-        v = [returns[i][1],returns[i][2],returns[i][3]]
-        vector_length = math.sqrt(v[0]**2+v[1]**2+v[2]**2)
-        norm_vector = [v[0]/vector_length, v[1]/vector_length, v[2]/vector_length]
-
+    distance_noise = numpy.random.normal(noise_mu, noise_sigma, len(returns))
+    #If everything works add the per pixel bias as well
+    #distance_noise += numpy.asarray(pixel_noise)[returns["idx"]]
 
-        vector_length_noise = vector_length+distance_noise
-        if backfolding:
-           #Distances > max_distance/2..max_distance are mapped to 0..max_distance/2
-           if vector_length_noise >= max_distance/2.0:
-               vector_length_noise = vector_length_noise - max_distance/2.0
+    #Distances > max_distance/2..max_distance are mapped to 0..max_distance/2
+    backfolding_distance = max_distance/2.0 if backfolding else None
 
-        reusable_vector.xyzw = [norm_vector[0]*vector_length_noise, norm_vector[1]*vector_length_noise, norm_vector[2]*vector_length_noise,1.0]
-        v_noise = (world_transformation * reusable_vector).xyz
-        
-        evd_storage.addEntry(timestamp = ray_info[idx][2], yaw =(ray_info[idx][0]+math.pi)%(2*math.pi), pitch=ray_info[idx][1], distance=vector_length, distance_noise=vector_length_noise, x=vt[0], y=vt[1], z=vt[2], x_noise=v_noise[0], y_noise=v_noise[1], z_noise=v_noise[2], object_id=returns[i][4], color=returns[i][5], idx=returns[i][-1])
+    evd_storage.addEntries(scan_processing.process_returns(returns, timestamps, yaws, pitches, 
+                                                           distance_noise, world_transformation,
+                                                           backfolding_distance))
 
     if evd_file:
         evd_storage.appendEvdFile()
 
     if not evd_storage.isEmpty():
-        scan_data = numpy.array(evd_storage.buffer)
         additional_data = None
         if scanner_object.store_data_in_mesh:
             additional_data = evd_storage.buffer
 
         if add_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,5:8], "Scan", world_transformation, buffer=additional_data)
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(), "Scan", world_transformation, buffer=additional_data, scanner=scanner_object)
 
         if add_noisy_blender_mesh:
-            mesh_utils.add_mesh_from_points_tf(scan_data[:,8:11], "NoisyScan", world_transformation, buffer=additional_data) 
+            mesh_utils.add_mesh_from_points_tf(evd_storage.getPoints(noisy=True), "NoisyScan", world_transformation, buffer=additional_data, scanner=scanner_object) 
 
         bpy.context.scene.update()
 
@@ -190,7 +150,7 @@ def scan_advanced(scanner_object, max_distance = 10.0, evd_file=None, add_blende
 
 # This Function creates scans over a range of frames
 
-def scan_range(scanne_object, frame_start, frame_end, filename="/tmp/tof.evd", frame_time = (1.0/24.0), fps = 24, add_blender_mesh=False, add_noisy_blender_mesh=False, max_distance = 20.0, last_frame = True, noise_mu = 0.0, noise_sigma = 0.0, backfolding=False, tof_res_x = 176, tof_res_y=144, lens_angle_w=43.6, lens_angle_h=34.6, flength = 10.0, world_transformation=Matrix()):
+def scan_range(scanner_object, frame_start, frame_end, filename="/tmp/tof.evd", frame_time = (1.0/24.0), fps = 24, add_blender_mesh=False, add_noisy_blender_mesh=False, max_distance = 20.0, last_frame = True, noise_mu = 0.0, noise_sigma = 0.0, backfolding=False, tof_res_x = 176, tof_res_y=144, lens_angle_w=43.6, lens_angle_h=34.6, flength = 10.0, world_transformation=Matrix(), raise_errors=False):
 
 
 
@@ -218,11 +178,11 @@ def scan_range(scanne_object, frame_start, frame_end, filename="/tmp/tof.evd", f
                 break
     except:
         print ("Scan aborted")
+        if raise_errors:
+            raise
 
     if last_frame:
-        evd_file = open(filename,"a")
-        evd_file.buffer.write(struct.pack("i",-1))
-        evd_file.close()
+        evd.finish_evd_stream(filename)
 
     end_time = time.time()
     print ("Total scan time: %.2f"%(end_time-start_time))
@@ -96,7 +96,10 @@ PyDoc_STRVAR(M_Blensorintern_doc,
 /*------------------------------------------------------------*/
 
 PyDoc_STRVAR(M_Blensorintern_scan_doc,
-".. function:: scan(raycount, elements_per_ray, keep_render_setup, shading, maximum_distance, ray_ptr_str, return_ptr_str)\n"
+".. function:: scan(raycount, elements_per_ray, keep_render_setup, shading, maximum_distance, ray_ptr_str, return_ptr_str, threads=0)\n"
+"\n"
+"   threads is the number of threads used to cast the rays. 0 uses the\n"
+"   render threads of the scene, 1 casts all rays on the calling thread.\n"
 "   :return: status\n"
 "   :rtype: integer\n"
 );
@@ -105,24 +108,98 @@ static PyObject *M_Blensorintern_scan(PyObject *UNUSED(self), PyObject *args)
   int raycount, elements_per_ray, keep_render_setup;
   int shading;
   float maximum_distance;
+  int threads = 0;
   char *ray_ptr_str, *return_ptr_str;
   bContext *C;
   PyObject *result;
   
-  if (!PyArg_ParseTuple(args, "IfIIIss", &raycount, &maximum_distance, &elements_per_ray,
+  if (!PyArg_ParseTuple(args, "IfIIIss|i", &raycount, &maximum_distance, &elements_per_ray,
       &keep_render_setup, &shading,  
-      &ray_ptr_str, &return_ptr_str))
+      &ray_ptr_str, &return_ptr_str, &threads))
     return 0;
     
 	C = (bContext *)BPy_GetContext();
-  screen_blensor_exec(C, raycount, elements_per_ray, keep_render_setup, 
-                 shading, maximum_distance, ray_ptr_str, return_ptr_str);
+  screen_blensor_exec(C, raycount, elements_per_ray, BLENSOR_ELEMENTS_PER_RETURN,
+                 keep_render_setup, shading, maximum_distance, 
+                 (float *)blensor_convert_str_to_ptr(ray_ptr_str),
+                 (float *)blensor_convert_str_to_ptr(return_ptr_str), threads);
 
   result = Py_BuildValue("i",0);
 
 	return result;
 }
 
+PyDoc_STRVAR(M_Blensorintern_scan_buffer_doc,
+".. function:: scan_buffer(raycount, maximum_distance, elements_per_ray, keep_render_setup, shading, rays, returns, threads=0)\n"
+"\n"
+"   Same as scan but the rays and returns are passed as objects supporting\n"
+"   the buffer protocol (i.e. C-contiguous float32 numpy arrays) instead of\n"
+"   pointer strings. The returns buffer is written in place, its size\n"
+"   determines the number of floats per return (at least 8).\n"
+"   :return: status\n"
+"   :rtype: integer\n"
+);
+static PyObject *M_Blensorintern_scan_buffer(PyObject *UNUSED(self), PyObject *args)
+{
+  int raycount, elements_per_ray, elements_per_return, keep_render_setup;
+  int shading;
+  int threads = 0;
+  float maximum_distance;
+  Py_buffer rays, returns;
+  bContext *C;
+  
+  if (!PyArg_ParseTuple(args, "IfIIIy*w*|i", &raycount, &maximum_distance, &elements_per_ray,
+      &keep_render_setup, &shading, &rays, &returns, &threads))
+    return NULL;
+
+  if (raycount <= 0 || 
+      rays.len < (Py_ssize_t)raycount * elements_per_ray * sizeof(float))
+  {
+    PyErr_SetString(PyExc_ValueError, "scan_buffer: ray buffer is too small");
+    PyBuffer_Release(&rays);
+    PyBuffer_Release(&returns);
+    return NULL;
+  }
+
+  elements_per_return = returns.len / ((Py_ssize_t)raycount * sizeof(float));
+  if (elements_per_return < BLENSOR_ELEMENTS_PER_RETURN)
+  {
+    PyErr_SetString(PyExc_ValueError, "scan_buffer: return buffer is too small");
+    PyBuffer_Release(&rays);
+    PyBuffer_Release(&returns);
+    return NULL;
+  }
+    
+	C = (bContext *)BPy_GetContext();
+  screen_blensor_exec(C, raycount, elements_per_ray, elements_per_return, keep_render_setup, 
+                 shading, maximum_distance, (float *)rays.buf, (float *)returns.buf, threads);
+
+  PyBuffer_Release(&rays);
+  PyBuffer_Release(&returns);
+
+	return Py_BuildValue("i",0);
+}
+
+PyDoc_STRVAR(M_Blensorintern_free_render_setup_doc,
+".. function:: free_render_setup()\n"
+"\n"
+"   Free the render database and raytree kept by a scan with\n"
+"   keep_render_setup. Scans of the same frame with keep_render_setup\n"
+"   reuse the setup, the raytree stays in the view space of the camera\n"
+"   that was active when it was built.\n"
+"   :return: status\n"
+"   :rtype: integer\n"
+);
+static PyObject *M_Blensorintern_free_render_setup(PyObject *UNUSED(self), PyObject *UNUSED(args))
+{
+  bContext *C;
+
+	C = (bContext *)BPy_GetContext();
+  screen_blensor_free(C);
+
+	return Py_BuildValue("i",0);
+}
+
 PyDoc_STRVAR(M_Blensorintern_copy_zbuf_doc,
 ".. function:: copy_zbuf(image)\n"
 "   :return: zbuf\n"
@@ -164,10 +241,49 @@ static PyObject *M_Blensorintern_copy_zbuf(PyObject *UNUSED(self), PyObject *obj
 
 
 
+PyDoc_STRVAR(M_Blensorintern_copy_zbuf_buffer_doc,
+".. function:: copy_zbuf_buffer(image, zbuf)\n"
+"\n"
+"   Same as copy_zbuf but the zbuffer is copied into zbuf, an object\n"
+"   supporting the buffer protocol (i.e. a C-contiguous float32 numpy\n"
+"   array with one value per pixel).\n"
+"   :return: number of pixels of the zbuffer, -1 if there is none\n"
+"   :rtype: integer\n"
+);
+static PyObject *M_Blensorintern_copy_zbuf_buffer(PyObject *UNUSED(self), PyObject *args)
+{
+  PyObject *obj;
+  Py_buffer zbuf;
+  struct ID *id;
+  bContext *C;
+  int count;
+
+  if (!PyArg_ParseTuple(args, "Ow*", &obj, &zbuf))
+    return NULL;
+
+  if (pyrna_id_FromPyObject(obj, &id) == 0 || GS(id->name) != ID_IM)
+  {
+    PyErr_SetString(PyExc_TypeError, "copy_zbuf_buffer: expected an image");
+    PyBuffer_Release(&zbuf);
+    return NULL;
+  }
+
+	C = (bContext *)BPy_GetContext();
+  count = blensor_Image_copy_zbuf_into((Image *)id, C, (float *)zbuf.buf, zbuf.len / sizeof(float));
+  PyBuffer_Release(&zbuf);
+
+	return Py_BuildValue("i", count);
+}
+
+
+
 /*----------------------------MODULE INIT-------------------------*/
 static struct PyMethodDef M_Blensorintern_methods[] = {
 	{"scan", (PyCFunction) M_Blensorintern_scan, METH_VARARGS, M_Blensorintern_scan_doc},
+	{"scan_buffer", (PyCFunction) M_Blensorintern_scan_buffer, METH_VARARGS, M_Blensorintern_scan_buffer_doc},
+	{"free_render_setup", (PyCFunction) M_Blensorintern_free_render_setup, METH_NOARGS, M_Blensorintern_free_render_setup_doc},
 	{"copy_zbuf", (PyCFunction) M_Blensorintern_copy_zbuf, METH_O, M_Blensorintern_copy_zbuf_doc},
+	{"copy_zbuf_buffer", (PyCFunction) M_Blensorintern_copy_zbuf_buffer, METH_VARARGS, M_Blensorintern_copy_zbuf_buffer_doc},
 	{NULL, NULL, 0, NULL}
 };
 
@@ -42,7 +42,6 @@ extern void shade_ray(struct Isect *is, struct ShadeInput *shi, struct ShadeResu
 
 //How many fields are returned from the cast rays function
 #define BLENSOR_INTERSECTION_RETURNS 15
-#define BLENSOR_ELEMENTS_PER_RETURN 8
 
 /* Return the value of the id property or the defaultvalue if the id property
  * does not exist
@@ -92,8 +91,11 @@ double Blensor_GetPropertyValue_Double(struct Object *root, const char *name, do
 
 
 
-/* Setup a single ray and cast it onto the raytree */
-static int cast_ray(RayObject *tree, float sx, float sy, float sz, float vx, float vy, float vz, float *ret, void **hit_ob, void **hit_face, Render *re, SceneRenderLayer *srl, int shading)
+/* Setup a single ray and cast it onto the raytree 
+ * If shading is enabled the render and material modes have to be prepared
+ * with blensor_shading_begin. thread is the index of the calling thread
+ */
+static int cast_ray(RayObject *tree, float sx, float sy, float sz, float vx, float vy, float vz, float *ret, void **hit_ob, void **hit_face, Render *re, SceneRenderLayer *srl, int shading, int thread)
 {
     struct Isect isect;
     int res=0;
@@ -158,8 +160,6 @@ static int cast_ray(RayObject *tree, float sx, float sy, float sz, float vx, flo
                  //#TODO get all necessary information from the Shaderesult
                 ShadeInput shi =  {0};
                 ShadeResult shr = {{0}};
-                int saved_render_mode;
-                int saved_material_mode;
                 struct Material *m = face->mat;
                 
                 if (shading)
@@ -172,15 +172,9 @@ static int cast_ray(RayObject *tree, float sx, float sy, float sz, float vx, flo
                   shi.mat_override= NULL;
                   shi.light_override= NULL;
                   shi.combinedflag= 0xFFFF;
+                  shi.thread = thread;
 
-                  saved_render_mode = re->r.mode;
-                  re->r.mode = ~(R_RAYTRACE); //Disable raytracing
-                  saved_material_mode = m->mode;
-                  m->mode |= MA_SHLESS; //Enable shadeless mode (disables lighting shaders)
                   shade_ray(&isect, &shi, &shr);
-                  /* Restore parameters */
-                  m->mode = saved_material_mode;
-                  re->r.mode = saved_render_mode;
                 }
                 ret[5] = m->alpha;
                 ret[6] = m->ray_mirror;
@@ -301,93 +295,53 @@ double blensor_calculate_reflectivity_limit(double dist,
 }
 
 
-/*
- * TODO: implement a threaded blensor
- * 
-static void threaded_blensor_processor(Render *re)
-{
-	ListBase threads;
-	RenderPart *pa, *nextpa;
-	int rendering=1, counter= 1, drawtimer=0, hasdrawn, minx=0;
-	
-//?//	initparts(re);
-
-	
-	BLI_init_threads(&threads, do_part_blensor, re->r.threads);
-	
-	// assuming no new data gets added to dbase... 
-	R= *re;
-	
-	// set threadsafe break 
-//?//	R.test_break= thread_break;
-
-	nextpa= find_next_part(re, 0);
-	
-	while (rendering) {
-		
-		if (BLI_available_threads(&threads)) {
-			BLI_insert_thread(&threads, [[DATA]]);
-		}
-
-		
-		for (pa= re->parts.first; pa; pa= pa->next) {
-			if (pa->ready) {
-				BLI_remove_thread(&threads, pa);
-			}
-		}
-	}
-	
-	// unset threadsafety 
-	g_break= 0;
-	
-	BLI_end_threads(&threads);
-//?//	freeparts(re);
-}
-*/
+/* Settings that are shared by all rays of a scan */
+typedef struct BlensorScanSettings {
+    float refractive_index;
+    double reflectivity_distance;  //Minimum distance at which the reflectivity
+                                   //of the object influences the distance measuremet
+    double reflectivity_limit;
+    double reflectivity_slope;
+    int reflection_enabled;
+} BlensorScanSettings;
+
+/* A contiguous chunk of the ray buffer that is processed by one thread */
+typedef struct BlensorThread {
+    Render *re;
+    SceneRenderLayer *srl;
+    const BlensorScanSettings *settings;
+    float *rays;
+    float *returns;
+    int start, end;
+    int elements_per_ray;
+    int elements_per_return;
+    float maximum_distance;
+    int shading;
+    int thread;
+} BlensorThread;
 
 
-/* cast all rays specified in *rays and return the result via *returns */
-static void do_blensor(Render *re, float *rays, int raycount, int elements_per_ray, float *returns, float maximum_distance,
-                       Main *bmain, Scene *scene, SceneRenderLayer *srl, int shading)
+/* Cast the rays [start, end) of a chunk. The raytree is only read, every
+ * chunk writes to its own part of the return buffer
+ */
+static void blensor_cast_rays(BlensorThread *bt)
 {
     int idx;
-    float refractive_index = 1.0;
-    double reflectivity_distance = 50;  //Minimum distance at which the reflectivity
-                                          //of the object influences the distance measuremet
-    double reflectivity_limit = 0.1;  
-    double reflectivity_slope = 0.01;  
-    double min_reflectivity = -1.0;
-    int reflection_enabled = 0;
-    struct bProperty *tprop;
-    Camera *cam;
-    PointerRNA rna_cam;
-    PropertyRNA *rna_cam_prop;
-    PropertyType pt;
-    
-
-    cam = (Camera *)re->scene->camera->data;
-    RNA_pointer_create(&(re->scene->camera->id), &RNA_Object, re->scene->camera, &rna_cam);
-
-    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_dist");
-    reflectivity_distance = RNA_property_float_get(&rna_cam, rna_cam_prop);
-
-    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_limit");
-    reflectivity_limit = RNA_property_float_get(&rna_cam, rna_cam_prop);
-
-    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_slope");
-    reflectivity_slope = RNA_property_float_get(&rna_cam, rna_cam_prop);
-
-    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_enabled");
-    reflection_enabled = RNA_property_boolean_get(&rna_cam, rna_cam_prop);
-
-    /* This is necessary, see explanation at the point of declaration */
-    R = *re;
-
-    refractive_index = Blensor_GetIDPropertyValue_Double(&re->scene->world->id,"refractive_index", 1.0);
-    printf ("The refractive index of the world is: %.6f\n",refractive_index);
-    printf ("reflectivity_distance: %.6f  reflectivity_limit: %.6f\n",reflectivity_distance, reflectivity_limit);
-
-    for (idx = 0; idx < raycount ;  idx ++)
+    Render *re = bt->re;
+    SceneRenderLayer *srl = bt->srl;
+    float *rays = bt->rays;
+    float *returns = bt->returns;
+    int elements_per_ray = bt->elements_per_ray;
+    int elements_per_return = bt->elements_per_return;
+    float maximum_distance = bt->maximum_distance;
+    int shading = bt->shading;
+    float refractive_index = bt->settings->refractive_index;
+    double reflectivity_distance = bt->settings->reflectivity_distance;
+    double reflectivity_limit = bt->settings->reflectivity_limit;
+    double reflectivity_slope = bt->settings->reflectivity_slope;
+    int reflection_enabled = bt->settings->reflection_enabled;
+
+    for (idx = bt->start; idx < bt->end; idx ++)
     {
         double maxdist = maximum_distance;
         int valid_signal = 0;
@@ -422,7 +376,7 @@ static void do_blensor(Render *re, float *rays, int raycount, int elements_per_r
             double reflected_energy = 0.0;
             reflection = 0;
             transmission = 0;
-            cast_ray(re->raytree, sx, sy, sz, vx, vy, vz, intersection, &hit_ob, &hit_face, re, srl, shading);
+            cast_ray(re->raytree, sx, sy, sz, vx, vy, vz, intersection, &hit_ob, &hit_face, re, srl, shading, bt->thread);
   
             raydistance += intersection[0];
 
@@ -493,69 +447,185 @@ static void do_blensor(Render *re, float *rays, int raycount, int elements_per_r
             sz = intersection[3];
         } while((reflection || transmission) && raydistance <= maxdist && !valid_signal);
 
-        returns[idx*BLENSOR_ELEMENTS_PER_RETURN+5] = intersection[12]; //r-value
-        returns[idx*BLENSOR_ELEMENTS_PER_RETURN+6] = intersection[13]; //g-value
-        returns[idx*BLENSOR_ELEMENTS_PER_RETURN+7] = intersection[14]; //b-value
+        returns[idx*elements_per_return+5] = intersection[12]; //r-value
+        returns[idx*elements_per_return+6] = intersection[13]; //g-value
+        returns[idx*elements_per_return+7] = intersection[14]; //b-value
         
         if (raydistance <= maxdist && valid_signal != 0)
         {   
             intersection[0] = raydistance;
-            memcpy(&returns[idx*BLENSOR_ELEMENTS_PER_RETURN], intersection, 5*sizeof(float));
+            memcpy(&returns[idx*elements_per_return], intersection, 5*sizeof(float));
         }
         else 
         {
             intersection[0] = FLT_MAX;
         }
     }
+}
 
+static void *do_blensor_thread(void *data)
+{
+    blensor_cast_rays((BlensorThread *)data);
+    return NULL;
 }
 
+/* Split the ray buffer into one chunk per thread and cast them in parallel */
+static void threaded_blensor_processor(BlensorThread *base, int raycount, int totthread)
+{
+    ListBase threads;
+    BlensorThread *thread;
+    int a, chunk;
+
+    if (totthread > BLENDER_MAX_THREADS) totthread = BLENDER_MAX_THREADS;
+    if (totthread > raycount) totthread = raycount;
+    if (totthread < 1) totthread = 1;
 
+    thread = MEM_mallocN(sizeof(BlensorThread) * totthread, "blensor threads");
+    chunk = (raycount + totthread - 1) / totthread;
 
-/* ****************************** render invoking ***************** */
+    BLI_threadpool_init(&threads, do_blensor_thread, totthread);
+
+    for (a = 0; a < totthread; a++) {
+        thread[a] = *base;
+        thread[a].start = a * chunk;
+        thread[a].end = MIN2(raycount, (a + 1) * chunk);
+        thread[a].thread = a;
+
+        BLI_threadpool_insert(&threads, &thread[a]);
+    }
+
+    /* wait until all chunks are done */
+    BLI_threadpool_end(&threads);
+
+    MEM_freeN(thread);
+}
 
+/* Shading is done shadeless and without raytracing. Set this up once for
+ * the whole scan instead of per ray, so the threads don't have to modify
+ * shared state. blensor_shading_end restores the material modes.
+ */
+static int *blensor_shading_begin(Render *re, Main *bmain, int *saved_render_mode)
+{
+    extern Material defmaterial;
+    Material *ma;
+    int *saved_material_modes;
+    int idx = 0;
+
+    saved_material_modes = MEM_mallocN(sizeof(int) * (BLI_listbase_count(&bmain->mat) + 1), "blensor material modes");
+
+    for (ma = bmain->mat.first; ma; ma = ma->id.next) {
+        saved_material_modes[idx++] = ma->mode;
+        ma->mode |= MA_SHLESS; //Enable shadeless mode (disables lighting shaders)
+    }
+    saved_material_modes[idx] = defmaterial.mode;
+    defmaterial.mode |= MA_SHLESS;
+
+    *saved_render_mode = re->r.mode;
+    re->r.mode = ~(R_RAYTRACE); //Disable raytracing
 
-static uintptr_t convert_str_to_ptr(char *ptr_str)
+    return saved_material_modes;
+}
+
+static void blensor_shading_end(Render *re, Main *bmain, int saved_render_mode, int *saved_material_modes)
 {
-  int idx=0;
-  uintptr_t ptr=0;
-  for (idx=0; idx < 16; idx++)
-  {
-    ptr = ptr << 4;  
-    switch(ptr_str[idx])
+    extern Material defmaterial;
+    Material *ma;
+    int idx = 0;
+
+    for (ma = bmain->mat.first; ma; ma = ma->id.next) {
+        ma->mode = saved_material_modes[idx++];
+    }
+    defmaterial.mode = saved_material_modes[idx];
+
+    re->r.mode = saved_render_mode;
+    MEM_freeN(saved_material_modes);
+}
+
+
+/* cast all rays specified in *rays and return the result via *returns 
+ * every return occupies elements_per_return floats, only the first
+ * BLENSOR_ELEMENTS_PER_RETURN are written
+ * threads is the number of threads to use, 0 uses the render threads
+ * of the scene
+ */
+static void do_blensor(Render *re, float *rays, int raycount, int elements_per_ray, float *returns, int elements_per_return,
+                       float maximum_distance, Main *bmain, Scene *scene, SceneRenderLayer *srl, int shading, int threads)
+{
+    BlensorScanSettings settings;
+    BlensorThread base;
+    PointerRNA rna_cam;
+    PropertyRNA *rna_cam_prop;
+    int saved_render_mode = 0;
+    int *saved_material_modes = NULL;
+
+    RNA_pointer_create(&(re->scene->camera->id), &RNA_Object, re->scene->camera, &rna_cam);
+
+    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_dist");
+    settings.reflectivity_distance = RNA_property_float_get(&rna_cam, rna_cam_prop);
+
+    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_limit");
+    settings.reflectivity_limit = RNA_property_float_get(&rna_cam, rna_cam_prop);
+
+    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_slope");
+    settings.reflectivity_slope = RNA_property_float_get(&rna_cam, rna_cam_prop);
+
+    rna_cam_prop = RNA_struct_find_property(&rna_cam, "ref_enabled");
+    settings.reflection_enabled = RNA_property_boolean_get(&rna_cam, rna_cam_prop);
+
+    /* This is necessary, see explanation at the point of declaration */
+    R = *re;
+
+    settings.refractive_index = Blensor_GetIDPropertyValue_Double(&re->scene->world->id,"refractive_index", 1.0);
+    printf ("The refractive index of the world is: %.6f\n",settings.refractive_index);
+    printf ("reflectivity_distance: %.6f  reflectivity_limit: %.6f\n",settings.reflectivity_distance, settings.reflectivity_limit);
+
+    if (shading)
     {
-      case 'F': 
-      case 'f': ptr += 15; break;
-      case 'E': 
-      case 'e': ptr += 14; break;
-      case 'D': 
-      case 'd': ptr += 13; break;
-      case 'C': 
-      case 'c': ptr += 12; break;
-      case 'B': 
-      case 'b': ptr += 11; break;
-      case 'A': 
-      case 'a': ptr += 10; break;
-      case '0':
-      case '1':
-      case '2':
-      case '3':
-      case '4':
-      case '5':
-      case '6':
-      case '7':
-      case '8':
-      case '9': ptr += ptr_str[idx]-'0';
-            break;
-      default:
-        //You have some ugly data here
-        break;
+        saved_material_modes = blensor_shading_begin(re, bmain, &saved_render_mode);
+    }
+
+    base.re = re;
+    base.srl = srl;
+    base.settings = &settings;
+    base.rays = rays;
+    base.returns = returns;
+    base.start = 0;
+    base.end = raycount;
+    base.elements_per_ray = elements_per_ray;
+    base.elements_per_return = elements_per_return;
+    base.maximum_distance = maximum_distance;
+    base.shading = shading;
+    base.thread = 0;
+
+    /* The shading code uses per thread tables which only exist for the
+     * render threads of the scene
+     */
+    if (threads <= 0 || (shading && threads > re->r.threads))
+    {
+        threads = re->r.threads;
+    }
+
+    printf ("Blensor threads: %d\n", threads);
+    if (threads > 1)
+    {
+        threaded_blensor_processor(&base, raycount, threads);
+    }
+    else
+    {
+        blensor_cast_rays(&base);
+    }
+
+    if (shading)
+    {
+        blensor_shading_end(re, bmain, saved_render_mode, saved_material_modes);
     }
-    
-  }
-  return ptr;
 }
 
+
+
+/* ****************************** render invoking ***************** */
+
+
 /* for exec() when there is no render job
  * note: this wont check for the escape key being pressed, but doing so isnt threadsafe */
 static int render_break(void *UNUSED(rjv))
@@ -566,21 +636,151 @@ static int render_break(void *UNUSED(rjv))
 }
 
 
+/* If this is 1 the render database and raytree are still setup from a
+ * previous call with keep_setup and can be reused for the same frame
+ */
+static int render_still_available = 0;
+static int render_setup_frame = 0;
+static float render_setup_subframe = 0.f;
+static float render_current_subframe = 0.f;
+static Render *blensor_render = NULL;
+
+/* Free the render database kept by a call with keep_setup */
+static void blensor_free_render_setup(Render *re)
+{
+    if (re != NULL && render_still_available)
+    {
+        RE_Database_Free(re);
+
+        BKE_image_pool_free(re->pool);
+        re->pool = NULL;
+
+        re->scene->r.subframe = render_setup_subframe;
+    }
+    render_still_available = 0;
+}
+
+/* Free the top level raytree and the instance wrappers but keep the
+ * raytrees of the instanced objects, their geometry does not change
+ */
+static void blensor_free_toplevel_raytree(Render *re)
+{
+    ObjectInstanceRen *obi;
+
+    if (re->raytree) {
+        RE_rayobject_free(re->raytree);
+        re->raytree = NULL;
+    }
+    if (re->rayfaces) {
+        MEM_freeN(re->rayfaces);
+        re->rayfaces = NULL;
+    }
+    if (re->rayprimitives) {
+        MEM_freeN(re->rayprimitives);
+        re->rayprimitives = NULL;
+    }
+    for (obi = re->instancetable.first; obi; obi = obi->next)
+    {
+        if (obi->raytree) {
+            RE_rayobject_free(obi->raytree);
+            obi->raytree = NULL;
+        }
+    }
+}
+
+/* Move the render instances to the current object matrices (rolling
+ * shutter slices of the same frame). The database keeps the geometry of
+ * the setup, objects that moved since the setup get an instance transform
+ * and only the raytree is rebuilt. The raytrees of moved objects are kept
+ * as instances, so later slices only rebuild the top level tree.
+ * Dupli and particle instances and deforming meshes keep their state of
+ * the setup.
+ */
+static void blensor_update_render_setup(Render *re)
+{
+    ObjectInstanceRen *obi;
+    int moved = 0;
+
+    for (obi = re->instancetable.first; obi; obi = obi->next)
+    {
+        float mat[4][4], mat3[3][3];
+
+        if (obi->ob == NULL || obi->par != NULL)
+            continue;
+
+        /* view space of the setup -> object space of the setup -> current object matrix -> view space */
+        mul_m4_series(mat, re->viewmat, obi->ob->obmat, obi->obinvmat, re->viewinv);
+
+        if (obi->flag & R_DUPLI_TRANSFORMED)
+        {
+            if (equals_m4m4(mat, obi->mat))
+                continue;
+        }
+        else
+        {
+            /* obi->mat is unused for untransformed instances, compare against the identity */
+            float unit[4][4];
+            unit_m4(unit);
+            if (compare_m4m4(mat, unit, 1e-6f))
+                continue;
+        }
+
+        copy_m4_m4(obi->mat, mat);
+        invert_m4_m4(obi->imat, obi->mat);
+        copy_m3_m4(mat3, obi->mat);
+        invert_m3_m3(obi->nmat, mat3);
+        transpose_m3(obi->nmat);
+        obi->flag |= R_DUPLI_TRANSFORMED;
+        moved++;
+    }
+
+    printf ("Blensor: %d objects moved since the render setup\n", moved);
+    if (moved > 0 && (re->r.mode & R_RAYTRACE))
+    {
+        blensor_free_toplevel_raytree(re);
+        if (re->r.raytrace_structure != R_RAYSTRUCTURE_OCTREE)
+        {
+            re->r.raytrace_options |= R_RAYTRACE_USE_INSTANCES;
+        }
+        makeraytree(re);
+    }
+}
+
 /* #TODO@mgschwan: There is a memory leak somewhere in the raycasting code. Find it! */
-/* Setup the evnironment and call the raycaster function */
-void RE_BlensorFrame(Render *re, Main *bmain, Scene *scene, SceneRenderLayer *srl, Object *camera_override, unsigned int lay, int frame, const short write_still, float *rays, int raycount, int elements_per_ray, float *returns, float maximum_distance, int keep_setup, int shading)
+/* Setup the evnironment and call the raycaster function
+ * With keep_setup the render database is not freed after the rays are cast,
+ * further calls for the same frame reuse it until blensor_free_render_setup
+ * is called. The raytree is in the view space of the camera that was active
+ * when it was built, rays of other sensors have to be transformed into it.
+ * A call for another subframe of the same frame only moves the objects
+ * (see blensor_update_render_setup) instead of converting the scene again.
+ */
+void RE_BlensorFrame(Render *re, Main *bmain, Scene *scene, SceneRenderLayer *srl, Object *camera_override, unsigned int lay, int frame, const short write_still, float *rays, int raycount, int elements_per_ray, float *returns, int elements_per_return, float maximum_distance, int keep_setup, int shading, int threads)
 {
-  static int render_still_available = 0; //If this is 1 the raycasting is still setup from
-                                         //previous renders, and can be reused
-  double refractive_index = 1.0; //Vacuum
 	/* ugly global still... is to prevent preview events and signal subsurfs etc to make full resol */
 	G.is_rendering= true;
 	
 	printf ("Do Blensor processing: %d\n", frame);
 
+    if (render_still_available && frame != render_setup_frame)
+    {
+        /* The database was built for a different frame */
+        blensor_free_render_setup(re);
+    }
+    else if (render_still_available && scene->r.subframe != render_current_subframe)
+    {
+        /* Rolling shutter slice of the same frame */
+        blensor_update_render_setup(re);
+        render_current_subframe = scene->r.subframe;
+    }
+
 	scene->r.cfra= frame;
 
-	if(blensor_initialize_from_main(re, &scene->r, bmain, scene, srl, camera_override, lay, 0, 0)) {
+	if(render_still_available) {
+    printf ("Reusing the render setup of frame %d\n", frame);
+    do_blensor(re, rays, raycount, elements_per_ray, returns, elements_per_return, maximum_distance, bmain, scene, srl, shading, threads);
+  }
+	else if(blensor_initialize_from_main(re, &scene->r, bmain, scene, srl, camera_override, lay, 0, 0)) {
     MEM_reset_peak_memory();
 
     BKE_scene_camera_switch_update(re->scene);
@@ -590,25 +790,27 @@ void RE_BlensorFrame(Render *re, Main *bmain, Scene *scene, SceneRenderLayer *sr
     re->pool = BKE_image_pool_new();
 
     // moved here from the do_blensor function 
-    re->scene->r.subframe = re->mblur_offs + re->field_offs;
+    // the subframe set by the caller is kept for rolling shutter scans
+    render_setup_subframe = re->scene->r.subframe;
+    render_current_subframe = render_setup_subframe;
+    re->scene->r.subframe = render_setup_subframe + re->mblur_offs + re->field_offs;
     RE_Database_FromScene(re, re->main, re->scene, re->lay, 1); //Sets up all the stuff
 		RE_Database_Preprocess(re);
+    render_still_available = 1;
+    render_setup_frame = frame;
 
-    do_blensor(re, rays, raycount, elements_per_ray, returns, maximum_distance, bmain, scene, srl, shading);
-	
-    // moved here from the end of do_blensor 
-    // free all render verts etc 
-    RE_Database_Free(re);
-
-	BKE_image_pool_free(re->pool);
-    re->pool = NULL;
-
-    re->scene->r.subframe = 0.f;
-    render_still_available = 0;
+    do_blensor(re, rays, raycount, elements_per_ray, returns, elements_per_return, maximum_distance, bmain, scene, srl, shading, threads);
 
     //BLI_callback_exec(re->main, (ID *)scene, BLI_CB_EVT_RENDER_POST); 
   }
 
+  if (!keep_setup)
+  {
+    // moved here from the end of do_blensor 
+    // free all render verts etc 
+    blensor_free_render_setup(re);
+  }
+
   //BLI_callback_exec(re->main, (ID *)scene, G.afbreek ? BLI_CB_EVT_RENDER_CANCEL : BLI_CB_EVT_RENDER_COMPLETE);
 
 	/* UGLY WARNING */
@@ -616,36 +818,29 @@ void RE_BlensorFrame(Render *re, Main *bmain, Scene *scene, SceneRenderLayer *sr
 }
 
 /* executes blocking blensor */
-int screen_blensor_exec(bContext *C, int raycount, int elements_per_ray, int keep_render_setup, int shading, float maximum_distance, char *ray_ptr_str, char *return_ptr_str)
+int screen_blensor_exec(bContext *C, int raycount, int elements_per_ray, int elements_per_return, int keep_render_setup, int shading, float maximum_distance, float *rays, float *returns, int threads)
 {
 	Scene *scene= CTX_data_scene(C);
     SceneRenderLayer *srl = NULL;
-	static Render *re=NULL;
 	Image *ima;
 	View3D *v3d= CTX_wm_view3d(C);
 	Main *mainp= CTX_data_main(C);
 	unsigned int lay= (v3d)? v3d->lay: scene->lay;
-    float *rays;
-    float *returns;
 
 	struct Object *camera_override= v3d ? V3D_CAMERA_LOCAL(v3d) : NULL;
 
-
-    rays = (float *)convert_str_to_ptr(ray_ptr_str);
-    returns = (float *)convert_str_to_ptr(return_ptr_str);
-      
     if (raycount > 0)
     {
             
         printf ("Raycount: %d\n",raycount);
         
-            if(re==NULL) {
-                re = RE_NewSceneRender(scene);
+            if(blensor_render==NULL) {
+                blensor_render = RE_NewSceneRender(scene);
             }
         
     
         G.is_break = false;
-        RE_test_break_cb(re, NULL, render_break);
+        RE_test_break_cb(blensor_render, NULL, render_break);
 
         ima= BKE_image_verify_viewer(IMA_TYPE_R_RESULT, "Render Result");
         BKE_image_signal(ima, NULL, IMA_SIGNAL_FREE);
@@ -661,11 +856,11 @@ int screen_blensor_exec(bContext *C, int raycount, int elements_per_ray, int kee
 
         BLI_threaded_malloc_begin();
 
-        RE_BlensorFrame(re, mainp, scene, NULL, camera_override, lay, scene->r.cfra, 0, rays, raycount, elements_per_ray, returns, maximum_distance, keep_render_setup, shading);
+        RE_BlensorFrame(blensor_render, mainp, scene, NULL, camera_override, lay, scene->r.cfra, 0, rays, raycount, elements_per_ray, returns, elements_per_return, maximum_distance, keep_render_setup, shading, threads);
 
         BLI_threaded_malloc_end();
 
-        RE_SetReports(re, NULL);
+        RE_SetReports(blensor_render, NULL);
 
             // no redraw needed, we leave state as we entered it
         ED_update_for_newframe(mainp, scene, 1);
@@ -673,13 +868,20 @@ int screen_blensor_exec(bContext *C, int raycount, int elements_per_ray, int kee
         WM_event_add_notifier(C, NC_SCENE|ND_RENDER_RESULT, scene);
         if (keep_render_setup == 0)
         {
-            re = NULL;
+            blensor_render = NULL;
         }
 
      }
 	return OPERATOR_FINISHED;
 }
 
+/* Free the render setup kept by screen_blensor_exec with keep_render_setup */
+void screen_blensor_free(bContext *UNUSED(C))
+{
+    blensor_free_render_setup(blensor_render);
+    blensor_render = NULL;
+}
+
 /* Return the floating point zbuffer */
 void blensor_Image_copy_zbuf(Image *image, bContext *C, int *outbuffer_len, float **outbuffer)
 {
@@ -717,5 +919,32 @@ void blensor_Image_copy_zbuf(Image *image, bContext *C, int *outbuffer_len, floa
 	BKE_image_release_ibuf(image, ibuf, lock);
 }
 
+/* Copy the floating point zbuffer into outbuffer, at most outbuffer_len
+ * values are copied. Returns the number of pixels of the zbuffer or -1 if
+ * the image has no zbuffer
+ */
+int blensor_Image_copy_zbuf_into(Image *image, bContext *C, float *outbuffer, int outbuffer_len)
+{
+  ImageUser iuser;
+	void *lock;
+  Scene *scene;
+	ImBuf *ibuf;
+  int count = -1;
+  
+  scene = CTX_data_scene(C);
+
+	iuser.scene = scene;
+	iuser.ok = 1;
 
+	ibuf = BKE_image_acquire_ibuf(image, &iuser, &lock);
 
+	if (ibuf == NULL || ibuf->zbuf_float == NULL) {
+			printf ("Couldn't acquire zbuffer from image");
+	}
+	else {
+        count = ibuf->x * ibuf->y;
+        memcpy((void *)outbuffer, (const void *)ibuf->zbuf_float, MIN2(count, outbuffer_len) * sizeof(float));
+	}
+	BKE_image_release_ibuf(image, ibuf, lock);
+  return count;
+}
@@ -94,6 +94,11 @@
 #include "zbuf.h"
 
 
-int screen_blensor_exec(bContext *C, int raycount, int elements_per_ray, int keep_render_setup, int shading, float maximum_distance, char *ray_ptr_str, char *return_ptr_str);
+/* Number of floats written per return: distance, x, y, z, object id, r, g, b */
+#define BLENSOR_ELEMENTS_PER_RETURN 8
+
+int screen_blensor_exec(bContext *C, int raycount, int elements_per_ray, int elements_per_return, int keep_render_setup, int shading, float maximum_distance, float *rays, float *returns, int threads);
+void screen_blensor_free(bContext *C);
+int blensor_Image_copy_zbuf_into(Image *image, bContext *C, float *outbuffer, int outbuffer_len);
 void blensor_Image_copy_zbuf(Image *image, bContext *C, int *outbuffer_len, float **outbuffer);
 
@@ -0,0 +1,156 @@
+# Apache License, Version 2.0
+
+# python3 tests/python/bl_blensor_raycast.py -- --verbose
+# Does not need bpy, the BlenSor raycast module only depends on numpy.
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "..", "release", "scripts", "addons", "blensor"))
+import raycast
+
+
+def brute_force(origin, direction, triangles, max_distance=np.inf):
+    """Closest hit of a single ray, one triangle at a time"""
+    direction = direction / np.linalg.norm(direction)
+    best, best_face = np.inf, -1
+    for face, (v1, v2, v3) in enumerate(triangles):
+        edge1 = v2 - v1
+        edge2 = v3 - v1
+        pvec = np.cross(direction, edge2)
+        det = np.dot(edge1, pvec)
+        if abs(det) < raycast.machineEpsilon:
+            continue
+        tvec = origin - v1
+        u = np.dot(tvec, pvec) / det
+        qvec = np.cross(tvec, edge1)
+        v = np.dot(direction, qvec) / det
+        t = np.dot(edge2, qvec) / det
+        if u >= 0.0 and u <= 1.0 and v >= 0.0 and u + v <= 1.0 and t >= raycast.machineEpsilon and t < best:
+            best, best_face = t, face
+    if best > max_distance:
+        return np.inf, -1
+    return best, best_face
+
+
+class RaycastTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(42)
+        self.triangles = self.rng.uniform(-1.0, 1.0, (60, 3, 3))
+        self.chunk_size = raycast.CHUNK_SIZE
+
+    def tearDown(self):
+        raycast.CHUNK_SIZE = self.chunk_size
+
+    def assertSameHits(self, origins, directions, max_distance=np.inf):
+        origins = np.broadcast_to(origins, directions.shape)
+        grid = raycast.UniformGrid(self.triangles)
+        distances, faces = grid.closest_intersection(origins, directions, max_distance)
+        all_distances, all_faces = raycast.closest_triangle_intersection(origins, directions,
+                                                                         self.triangles, max_distance)
+        for idx in range(len(directions)):
+            distance, face = brute_force(origins[idx], directions[idx], self.triangles, max_distance)
+            self.assertEqual(faces[idx], face)
+            self.assertEqual(all_faces[idx], face)
+            if face >= 0:
+                self.assertAlmostEqual(distances[idx], distance, places=9)
+                self.assertAlmostEqual(all_distances[idx], distance, places=9)
+            else:
+                self.assertTrue(np.isinf(distances[idx]))
+                self.assertTrue(np.isinf(all_distances[idx]))
+
+    def test_rays_from_inside(self):
+        self.assertSameHits(np.zeros(3), self.rng.normal(size=(300, 3)))
+
+    def test_rays_from_outside(self):
+        origins = self.rng.uniform(-4.0, 4.0, (300, 3))
+        directions = self.rng.uniform(-1.0, 1.0, (300, 3)) - 0.25 * origins
+        self.assertSameHits(origins, directions)
+
+    def test_max_distance(self):
+        self.assertSameHits(np.zeros(3), self.rng.normal(size=(300, 3)), max_distance=0.5)
+
+    def test_misses(self):
+        """Rays that start beside the grid and point away from it"""
+        origins = self.rng.uniform(2.0, 3.0, (50, 3))
+        distances, faces = raycast.UniformGrid(self.triangles).closest_intersection(origins, origins)
+        self.assertTrue(np.all(faces == -1))
+        self.assertTrue(np.all(np.isinf(distances)))
+
+    def test_axis_parallel_rays(self):
+        """Directions with zero components walk along the grid cells"""
+        directions = np.repeat(np.eye(3), 40, axis=0) * np.sign(self.rng.uniform(-1.0, 1.0, (120, 1)))
+        origins = self.rng.uniform(-1.0, 1.0, (120, 3))
+        self.assertSameHits(origins, directions)
+
+    def test_rays_parallel_to_triangle(self):
+        """Rays in the plane of a triangle do not hit it"""
+        triangle = np.array([[[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]])
+        origins = np.array([[-1.0, 0.25, 0.0], [0.25, -1.0, 0.0], [-1.0, -1.0, 0.0]])
+        directions = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [1.0, 1.0, 0.0]])
+        distances, faces = raycast.UniformGrid(triangle).closest_intersection(origins, directions)
+        self.assertTrue(np.all(faces == -1))
+        distances, faces = raycast.closest_triangle_intersection(origins, directions, triangle)
+        self.assertTrue(np.all(faces == -1))
+
+    def test_chunk_boundaries(self):
+        """Results do not depend on how the ray/triangle pairs are split"""
+        directions = self.rng.normal(size=(200, 3))
+        grid = raycast.UniformGrid(self.triangles)
+        expected = grid.closest_intersection(np.zeros(3), directions)
+        expected_all = raycast.closest_triangle_intersection(np.zeros(3), directions, self.triangles)
+        for chunk_size in [1, 7, 59, 60, 61]:
+            raycast.CHUNK_SIZE = chunk_size
+            distances, faces = grid.closest_intersection(np.zeros(3), directions)
+            np.testing.assert_array_equal(faces, expected[1])
+            np.testing.assert_array_equal(distances, expected[0])
+            distances, faces = raycast.closest_triangle_intersection(np.zeros(3), directions, self.triangles)
+            np.testing.assert_array_equal(faces, expected_all[1])
+            np.testing.assert_array_equal(distances, expected_all[0])
+
+    def test_face_normals(self):
+        normals = raycast.face_normals(self.triangles)
+        for (v1, v2, v3), normal in zip(self.triangles, normals):
+            expected = np.cross(v2 - v1, v3 - v1)
+            np.testing.assert_allclose(normal, expected / np.linalg.norm(expected), atol=1e-12)
+        degenerate = np.array([[[0.0, 0.0, 0.0], [1.0, 1.0, 1.0], [2.0, 2.0, 2.0]]])
+        np.testing.assert_array_equal(raycast.face_normals(degenerate), np.zeros((1, 3)))
+
+    def test_transform_normals(self):
+        """Normals of hit faces in object space, rotated and non-uniformly
+           scaled into world space, match the normals of the world triangles
+        """
+        angle = 0.7
+        matrix = np.eye(4)
+        matrix[0:3, 0:3] = np.dot([[np.cos(angle), -np.sin(angle), 0.0],
+                                   [np.sin(angle), np.cos(angle), 0.0],
+                                   [0.0, 0.0, 1.0]], np.diag([3.0, 0.5, -2.0]))
+        matrix[0:3, 3] = [1.0, -2.0, 0.5]
+        world = np.dot(self.triangles, matrix[0:3, 0:3].T) + matrix[0:3, 3]
+        faces = self.rng.randint(0, len(self.triangles), 20)
+        normals = raycast.transform_normals(raycast.face_normals(self.triangles)[faces], matrix)
+        np.testing.assert_allclose(normals, raycast.face_normals(world)[faces], atol=1e-9)
+
+        """The normal of the closest hit is the one of the hit world triangle"""
+        directions = self.rng.normal(size=(100, 3))
+        origin = np.dot(np.linalg.inv(matrix), [0.0, 0.0, 0.0, 1.0])[0:3]
+        distances, faces = raycast.UniformGrid(self.triangles).closest_intersection(origin, directions)
+        hit = faces >= 0
+        world_distances, world_faces = raycast.closest_triangle_intersection(
+            np.dot(matrix[0:3, 0:3], origin) + matrix[0:3, 3], np.dot(directions, matrix[0:3, 0:3].T), world)
+        np.testing.assert_array_equal(world_faces, faces)
+        np.testing.assert_allclose(raycast.transform_normals(raycast.face_normals(self.triangles)[faces[hit]], matrix),
+                                   raycast.face_normals(world)[world_faces[hit]], atol=1e-9)
+
+    def test_empty(self):
+        grid = raycast.UniformGrid(np.zeros((0, 3, 3)))
+        distances, faces = grid.closest_intersection(np.zeros(3), self.rng.normal(size=(5, 3)))
+        self.assertTrue(np.all(faces == -1))
+
+
+if __name__ == '__main__':
+    sys.argv = [__file__] + (sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
+    unittest.main()
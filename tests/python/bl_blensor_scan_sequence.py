@@ -0,0 +1,60 @@
+# Apache License, Version 2.0
+
+# ./blender.bin --background -noaudio --python tests/python/bl_blensor_scan_sequence.py -- --verbose
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import bpy
+
+from blensor import evd
+from blensor import mesh_utils
+from blensor import scan_sequence
+
+
+class ScanSequenceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.obj = bpy.data.objects.new("Scan.sequence.Test", bpy.data.meshes.new("Scan.sequence.Test_mesh"))
+        bpy.context.scene.objects.link(self.obj)
+        self.obj[scan_sequence.CACHE_PROPERTY] = os.path.join(self.directory, "Scan")
+
+    def tearDown(self):
+        scan_sequence.delete_cache(self.obj)
+        os.rmdir(self.directory)
+        mesh = self.obj.data
+        bpy.context.scene.objects.unlink(self.obj)
+        bpy.data.objects.remove(self.obj)
+        bpy.data.meshes.remove(mesh)
+
+    def write_frame(self, frame, count):
+        scan = np.zeros(count, dtype=evd.ENTRY_DTYPE)
+        scan["distance"] = np.arange(count) + frame
+        scan["object_id"] = frame
+        np.savez(scan_sequence.cache_filename(self.obj[scan_sequence.CACHE_PROPERTY], frame),
+                 points=np.zeros((count, 3), dtype=np.float32), matrix=np.eye(4), scan=scan)
+        return scan
+
+    def test_side_buffer_of_cached_frame(self):
+        scans = {frame: self.write_frame(frame, 5 + frame) for frame in (1, 2)}
+        for frame in (1, 2, 1):
+            scan_sequence.load_frame(self.obj, frame)
+            self.assertEqual(self.obj.data.name, "Scan.sequence.Test_mesh")
+            self.assertEqual(len(self.obj.data.vertices), len(scans[frame]))
+            side_buffer = mesh_utils.get_side_buffer(self.obj.data)
+            self.assertIsNotNone(side_buffer)
+            np.testing.assert_array_equal(side_buffer, scans[frame])
+
+    def test_frame_without_scan(self):
+        self.write_frame(1, 5)
+        scan_sequence.load_frame(self.obj, 1)
+        scan_sequence.load_frame(self.obj, 3)
+        self.assertEqual(len(self.obj.data.vertices), 0)
+        self.assertIsNone(mesh_utils.get_side_buffer(self.obj.data))
+
+
+if __name__ == '__main__':
+    sys.argv = [__file__] + (sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
+    unittest.main()